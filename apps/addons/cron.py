@@ -1,4 +1,6 @@
 import array
+import cPickle
+import functools
 import itertools
 import logging
 import operator
@@ -9,11 +11,11 @@ from datetime import datetime, timedelta
 
 from django.conf import settings
 from django.db import connections, transaction
-from django.db.models import Q, F, Avg
+from django.db.models import Q, F
 
 import multidb
 import path
-from lib import recommend
+from lib.recommend import scores, sparse
 from celery.task.sets import TaskSet
 from celeryutils import task
 import waffle
@@ -25,9 +27,13 @@ from addons import search
 from addons.models import Addon, FrozenAddon, AppSupport
 from addons.utils import ReverseNameLookup, FeaturedManager, CreaturedManager
 from files.models import File
-from stats.models import UpdateCount
 from translations.models import Translation
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 log = logging.getLogger('z.cron')
 task_log = logging.getLogger('z.task')
 recs_log = logging.getLogger('z.recs')
@@ -145,33 +151,22 @@ def update_addon_average_daily_users():
     cursor.close()
 
     ts = [_update_addon_average_daily_users.subtask(args=[chunk])
-          for chunk in chunked(d, 250)]
+          for chunk in chunked(d, 1000)]
     TaskSet(ts).apply_async()
 
 
 @task
 def _update_addon_average_daily_users(data, **kw):
     task_log.info("[%s] Updating add-ons ADU totals." % (len(data)))
-
-    for pk, count in data:
-        try:
-            addon = Addon.objects.get(pk=pk)
-        except Addon.DoesNotExist:
-            # The processing input comes from metrics which might be out of
-            # date in regards to currently existing add-ons
-            m = "Got an ADU update (%s) but the add-on doesn't exist (%s)"
-            task_log.debug(m % (count, pk))
-            continue
-
-        if (count - addon.total_downloads) > 10000:
-            # Adjust ADU to equal total downloads so bundled add-ons don't
-            # skew the results when sorting by users.
-            task_log.info('Readjusted ADU count for addon %s' % addon.slug)
-            addon.update(average_daily_users=addon.total_downloads)
-        else:
-            #task_log.debug('Updating "%s" :: ADU %s -> %s' %
-            #               (addon.slug, addon.average_daily_users, count))
-            addon.update(average_daily_users=count)
+    # Adjust ADU to equal total downloads so bundled add-ons don't skew the
+    # results when sorting by users.
+    changed = _update_addon_stats(data, ['adu BIGINT'], {
+        'average_daily_users': """IF(tmp_addon_stats.adu >
+                                     addons.totaldownloads + 10000,
+                                     addons.totaldownloads,
+                                     tmp_addon_stats.adu)"""})
+    task_log.info("[%s] Changed ADU totals for %s add-ons." %
+                  (len(data), changed))
 
 
 @cronjobs.register
@@ -191,7 +186,7 @@ def update_addon_download_totals():
     cursor.close()
 
     ts = [_update_addon_download_totals.subtask(args=[chunk])
-          for chunk in chunked(d, 250)]
+          for chunk in chunked(d, 1000)]
     TaskSet(ts).apply_async()
 
 
@@ -199,17 +194,61 @@ def update_addon_download_totals():
 def _update_addon_download_totals(data, **kw):
     task_log.info("[%s] Updating add-ons download+average totals." %
                    (len(data)))
+    changed = _update_addon_stats(data, ['average BIGINT', 'total BIGINT'], {
+        'average_daily_downloads': 'tmp_addon_stats.average',
+        'totaldownloads': 'tmp_addon_stats.total'})
+    task_log.info("[%s] Changed download totals for %s add-ons." %
+                  (len(data), changed))
 
-    for pk, avg, sum in data:
-        try:
-            Addon.objects.get(pk=pk).update(average_daily_downloads=avg,
-                                            total_downloads=sum)
-        except Addon.DoesNotExist:
-            # The processing input comes from metrics which might be out of
-            # date in regards to currently existing add-ons
-            m = ("Got new download totals (total=%s,avg=%s) but the add-on"
-                 "doesn't exist (%s)" % (sum, avg, pk))
-            task_log.debug(m)
+
+def _update_addon_stats(data, columns, values):
+    """
+    Updates add-ons from `data`, rows of (addon_id, column, ...), without
+    going through the ORM one add-on at a time.
+
+    The rows are staged in a temporary table, tmp_addon_stats, with
+    `columns` (their SQL definitions), and `values` maps addons columns to
+    the SQL that works out their new values from it. Only the add-ons that
+    change are updated, in one joined UPDATE, and invalidated and
+    reindexed together. Ids that aren't add-ons any more (the stats can be
+    out of date) are skipped by the join. Returns how many add-ons changed.
+    """
+    from . import tasks
+    if not data:
+        return 0
+    cursor = connections['default'].cursor()
+    cursor.execute('DROP TEMPORARY TABLE IF EXISTS tmp_addon_stats')
+    cursor.execute("""
+        CREATE TEMPORARY TABLE tmp_addon_stats
+        (addon_id INT PRIMARY KEY, %s)""" %
+        ', '.join(columns))
+    row = '(%s)' % ','.join(['%s'] * (len(columns) + 1))
+    cursor.execute('INSERT INTO tmp_addon_stats VALUES %s' %
+                   ','.join([row] * len(data)),
+                   list(itertools.chain(*data)))
+
+    join = 'addons INNER JOIN tmp_addon_stats ON addons.id = addon_id'
+    changes = ' OR '.join('addons.%s <> %s' % (column, value)
+                          for column, value in values.items())
+    cursor.execute('SELECT addons.id FROM %s WHERE %s' % (join, changes))
+    ids = [r[0] for r in cursor.fetchall()]
+    if ids:
+        # MySQL assigns left to right, so none of `values` may use a
+        # column that this sets.
+        cursor.execute('UPDATE %s SET %s WHERE addons.id IN (%s)' % (
+            join, ', '.join('addons.%s = %s' % (column, value)
+                            for column, value in values.items()),
+            ','.join(map(str, ids))))
+    cursor.execute('DROP TEMPORARY TABLE tmp_addon_stats')
+    transaction.commit_unless_managed()
+
+    # All our updates were sql, so invalidate and reindex manually.
+    if ids:
+        Addon.objects.invalidate(*Addon.uncached.filter(id__in=ids)
+                                 .no_transforms())
+        for chunk in chunked(sorted(ids), 150):
+            tasks.index_addons.delay(chunk)
+    return len(ids)
 
 
 def _change_last_updated(next):
@@ -349,92 +388,274 @@ def deliver_hotness():
     a = avg(users this week)
     b = avg(users three weeks before this week)
     hotness = (a-b) / b if a > 1000 and b > 1 else 0
+
+    Both averages come out of one pass over update_counts, and only the
+    add-ons whose hotness changed are written, HOTNESS_BATCH at a time with
+    HOTNESS_THROTTLE seconds between batches. They're reindexed too.
+    """
+    frozen = set(FrozenAddon.objects.values_list('addon', flat=True))
+    addons = (Addon.objects.no_cache().exclude(type=amo.ADDON_PERSONA)
+              .values_list('id', 'hotness'))
+    # update_counts.date is a DATE, so compare it with dates.
+    today = datetime.now().date()
+    one_week = today - timedelta(days=7)
+    four_weeks = today - timedelta(days=28)
+    cursor = connections[multidb.get_slave()].cursor()
+    cursor.execute("""
+        SELECT addon_id,
+               AVG(IF(`date` >= %s, `count`, NULL)),
+               AVG(IF(`date` <= %s, `count`, NULL))
+        FROM update_counts
+        WHERE `date` >= %s
+        GROUP BY addon_id""", [one_week, one_week, four_weeks])
+    averages = dict((pk, (this, three))
+                    for pk, this, three in cursor.fetchall())
+    cursor.close()
+
+    ids, this, three, old = [], [], [], []
+    for pk, hotness in addons:
+        ids.append(pk)
+        old.append(hotness)
+        if pk in frozen:
+            # Frozen add-ons never get a hotness score.
+            a, b = 0, 0
+        else:
+            a, b = averages.get(pk, (0, 0))
+        this.append(float(a or 0))
+        three.append(float(b or 0))
+    hotness = _hotness(this, three)
+    changed = [(pk, new) for pk, new, was in zip(ids, hotness, old)
+               if new != was]
+    log.info('Updating hotness for %s of %s add-ons.' %
+             (len(changed), len(ids)))
+
+    for i, chunk in enumerate(chunked(changed, settings.HOTNESS_BATCH)):
+        if i and settings.HOTNESS_THROTTLE:
+            # Let the database catch its breath.
+            time.sleep(settings.HOTNESS_THROTTLE)
+        _update_addon_stats(chunk, ['hotness DOUBLE'],
+                            {'hotness': 'tmp_addon_stats.hotness'})
+
+
+def _hotness(this, three):
+    """
+    Hotness for each add-on, given lists of their average users this week
+    and in the three weeks before.
     """
-    frozen = [f.id for f in FrozenAddon.objects.all()]
-    all_ids = list((Addon.objects.exclude(type=amo.ADDON_PERSONA)
-                   .values_list('id', flat=True)))
-    now = datetime.now()
-    one_week = now - timedelta(days=7)
-    four_weeks = now - timedelta(days=28)
-    for ids in chunked(all_ids, 300):
-        addons = Addon.uncached.filter(id__in=ids).no_transforms()
-        ids = [a.id for a in addons if a.id not in frozen]
-        qs = (UpdateCount.objects.filter(addon__in=ids)
-              .values_list('addon').annotate(Avg('count')))
-        thisweek = dict(qs.filter(date__gte=one_week))
-        threeweek = dict(qs.filter(date__range=(four_weeks, one_week)))
-        for addon in addons:
-            this, three = thisweek.get(addon.id, 0), threeweek.get(addon.id, 0)
-            if this > 1000 and three > 1:
-                addon.update(hotness=(this - three) / float(three))
-            else:
-                addon.update(hotness=0)
-        # Let the database catch its breath.
-        time.sleep(10)
+    if numpy is None:
+        return [(a - b) / b if a > 1000 and b > 1 else 0.
+                for a, b in zip(this, three)]
+    this, three = numpy.array(this), numpy.array(three)
+    hot = numpy.zeros(len(this))
+    rising = (this > 1000) & (three > 1)
+    hot[rising] = (this[rising] - three[rising]) / three[rising]
+    return hot.tolist()
+
+
+RECS_PER_ADDON = 10
+
+RECS_ADDONS_SQL = """
+    SELECT id FROM addons
+    WHERE inactive=0 AND status=4 AND addontype_id <> 9
+          AND current_version IS NOT NULL
+"""
+
+RECS_SQL = """
+    SELECT addon_id, collection_id
+    FROM synced_addons_collections ac
+    INNER JOIN addons ON
+        (ac.addon_id=addons.id AND inactive=0 AND status=4
+         AND addontype_id <> 9 AND current_version IS NOT NULL)
+    WHERE collection_id <= %s {where}
+    ORDER BY addon_id, collection_id
+"""
 
 
 @cronjobs.register
-def recs():
+def recs(full=False):
+    """
+    Only the add-ons whose collections changed since the last run, and the
+    add-ons whose recommendations that could change, are worked out again.
+    Everything is rebuilt with `full` or when there's no state from the
+    last run in RECS_STATE_PATH.
+    """
     start = time.time()
     cursor = connections[multidb.get_slave()].cursor()
-    cursor.execute("""
-        SELECT addon_id, collection_id
-        FROM synced_addons_collections ac
-        INNER JOIN addons ON
-            (ac.addon_id=addons.id AND inactive=0 AND status=4
-             AND addontype_id <> 9 AND current_version IS NOT NULL)
-        ORDER BY addon_id, collection_id
-    """)
-    qs = cursor.fetchall()
-    recs_log.info('%.2fs (query) : %s rows' % (time.time() - start, len(qs)))
-    addons = _group_addons(qs)
+    # Synced collections are only ever added or deleted, so the highest id
+    # marks the collections a run has seen.
+    cursor.execute('SELECT MAX(id) FROM synced_collections')
+    watermark = cursor.fetchone()[0] or 0
+    cursor.execute(RECS_ADDONS_SQL)
+    eligible = set(r[0] for r in cursor.fetchall())
+
+    state = None if full else _load_recs_state()
+    if state is None:
+        cursor.execute(RECS_SQL.format(where=''), [watermark])
+        qs = cursor.fetchall()
+        recs_log.info('%.2fs (query) : %s rows' %
+                      (time.time() - start, len(qs)))
+        groups = _group_addons(qs)
+    else:
+        groups = _update_groups(cursor, state, watermark, eligible)
+    # Don't generate recs for frozen add-ons.
+    frozen = set(FrozenAddon.objects.values_list('addon', flat=True))
+    for addon in frozen:
+        if addon in groups:
+            recs_log.info('Skipping frozen addon %s.' % addon)
+    addons = _skip_frozen(groups, frozen)
     recs_log.info('%.2fs (groupby) : %s addons' %
                   ((time.time() - start), len(addons)))
 
-    if not len(addons):
-        return
-
-    # Check our memory usage.
-    try:
-        p = subprocess.Popen('%s -p%s -o rss' % (settings.PS_BIN, os.getpid()),
-                             shell=True, stdout=subprocess.PIPE)
-        recs_log.info('%s bytes' % ' '.join(p.communicate()[0].split()))
-    except Exception:
-        log.error('Could not call ps', exc_info=True)
-
-    sim = recommend.similarity  # Locals are faster.
-    sims, start, timers = {}, [time.time()], {'calc': [], 'sql': []}
-
-    def write_recs():
-        calc = time.time()
-        timers['calc'].append(calc - start[0])
+    matrix, dump = sparse.Incidence(addons), _dump_recs
+    only = None
+    if state is not None:
+        old = _skip_frozen(state['groups'], state['frozen'])
+        current = _load_recs(cursor)
+        only = _affected_addons(matrix, old, addons, current)
+        dump = functools.partial(_update_recs, current=current)
+        gone = [a for a in old if a not in addons]
+        if gone:
+            _delete_recs(gone)
+        recs_log.info('%s addons changed, %s to update' %
+                      (len(set(old) ^ set(addons)), len(only)))
+
+    if len(addons):
+        # Check our memory usage.
+        try:
+            p = subprocess.Popen('%s -p%s -o rss' % (settings.PS_BIN,
+                                                     os.getpid()),
+                                 shell=True, stdout=subprocess.PIPE)
+            recs_log.info('%s bytes' % ' '.join(p.communicate()[0].split()))
+        except Exception:
+            log.error('Could not call ps', exc_info=True)
+
+    # The top 10 for every add-on come out of a sparse product of the
+    # add-on x collection matrix, a block of add-ons at a time.
+    timers, calc = {'calc': [], 'sql': []}, time.time()
+    blocks = sparse.top_similar(matrix, n=RECS_PER_ADDON,
+                                block_size=settings.RECS_BLOCK_SIZE,
+                                processes=settings.RECS_PROCESSES,
+                                only=only)
+    failed = False
+    for sims in blocks:
+        sql = time.time()
+        timers['calc'].append(sql - calc)
         try:
-            _dump_recs(sims)
+            dump(sims)
         except Exception:
+            failed = True
             recs_log.error('Error dumping recommendations. SQL issue.',
                            exc_info=True)
-        sims.clear()
-        timers['sql'].append(time.time() - calc)
-        start[0] = time.time()
-
-    for idx, (addon, collections) in enumerate(addons.iteritems(), 1):
-        xs = [(other, sim(collections, cs))
-              for other, cs in addons.iteritems()]
-        # Sort by similarity and keep the top N.
-        others = sorted(xs, key=operator.itemgetter(1), reverse=True)
-        sims[addon] = [(k, v) for k, v in others[:11] if k != addon]
-
-        if idx % 50 == 0:
-            write_recs()
-    else:
-        write_recs()
+        calc = time.time()
+        timers['sql'].append(calc - sql)
+
+    # If some of the rows didn't make it the next run has to start over.
+    _save_recs_state(None if failed else {
+        'watermark': watermark, 'eligible': eligible, 'groups': groups,
+        'frozen': frozen})
+    if not failed:
+        recs_index()
 
+    if not len(addons):
+        return
     avg_len = sum(len(v) for v in addons.itervalues()) / float(len(addons))
     recs_log.info('%s addons: average length: %.2f' % (len(addons), avg_len))
     recs_log.info('Processing time: %.2fs' % sum(timers['calc']))
     recs_log.info('SQL time: %.2fs' % sum(timers['sql']))
 
 
+@cronjobs.register
+def recs_index():
+    """Write what's in addon_recommendations out to RECS_INDEX_PATH."""
+    start = time.time()
+    recs = _load_recs(connections['default'].cursor())
+    scores.write(settings.RECS_INDEX_PATH, recs)
+    recs_log.info('%.2fs (index) : %s addons' % (time.time() - start,
+                                                 len(recs)))
+
+
+def _update_groups(cursor, state, watermark, eligible):
+    """
+    Brings the {addon: collections} groups from the last run up to date,
+    only going back to the db for the add-ons that gained or lost a
+    collection, or that started or stopped being public.
+    """
+    old = state['groups']
+    cursor.execute("""
+        SELECT DISTINCT addon_id FROM synced_addons_collections
+        WHERE collection_id > %s AND collection_id <= %s""",
+                   [state['watermark'], watermark])
+    touched = set(r[0] for r in cursor.fetchall())
+    # Collections under the last watermark can only have been deleted.
+    cursor.execute('SELECT id FROM synced_collections WHERE id <= %s',
+                   [state['watermark']])
+    live = set(r[0] for r in cursor.fetchall())
+    touched.update(a for a, cs in old.iteritems() if not live.issuperset(cs))
+    touched.update(eligible.symmetric_difference(state['eligible']))
+
+    groups = dict((a, cs) for a, cs in old.iteritems()
+                  if a in eligible and a not in touched)
+    for chunk in chunked(sorted(touched & eligible), 1000):
+        cursor.execute(RECS_SQL.format(where='AND addon_id IN %s'),
+                       [watermark, chunk])
+        groups.update(_group_addons(cursor.fetchall()))
+    recs_log.info('%s addons touched since collection %s' %
+                  (len(touched), state['watermark']))
+    return groups
+
+
+def _affected_addons(matrix, old, new, current):
+    """
+    The add-ons in `new` whose recommendations could have changed: the ones
+    that changed themselves, the ones recommending a changed add-on today,
+    and the ones that a changed add-on is now at least as similar to as
+    their current 10th best.
+    """
+    changed = set(a for a in set(old) | set(new) if old.get(a) != new.get(a))
+    if not changed:
+        return set()
+    affected = set(a for a in changed if a in new)
+    affected.update(a for a, others in current.iteritems()
+                    if a in new and not changed.isdisjoint(others))
+    # similarity = 1 / (1 + symmetric difference)
+    worst = dict((a, int(round(1 / min(others.values()) - 1)))
+                 for a, others in current.iteritems()
+                 if len(others) >= RECS_PER_ADDON)
+    affected.update(matrix.reached(changed, worst))
+    return affected
+
+
+def _load_recs_state():
+    if os.path.exists(settings.RECS_STATE_PATH):
+        try:
+            with open(settings.RECS_STATE_PATH, 'rb') as f:
+                return cPickle.load(f)
+        except Exception:
+            recs_log.error('Could not load the recs state.', exc_info=True)
+    recs_log.info('No state from the last run, rebuilding everything.')
+
+
+def _save_recs_state(state):
+    if state is None:
+        if os.path.exists(settings.RECS_STATE_PATH):
+            os.remove(settings.RECS_STATE_PATH)
+        return
+    tmp = settings.RECS_STATE_PATH + '.tmp'
+    with open(tmp, 'wb') as f:
+        cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, settings.RECS_STATE_PATH)
+
+
+def _load_recs(cursor):
+    """What's in addon_recommendations, as {addon: {other_addon: score}}."""
+    cursor.execute('SELECT addon_id, other_addon_id, score '
+                   'FROM addon_recommendations')
+    recs = {}
+    for addon, other, score in cursor.fetchall():
+        recs.setdefault(addon, {})[other] = score
+    return recs
+
+
 def _dump_recs(sims):
     # Dump a dictionary of {addon: (other_addon, score)} into the
     # addon_recommendations table.
@@ -451,6 +672,45 @@ def _dump_recs(sims):
     cursor.execute('COMMIT')
 
 
+def _update_recs(sims, current):
+    """
+    Like `_dump_recs()`, but only touches the rows that are different from
+    the `current` {addon: {other_addon: score}}.
+    """
+    upsert, delete = [], []
+    for addon, others in sims.iteritems():
+        old = current.get(addon, {})
+        for other, score in others:
+            if other not in old or abs(old[other] - score) > 1e-7:
+                upsert.append((addon, other, score))
+        keep = set(other for other, _ in others)
+        delete.extend((addon, other) for other in old if other not in keep)
+    if not upsert and not delete:
+        return
+    cursor = connections['default'].cursor()
+    cursor.execute('BEGIN')
+    if delete:
+        cursor.executemany("""
+            DELETE FROM addon_recommendations
+            WHERE addon_id=%s AND other_addon_id=%s""", delete)
+    if upsert:
+        cursor.executemany("""
+            INSERT INTO addon_recommendations (addon_id, other_addon_id, score)
+            VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE score=VALUES(score)""", upsert)
+    cursor.execute('COMMIT')
+
+
+def _delete_recs(addons):
+    cursor = connections['default'].cursor()
+    for chunk in chunked(addons, 1000):
+        cursor.execute('BEGIN')
+        cursor.execute(
+            'DELETE FROM addon_recommendations WHERE addon_id IN %s',
+            [chunk])
+        cursor.execute('COMMIT')
+
+
 def _group_addons(qs):
     # qs is a list of (addon_id, collection_id) order by addon_id.
     # Return a dict of {addon_id: [collection_id]}.
@@ -462,14 +722,13 @@ def _group_addons(qs):
         if len(cs) > 3:
             # array.array() lets us calculate similarities much faster.
             addons[addon] = array.array('l', cs)
-    # Don't generate recs for frozen add-ons.
-    for addon in FrozenAddon.objects.values_list('addon', flat=True):
-        if addon in addons:
-            recs_log.info('Skipping frozen addon %s.' % addon)
-            del addons[addon]
     return addons
 
 
+def _skip_frozen(addons, frozen):
+    return dict((a, cs) for a, cs in addons.iteritems() if a not in frozen)
+
+
 @cronjobs.register
 @transaction.commit_on_success
 def give_personas_versions():
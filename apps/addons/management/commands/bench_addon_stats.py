@@ -0,0 +1,103 @@
+from optparse import make_option
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+
+from amo.utils import chunked
+from addons import cron, tasks
+from addons.models import Addon
+
+
+def per_row_adu(data):
+    """How _update_addon_average_daily_users() used to do it."""
+    for pk, count in data:
+        try:
+            addon = Addon.objects.get(pk=pk)
+        except Addon.DoesNotExist:
+            continue
+        if (count - addon.total_downloads) > 10000:
+            addon.update(average_daily_users=addon.total_downloads)
+        else:
+            addon.update(average_daily_users=count)
+
+
+def per_row_downloads(data):
+    """How _update_addon_download_totals() used to do it."""
+    for pk, avg, total in data:
+        try:
+            Addon.objects.get(pk=pk).update(average_daily_downloads=avg,
+                                            total_downloads=total)
+        except Addon.DoesNotExist:
+            continue
+
+
+class Command(BaseCommand):
+    """
+    Times the ADU and download total updates for --number add-ons, loading
+    and updating one add-on at a time the way the tasks used to, against
+    _update_addon_stats(). The stats are made up for the first --number
+    add-ons in the db. Each run is rolled back, and the reindex tasks are
+    counted rather than queued, so this is safe on a dev db.
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('--number', action='store', type='int', default=1000,
+                    dest='number', help='Number of add-ons, default: '
+                                        '%default'),
+    )
+
+    def handle(self, *args, **options):
+        number = options['number']
+        ids = list(Addon.uncached.order_by('id')
+                   .values_list('id', flat=True)[:number])
+        if len(ids) < number:
+            print ('Only %s add-ons in the db, the other %s rows are for '
+                   'add-ons that are gone.' % (len(ids), number - len(ids)))
+            start = ids[-1] + 1 if ids else 1
+            ids += range(start, start + number - len(ids))
+        rand = random.Random(number)
+        adu = [(pk, rand.randint(0, 100000)) for pk in ids]
+        downloads = [(pk, rand.randint(0, 1000), rand.randint(0, 1000000))
+                     for pk in ids]
+
+        def bulk_adu(data):
+            for chunk in chunked(data, 1000):
+                cron._update_addon_average_daily_users(chunk)
+
+        def bulk_downloads(data):
+            for chunk in chunked(data, 1000):
+                cron._update_addon_download_totals(chunk)
+
+        for name, old, new, data in (
+                ('ADU', per_row_adu, bulk_adu, adu),
+                ('Download totals', per_row_downloads, bulk_downloads,
+                 downloads)):
+            print '%s for %s add-ons:' % (name, number)
+            self.run('per row', old, data)
+            self.run('_update_addon_stats()', new, data)
+
+    def run(self, name, update, data):
+        queued = []
+        delay = tasks.index_addons.delay
+        tasks.index_addons.delay = lambda ids, **kw: queued.append(ids)
+        for alias in connections:
+            connections[alias].use_debug_cursor = True
+            connections[alias].queries = []
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            start = time.time()
+            update(data)
+            elapsed = time.time() - start
+        finally:
+            transaction.rollback()
+            transaction.leave_transaction_management()
+            tasks.index_addons.delay = delay
+            for alias in connections:
+                connections[alias].use_debug_cursor = None
+        queries = sum(len(connections[alias].queries)
+                      for alias in connections)
+        print '    %s: %.2fs, %.0f rows/s, %s queries, %s index tasks' % (
+            name, elapsed, len(data) / elapsed if elapsed else 0, queries,
+            len(queued))
@@ -28,8 +28,9 @@ import amo.models
 from amo.decorators import use_master
 from amo.fields import DecimalCharField
 from amo.helpers import absolutify, shared_url
-from amo.utils import (cache_ns_key, chunked, JSONEncoder, send_mail, slugify,
-                       sorted_groupby, to_language, urlparams)
+from amo.utils import (cache_ns_key, cache_ns_keys, chunked, JSONEncoder,
+                       send_mail, slugify, sorted_groupby, to_language,
+                       urlparams)
 from amo.urlresolvers import get_outgoing_url, reverse
 from compat.models import CompatReport
 from files.models import File
@@ -599,8 +600,20 @@ class Addon(amo.models.OnChangeMixin, amo.models.ModelBase):
     def compatible_version(self, app_id, app_version=None, platform=None,
                            compat_mode='strict'):
         """Returns the newest compatible version given the input."""
+        return self.compatible_versions([self.id], app_id, app_version,
+                                        platform, compat_mode)[self.id]
+
+    @classmethod
+    def compatible_versions(cls, addon_ids, app_id, app_version=None,
+                            platform=None, compat_mode='strict'):
+        """
+        Returns {addon id: newest compatible version or None} for all of
+        `addon_ids`. The cache is checked with one get_many and everything
+        it doesn't have is found in one query.
+        """
+        addon_ids = sorted(set(addon_ids))
         if not app_id:
-            return None
+            return dict.fromkeys(addon_ids)
 
         if platform:
             # We include platform_id=1 always in the SQL so we skip it here.
@@ -610,39 +623,73 @@ class Addon(amo.models.OnChangeMixin, amo.models.ModelBase):
             else:
                 platform = None
 
-        log.info(u'Checking compatibility for add-on ID:%s, APP:%s, V:%s, '
-                  'OS:%s, Mode:%s' % (self.id, app_id, app_version, platform,
-                                      compat_mode))
-        valid_file_statuses = ','.join(map(str, amo.REVIEWED_STATUSES))
-        data = dict(id=self.id, app_id=app_id, platform=platform,
-                    valid_file_statuses=valid_file_statuses)
-        if app_version:
-            data.update(version_int=version_int(app_version))
-        else:
+        if not app_version:
             # We can't perform the search queries for strict or normal without
             # an app version.
             compat_mode = 'ignore'
 
-        ns_key = cache_ns_key('d2c-versions:%s' % self.id)
-        cache_key = '%s:%s:%s:%s:%s' % (ns_key, app_id, app_version, platform,
-                                        compat_mode)
-        version_id = cache.get(cache_key)
-        if version_id != None:
-            log.info(u'Found compatible version in cache: %s => %s' % (
-                     cache_key, version_id))
-            if version_id == 0:
-                return None
+        log.info(u'Checking compatibility for add-on IDs:%s, APP:%s, V:%s, '
+                  'OS:%s, Mode:%s' % (addon_ids, app_id, app_version,
+                                      platform, compat_mode))
+        ns_keys = cache_ns_keys(['d2c-versions:%s' % id for id in addon_ids])
+        keys = dict((id, '%s:%s:%s:%s:%s' % (ns_key, app_id, app_version,
+                                             platform, compat_mode))
+                    for id, ns_key in zip(addon_ids, ns_keys))
+        cached = cache.get_many(keys.values())
+
+        rv, found, misses = {}, {}, []
+        for id in addon_ids:
+            version_id = cached.get(keys[id])
+            if version_id is None:
+                misses.append(id)
+            elif version_id == 0:
+                rv[id] = None
             else:
-                try:
-                    return Version.objects.get(pk=version_id)
-                except Version.DoesNotExist:
-                    pass
+                found[id] = version_id
+        if found:
+            log.info(u'Found compatible versions in cache: %s' % found)
+            versions = dict((v.id, v) for v in
+                            Version.objects.filter(pk__in=found.values()))
+            for id, version_id in found.items():
+                if version_id in versions:
+                    rv[id] = versions[version_id]
+                else:
+                    misses.append(id)
+
+        if misses:
+            sql = cls._compatible_versions_sql(misses, app_id, app_version,
+                                               platform, compat_mode)
+            versions = dict((v.addon_id, v) for v in Version.objects.raw(sql))
+            to_cache = {}
+            for id in misses:
+                rv[id] = versions.get(id)
+                to_cache[keys[id]] = rv[id].id if rv[id] else 0
+            log.info(u'Caching compat versions %s' % to_cache)
+            cache.set_many(to_cache, 0)
+
+        return rv
 
+    @staticmethod
+    def _compatible_versions_sql(addon_ids, app_id, app_version, platform,
+                                 compat_mode):
+        """The newest compatible version of each of `addon_ids`."""
+        valid_file_statuses = ','.join(map(str, amo.REVIEWED_STATUSES))
+        data = dict(ids=','.join(map(str, map(int, addon_ids))),
+                    app_id=app_id, platform=platform,
+                    valid_file_statuses=valid_file_statuses)
+        if app_version:
+            data.update(version_int=version_int(app_version))
+
+        # The highest compatible version id per add-on, joined back onto
+        # versions so we get the whole row in the same query.
         raw_sql = ["""
             SELECT versions.*
             FROM versions
+            INNER JOIN (
+            SELECT MAX(versions.id) AS id
+            FROM versions
             INNER JOIN addons
-                ON addons.id = versions.addon_id AND addons.id = %(id)s
+                ON addons.id = versions.addon_id AND addons.id IN (%(ids)s)
             INNER JOIN applications_versions
                 ON applications_versions.version_id = versions.id
             INNER JOIN applications
@@ -696,20 +743,10 @@ class Addon(amo.models.OnChangeMixin, amo.models.ModelBase):
         else:  # Not defined or 'strict'.
             raw_sql.append('AND appmax.version_int >= %(version_int)s ')
 
-        raw_sql.append('ORDER BY versions.id DESC LIMIT 1;')
-
-        version = Version.objects.raw(''.join(raw_sql) % data)
-        if version:
-            version = version[0]
-            version_id = version.id
-        else:
-            version = None
-            version_id = 0
-
-        log.info(u'Caching compat version %s => %s' % (cache_key, version_id))
-        cache.set(cache_key, version_id, 0)
+        raw_sql.append("""GROUP BY versions.addon_id
+            ) AS compatible ON compatible.id = versions.id;""")
 
-        return version
+        return ''.join(raw_sql) % data
 
     def invalidate_d2c_versions(self):
         """Invalidates the cache of compatible versions.
@@ -1424,6 +1461,16 @@ def watch_disabled(old_attr={}, new_attr={}, instance=None, sender=None, **kw):
             f.hide_disabled_file()
 
 
+@Addon.on_change
+def watch_update_fields(old_attr={}, new_attr={}, instance=None, sender=None,
+                        **kw):
+    """The update service caches its responses in the d2c-versions namespace,
+    these change what it sends out."""
+    fields = ('status', 'disabled_by_user', 'premium_type')
+    if any(old_attr.get(f) != new_attr.get(f) for f in fields):
+        instance.invalidate_d2c_versions()
+
+
 class Persona(caching.CachingMixin, models.Model):
     """Personas-specific additions to the add-on model."""
     addon = models.OneToOneField(Addon)
@@ -2026,6 +2073,19 @@ models.signals.post_delete.connect(update_incompatible_versions,
                                    dispatch_uid='cor_update_incompatible')
 
 
+def invalidate_guid_search(sender, instance, **kw):
+    """The api's guid search caches the overrides it shows for a guid."""
+    if sender is CompatOverrideRange:
+        instance = instance.compat
+    cache_ns_key('guid_search:%s' % instance.guid, increment=True)
+
+
+for sender in (CompatOverride, CompatOverrideRange):
+    for signal in (models.signals.post_save, models.signals.post_delete):
+        signal.connect(invalidate_guid_search, sender=sender,
+                       dispatch_uid='guid_search_%s' % sender.__name__)
+
+
 # webapps.models imports addons.models to get Addon, so we need to keep the
 # Webapp import down here.
 from mkt.webapps.models import Webapp
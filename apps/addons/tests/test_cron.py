@@ -1,13 +1,18 @@
 import os.path
+from datetime import date, timedelta
+
+from nose import SkipTest
 from nose.tools import eq_
 import mock
 
 import amo
 import amo.tests
 from addons import cron
-from addons.models import Addon, AppSupport
+from lib.recommend import sparse
+from addons.models import Addon, AppSupport, FrozenAddon
 from addons.utils import ReverseNameLookup
 from files.models import File, Platform
+from stats.models import UpdateCount
 from versions.models import Version
 
 
@@ -221,6 +226,123 @@ class AvgDailyUserCountTestCase(amo.tests.TestCase):
         addon = Addon.objects.get(pk=3615)
         eq_(addon.average_daily_users, addon.total_downloads)
 
+    def test_adu_is_updated_in_cron(self):
+        cron._update_addon_average_daily_users([(3615, 50), (9999, 10)])
+        eq_(Addon.objects.get(pk=3615).average_daily_users, 50)
+
+    def test_adu_unchanged(self):
+        addon = Addon.objects.get(pk=3615)
+        with mock.patch.object(Addon.objects, 'invalidate') as invalidate:
+            cron._update_addon_average_daily_users(
+                [(3615, addon.total_downloads)])
+            cron._update_addon_average_daily_users(
+                [(3615, addon.total_downloads)])
+        eq_(invalidate.call_count, 1)
+
+    @mock.patch('addons.tasks.index_addons')
+    def test_adu_reindexed(self, index_addons):
+        cron._update_addon_average_daily_users([(3615, 50), (9999, 10)])
+        index_addons.delay.assert_called_with([3615])
+        index_addons.reset_mock()
+        cron._update_addon_average_daily_users([(3615, 50)])
+        assert not index_addons.delay.called
+
+    def test_download_totals(self):
+        cron._update_addon_download_totals([(3615, 12, 3456), (9999, 1, 2)])
+        addon = Addon.objects.get(pk=3615)
+        eq_(addon.average_daily_downloads, 12)
+        eq_(addon.total_downloads, 3456)
+
+
+class TestHotness(amo.tests.TestCase):
+    fixtures = ['base/addon_3615']
+
+    def setUp(self):
+        today = date.today()
+        for days, count in ((1, 3000), (2, 3000), (10, 1000), (20, 1000)):
+            UpdateCount.objects.create(addon_id=3615, count=count,
+                                       date=today - timedelta(days=days))
+
+    @mock.patch.object(cron.settings, 'HOTNESS_THROTTLE', 0)
+    def test_hotness(self):
+        cron.deliver_hotness()
+        eq_(Addon.objects.no_cache().get(pk=3615).hotness, 2.0)
+
+    @mock.patch.object(cron.settings, 'HOTNESS_THROTTLE', 0)
+    def test_unchanged(self):
+        Addon.objects.filter(pk=3615).update(hotness=2.0)
+        with mock.patch.object(Addon.objects, 'invalidate') as invalidate:
+            cron.deliver_hotness()
+        assert not invalidate.called
+
+    @mock.patch.object(cron.settings, 'HOTNESS_THROTTLE', 0)
+    @mock.patch('addons.tasks.index_addons')
+    def test_reindexed(self, index_addons):
+        cron.deliver_hotness()
+        index_addons.delay.assert_called_with([3615])
+
+    @mock.patch.object(cron.settings, 'HOTNESS_THROTTLE', 0)
+    def test_frozen(self):
+        FrozenAddon.objects.create(addon_id=3615)
+        Addon.objects.filter(pk=3615).update(hotness=5.0)
+        cron.deliver_hotness()
+        eq_(Addon.objects.no_cache().get(pk=3615).hotness, 0)
+
+    def test_numpy_matches(self):
+        if cron.numpy is None:
+            raise SkipTest
+        # Below, at and above both thresholds, and floats as the db gives.
+        for this, three in (([0, 1001, 5000, 1500], [0, 1000, 1, 2]),
+                            ([1000, 1000.5, 2000, 1e6], [2, 1.5, 1, 3e5]),
+                            ([], [])):
+            hotness = cron._hotness(this, three)
+            with mock.patch.object(cron, 'numpy', None):
+                eq_(cron._hotness(this, three), hotness)
+
+
+class TestIncrementalRecs(amo.tests.TestCase):
+
+    def setUp(self):
+        self.old = {1: [1, 2, 3, 4], 2: [1, 2, 3, 5], 3: [6, 7, 8, 9],
+                    4: [10, 11, 12, 13]}
+        self.current = {1: {2: 1 / 3., 3: 1 / 9.}, 2: {1: 1 / 3., 3: 1 / 9.},
+                        3: {1: 1 / 9., 2: 1 / 9.}, 4: {1: 1 / 9., 2: 1 / 9.}}
+
+    def affected(self, new):
+        matrix = sparse.Incidence(new)
+        with mock.patch.object(cron, 'RECS_PER_ADDON', 2):
+            return cron._affected_addons(matrix, self.old, new,
+                                         self.current)
+
+    def test_nothing_changed(self):
+        eq_(self.affected(dict(self.old)), set())
+
+    def test_changed(self):
+        new = dict(self.old)
+        new[3] = [1, 2, 3, 4, 9, 14]
+        # 1 and 2 recommend 3 already, 4 is still closer to the others.
+        eq_(self.affected(new), set([1, 2, 3]))
+
+    def test_gone(self):
+        new = dict(self.old)
+        del new[2]
+        eq_(self.affected(new), set([1, 3, 4]))
+
+    @mock.patch('addons.cron.connections')
+    def test_update_recs(self, connections):
+        cursor = connections.__getitem__.return_value.cursor.return_value
+        cron._update_recs({1: [(2, 1 / 3.), (4, 1 / 9.)],
+                           2: [(1, 1 / 3.), (3, 1 / 9.)]}, self.current)
+        calls = dict((c[0][0].split()[0], c[0][1])
+                     for c in cursor.executemany.call_args_list)
+        eq_(calls['DELETE'], [(1, 3)])
+        eq_(calls['INSERT'], [(1, 4, 1 / 9.)])
+
+    @mock.patch('addons.cron.connections')
+    def test_update_recs_unchanged(self, connections):
+        cron._update_recs({2: [(1, 1 / 3.), (3, 1 / 9.)]}, self.current)
+        assert not connections.__getitem__.called
+
 
 class TestReindex(amo.tests.ESTestCase):
 
@@ -1761,6 +1761,26 @@ class TestAddonWatchDisabled(amo.tests.TestCase):
         assert not mock.hide_disabled_file.called
 
 
+class TestAddonWatchUpdateFields(amo.tests.TestCase):
+
+    def setUp(self):
+        self.addon = Addon.objects.create(type=amo.ADDON_EXTENSION,
+                                          status=amo.STATUS_PUBLIC)
+
+    @patch('addons.models.Addon.invalidate_d2c_versions')
+    def test_no_change(self, inv_mock):
+        self.addon.update(hotness=1)
+        assert not inv_mock.called
+
+    @patch('addons.models.Addon.invalidate_d2c_versions')
+    def test_fields(self, inv_mock):
+        for kw in [{'status': amo.STATUS_LITE}, {'disabled_by_user': True},
+                   {'premium_type': amo.ADDON_PREMIUM}]:
+            inv_mock.reset_mock()
+            self.addon.update(**kw)
+            assert inv_mock.called, kw
+
+
 class TestSearchSignals(amo.tests.ESTestCase):
     es = True
 
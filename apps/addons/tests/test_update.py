@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime, timedelta
 from email import utils
+import json
 import urllib
 import urlparse
 
 from django.db import connection
 from django.utils.encoding import smart_str
 
+from mock import Mock, patch
 from nose.tools import eq_
 
 import amo
@@ -16,6 +18,9 @@ from addons.models import (Addon, CompatOverride, CompatOverrideRange,
 from applications.models import Application, AppVersion
 from files.models import File
 from services import update
+from services.update_cache import UpdateCache
+from services.update_index import UpdateIndex
+from services.utils import get_pool, pools
 import settings_local
 from versions.models import ApplicationsVersions, Version
 
@@ -563,6 +568,149 @@ class TestDefaultToCompat(amo.tests.TestCase):
         self.check(self.expected)
 
 
+class TestDefaultToCompatIndex(TestDefaultToCompat):
+    """
+    The same combinations, answered from the update index instead of the db.
+    """
+
+    def get(self, **kw):
+        index = UpdateIndex()
+        index.refresh(connection.cursor())
+        up = update.Update({
+            'reqVersion': 1,
+            'id': self.addon.guid,
+            'version': kw.get('item_version', '1.0'),
+            'appID': self.app.guid,
+            'appVersion': kw.get('app_version', '3.0'),
+        }, compat_mode=kw.get('compat_mode', 'strict'), index=index)
+        assert up.is_valid()
+        assert up.use_index
+        up.get_update()
+        eq_(up.cursor, None)
+        return up.data['row'].get('version_id')
+
+
+class TestDefaultToCompatBatch(TestDefaultToCompat):
+    """
+    The same combinations, answered by a batch update check.
+    """
+
+    def get(self, **kw):
+        up = update.BatchUpdate({
+            'reqVersion': 1,
+            'appID': self.app.guid,
+            'appVersion': kw.get('app_version', '3.0'),
+        }, [(self.addon.guid, kw.get('item_version', '1.0'))],
+           compat_mode=kw.get('compat_mode', 'strict'))
+        up.cursor = connection.cursor()
+        assert up.is_valid()
+        items = up.get_updates()
+        eq_(len(items), 1)
+        return items[0].data['row'].get('version_id')
+
+
+class TestUpdateIndex(amo.tests.TestCase):
+    fixtures = ['addons/update',
+                'base/platforms']
+
+    def setUp(self):
+        self.addon = Addon.objects.get(id=1865)
+        self.app = Application.objects.get(id=1)
+        self.index = UpdateIndex()
+        self.index.refresh(connection.cursor())
+        self.data = {
+            'id': self.addon.guid,
+            'version': '1.0',
+            'appID': self.app.guid,
+            'appVersion': '3.0.12',
+            'reqVersion': 1,
+        }
+
+    def get(self, data, index=None):
+        up = update.Update(data, index=index)
+        up.cursor = connection.cursor()
+        assert up.is_valid()
+        up.get_update()
+        return up
+
+    def test_same_as_sql(self):
+        for app_version in ['2.0', '3.0a1', '3.0.12', '3.6', '3.7a5pre']:
+            for os in ['', amo.PLATFORM_LINUX.api_name]:
+                data = dict(self.data, appVersion=app_version, appOS=os)
+                eq_(self.get(data, self.index).data['row'].get('version_id'),
+                    self.get(data).data['row'].get('version_id'))
+
+    def test_use_index(self):
+        up = self.get(self.data, self.index)
+        assert up.use_index
+        eq_(up.data['row']['url'], self.get(self.data).data['row']['url'])
+
+    def test_fallback(self):
+        # Add-ons the index doesn't know about go to the db.
+        self.index.clear()
+        up = self.get(self.data, self.index)
+        assert not up.use_index
+        assert up.data['row']['version_id']
+
+    def test_incremental(self):
+        version_id = self.get(self.data, self.index).data['row']['version_id']
+        File.objects.filter(version=version_id).update(
+            status=amo.STATUS_DISABLED)
+        self.index.load(connection.cursor(), [self.addon.id])
+        row = self.get(self.data, self.index).data['row']
+        assert row.get('version_id') != version_id
+
+    def test_compat_changed(self):
+        data = dict(self.data, appVersion='5.0')
+        eq_(self.get(data, self.index).data['row'].get('version_id'), None)
+        # Bump the max of the latest version, the way the admin tools do.
+        av = ApplicationsVersions.objects.get(version=115509,
+                                              application=self.app)
+        av.max = AppVersion.objects.get(application=self.app, version='5.0')
+        av.save()
+        self.index.refresh(connection.cursor(), now=self.index.built + 1)
+        eq_(self.get(data, self.index).data['row'].get('version_id'), 115509)
+        eq_(self.get(data).data['row'].get('version_id'), 115509)
+
+    def test_removed(self):
+        self.addon.update(disabled_by_user=True)
+        self.index.load(connection.cursor(), [self.addon.id])
+        assert self.addon.guid not in self.index
+        eq_(self.index.keys.get(self.addon.id), None)
+
+    def test_check(self):
+        self.index.check = 1
+        up = self.get(self.data, self.index)
+        assert up.use_index
+        eq_(up.data['row']['version_id'],
+            self.get(self.data).data['row']['version_id'])
+
+
+@patch.dict(pools, clear=True)
+class TestPools(amo.tests.TestCase):
+
+    @patch.object(settings_local, 'SERVICES_DATABASE_POOLS',
+                  {'update': {'SIZE': 2}})
+    def test_size(self):
+        eq_(get_pool('update').pool.size(), 2)
+        eq_(get_pool('verify').pool.size(),
+            settings_local.SERVICES_DATABASE_POOL['SIZE'])
+
+    def test_shared(self):
+        assert get_pool('update') is get_pool('update')
+        assert get_pool('update') is not get_pool('verify')
+
+    def test_no_slave(self):
+        eq_(get_pool('update', readonly=True).name, 'update')
+
+    @patch.object(settings_local, 'SERVICES_DATABASE_SLAVE',
+                  {'NAME': 'zamboni', 'USER': '', 'PASSWORD': '',
+                   'HOST': 'slave'})
+    def test_slave(self):
+        eq_(get_pool('update', readonly=True).name, 'update.slave')
+        eq_(get_pool('update').name, 'update')
+
+
 class TestResponse(amo.tests.TestCase):
     fixtures = ['base/addon_3615',
                 'base/platforms',
@@ -815,3 +963,167 @@ class TestResponse(amo.tests.TestCase):
         data['appVersion'] = '5.0.1'
         upd = self.get(data)
         eq_(upd.get_rdf(), upd.get_no_updates_rdf())
+
+
+class TestUpdateCache(amo.tests.TestCase):
+    fixtures = ['base/addon_3615',
+                'base/platforms',
+                'base/seamonkey']
+
+    def setUp(self):
+        self.addon = Addon.objects.get(pk=3615)
+        self.cache = UpdateCache()
+        self.good_data = {
+            'id': '{2fa4ed95-0317-4c6a-a74c-5f3e3912c1f9}',
+            'version': '2.0.58',
+            'reqVersion': 1,
+            'appID': '{ec8030f7-c20a-464f-9b0e-13a3a9e97384}',
+            'appVersion': '3.7a1pre',
+        }
+        # Get past the mirror delay.
+        File.objects.filter(version__addon=self.addon).update(
+            datestatuschanged=datetime.now() - timedelta(days=1))
+
+    def get(self, data):
+        up = update.Update(data, rdf_cache=self.cache)
+        up.cursor = connection.cursor()
+        return up
+
+    def test_cached(self):
+        rdf = self.get(self.good_data).get_rdf()
+        up = self.get(self.good_data)
+        eq_(up.get_rdf(), rdf)
+        # Served from the cache, we never got as far as the db.
+        eq_(up.data['row'], {})
+
+    def test_memcached(self):
+        rdf = self.get(self.good_data).get_rdf()
+        self.cache.local.clear()
+        up = self.get(self.good_data)
+        eq_(up.get_rdf(), rdf)
+        eq_(up.data['row'], {})
+
+    def test_invalidated(self):
+        self.get(self.good_data).get_rdf()
+        self.addon.invalidate_d2c_versions()
+        up = self.get(self.good_data)
+        up.get_rdf()
+        assert up.data['row']
+
+    def test_different_request(self):
+        self.get(self.good_data).get_rdf()
+        up = self.get(dict(self.good_data, appVersion='2.0'))
+        up.get_rdf()
+        assert up.data['row']
+
+    def test_watermarked_request(self):
+        data = dict(self.good_data)
+        data[amo.WATERMARK_KEY] = 'foo@bar.com'
+        self.get(data).get_rdf()
+        eq_(len(self.cache.local), 0)
+
+    def test_premium(self):
+        self.addon.update(premium_type=amo.ADDON_PREMIUM)
+        self.get(self.good_data).get_rdf()
+        up = self.get(self.good_data)
+        up.get_rdf()
+        assert up.data['row']
+
+    def test_recent_file(self):
+        File.objects.filter(version__addon=self.addon).update(
+            datestatuschanged=datetime.now())
+        self.get(self.good_data).get_rdf()
+        up = self.get(self.good_data)
+        up.get_rdf()
+        assert up.data['row']
+
+    def test_bad_rdf(self):
+        data = dict(self.good_data, id='nope')
+        up = self.get(data)
+        eq_(up.get_rdf(), up.get_bad_rdf())
+        eq_(len(self.cache.local), 0)
+
+
+class TestBatchUpdate(amo.tests.TestCase):
+    fixtures = ['base/addon_3615',
+                'base/platforms',
+                'base/seamonkey']
+
+    def setUp(self):
+        self.data = {
+            'reqVersion': 1,
+            'appID': '{ec8030f7-c20a-464f-9b0e-13a3a9e97384}',
+            'appVersion': '3.7a1pre',
+        }
+        self.items = [('{2fa4ed95-0317-4c6a-a74c-5f3e3912c1f9}', '2.0.58'),
+                      ('bettergmail2@ginatrapani.org', '1'),
+                      ('nope', '1.0')]
+
+    def get(self, data=None, items=None, **kw):
+        up = update.BatchUpdate(data or self.data, items or self.items, **kw)
+        up.cursor = connection.cursor()
+        return up
+
+    def single(self, guid, version):
+        up = update.Update(dict(self.data, id=guid, version=version))
+        up.cursor = connection.cursor()
+        return up
+
+    def test_same_as_single(self):
+        up = self.get()
+        assert up.is_valid()
+        items = up.get_updates()
+        eq_(len(items), 2)
+        for item, (guid, version) in zip(items, self.items):
+            single = self.single(guid, version)
+            single.get_rdf()
+            eq_(item.data['row'].get('version_id'),
+                single.data['row'].get('version_id'))
+
+    def test_queries(self):
+        # The number of queries doesn't depend on the number of add-ons.
+        up = self.get()
+        up.cursor = mock_cursor = Mock(wraps=connection.cursor())
+        assert up.is_valid()
+        up.get_updates()
+        eq_(mock_cursor.execute.call_count, 2)
+
+    def test_rdf(self):
+        rdf = self.get().get_rdf()
+        eq_(rdf.count('<em:updates>'), 2)
+        assert rdf.find('bettergmail2@ginatrapani.org') > -1
+        assert rdf.find('nope') == -1
+        assert rdf.startswith(update.rdf_start)
+
+    def test_no_updates(self):
+        data = dict(self.data, appVersion='1.4')
+        rdf = self.get(data).get_rdf()
+        eq_(rdf.count('<em:updates>'), 2)
+        eq_(rdf.find('em:updateLink'), -1)
+
+    def test_json(self):
+        up = self.get(format='json')
+        result = json.loads(up.get_output())['addons']
+        eq_(sorted(result.keys()), ['bettergmail2@ginatrapani.org',
+                                    '{2fa4ed95-0317-4c6a-a74c-5f3e3912c1f9}'])
+        updates = result['{2fa4ed95-0317-4c6a-a74c-5f3e3912c1f9}']['updates']
+        eq_(len(updates), 1)
+        assert updates[0]['update_hash'].startswith('sha256:')
+        eq_(dict(up.get_headers(1))['Content-Type'], 'application/json')
+
+    def test_duplicates(self):
+        up = self.get(items=self.items + [self.items[0]])
+        assert up.is_valid()
+        eq_(len(up.get_updates()), 2)
+
+    @patch.object(settings_local, 'SERVICES_UPDATE_BATCH_SIZE', 2)
+    def test_too_many(self):
+        up = self.get()
+        eq_(up.get_rdf(), up.get_bad_rdf())
+
+    def test_no_app(self):
+        data = dict(self.data)
+        del data['appID']
+        up = self.get(data)
+        eq_(up.get_rdf(), up.get_bad_rdf())
+
@@ -2,7 +2,9 @@ import amo
 import amo.tests
 from services.pfs import get_output
 
-from  pyquery import PyQuery as pq
+from lxml import etree
+from nose.tools import eq_
+from pyquery import PyQuery as pq
 
 
 class TestPfs(amo.tests.TestCase):
@@ -14,3 +16,59 @@ class TestPfs(amo.tests.TestCase):
                   'licenseURL', 'needsRestart']:
             res = get_output({k: 'fooo<script>alert("foo")</script>;'})
             assert not pq(res)('script')
+
+    def get(self, **kw):
+        data = {'mimetype': 'application/x-shockwave-flash',
+                'appID': '{ec8030f7-c20a-464f-9b0e-13a3a9e97384}',
+                'appVersion': '20120215', 'clientOS': 'Windows NT 5.1',
+                'chromeLocale': 'en-US'}
+        data.update(kw)
+        return self.parse(get_output(data))
+
+    def parse(self, output):
+        """The pfs fields of the plugin in `output`, by name."""
+        ns = '{http://www.mozilla.org/2004/pfs-rdf#}'
+        return dict((el.tag[len(ns):], el.text or '')
+                    for el in etree.fromstring(output).iter()
+                    if el.tag.startswith(ns))
+
+    def test_flash(self):
+        doc = self.get()
+        eq_(doc['name'], 'Adobe Flash Player')
+        eq_(doc['version'], '11.3.300.262')
+
+    def test_flash_mac(self):
+        doc = self.get(clientOS='Intel Mac OS X 10.7')
+        eq_(doc['name'], 'Adobe Flash Player')
+        eq_(doc['guid'], '-1')
+
+    def test_java_vista(self):
+        doc = self.get(mimetype='application/x-java-applet;version=1.4.2',
+                       clientOS='Windows NT 6.0')
+        eq_(doc['guid'], '{fbe640ef-4375-4f45-8d79-767d60bf75b8}')
+        eq_(doc['XPILocation'], '')
+
+    def test_java_windows(self):
+        doc = self.get(mimetype='application/x-java-vm')
+        eq_(doc['XPILocation'], 'http://java.com/jre-install.xpi')
+
+    def test_shockwave_locale(self):
+        doc = self.get(mimetype='application/x-director')
+        eq_(doc['licenseURL'],
+            'http://www.adobe.com/go/eula_shockwaveplayer')
+        doc = self.get(mimetype='application/x-director', chromeLocale='ja-JP')
+        eq_(doc['licenseURL'],
+            'http://www.adobe.com/go/eula_shockwaveplayer_jp')
+
+    def test_no_plugin(self):
+        doc = self.get(mimetype='video/divx', clientOS='Linux i686')
+        eq_(doc['name'], '-1')
+        eq_(doc['requestedMimetype'], 'video/divx')
+
+    def test_missing_param(self):
+        doc = self.parse(get_output({'mimetype':
+                                       'application/x-shockwave-flash'}))
+        eq_(doc['name'], '-1')
+
+    def test_no_mimetype(self):
+        eq_(self.parse(get_output({}))['requestedMimetype'], '-1')
@@ -622,6 +622,21 @@ def cache_ns_key(namespace, increment=False):
     return '%s:%s' % (ns_val, ns_key)
 
 
+def cache_ns_keys(namespaces):
+    """
+    cache_ns_key() for a bunch of `namespaces` at once, in one get_many and
+    at most one set_many. Returns the keys in the same order.
+    """
+    ns_keys = ['ns:%s' % namespace for namespace in namespaces]
+    ns_vals = cache.get_many(ns_keys)
+    missing = dict((ns_key, epoch(datetime.datetime.now()))
+                   for ns_key in ns_keys if ns_vals.get(ns_key) is None)
+    if missing:
+        cache.set_many(missing, 0)
+        ns_vals.update(missing)
+    return ['%s:%s' % (ns_vals[ns_key], ns_key) for ns_key in ns_keys]
+
+
 class Message:
     """
     A simple message class for when you don't have a session, but wish
@@ -833,6 +833,32 @@ class TestGuidSearch(TestCase):
         # indicate that we are searching for null guid.
         eq_(len(doc('addon')), 0)
 
+    def test_cached(self):
+        make_call(self.good)
+        with self.assertNumQueries(0):
+            r = make_call(self.good)
+        eq_(set(['3615', '6113']),
+            set([a.attrib['id'] for a in pq(r.content)('addon')]))
+        eq_(len(pq(r.content)('addon_compatibility')), 1)
+
+    def test_repeated_guids(self):
+        r = make_call(self.good + ',{22870005-adef-4c9d-ae36-d0e1f2f27e5a}')
+        dom = pq(r.content)
+        eq_(['6113', '3615'], [a.attrib['id'] for a in dom('addon')])
+        eq_(dom('searchresults').attr('total_results'), '2')
+
+    def test_compat_changed(self):
+        make_call(self.good)
+        CompatOverride.objects.get().delete()
+        r = make_call(self.good)
+        eq_(len(pq(r.content)('addon_compatibility')), 0)
+
+        c = CompatOverride.objects.create(guid=Addon.objects.get(id=6113).guid)
+        CompatOverrideRange.objects.create(compat=c, app_id=amo.FIREFOX.id)
+        r = make_call(self.good)
+        eq_(['6113'],
+            [a.attrib['id'] for a in pq(r.content)('addon_compatibility')])
+
     def test_addon_compatibility(self):
         addon = Addon.objects.get(id=3615)
         r = make_call('search/guid:%s' % addon.guid)
@@ -1184,6 +1210,40 @@ class SearchTest(ESTestCase):
         with self.assertNumQueries(0):
             addon.compatible_version(amo.FIREFOX.id, '4.0', 'all', 'strict')
 
+    def test_compatible_versions(self):
+        ids = [a.id for a in self.addons]
+        for mode in ('strict', 'normal', 'ignore'):
+            versions = Addon.compatible_versions(ids, amo.FIREFOX.id, '3.6',
+                                                 'all', mode)
+            eq_(sorted(versions), sorted(ids))
+            for addon in self.addons:
+                eq_(versions[addon.id],
+                    addon.compatible_version(amo.FIREFOX.id, '3.6', 'all',
+                                             mode))
+
+    def test_compatible_versions_cache(self):
+        ids = [a.id for a in self.addons]
+        # One query finds all of them, and another fetches the versions
+        # once they're cached.
+        with self.assertNumQueries(1):
+            versions = Addon.compatible_versions(ids, amo.FIREFOX.id, '3.6',
+                                                 'all', 'normal')
+        assert any(versions.values())
+        with self.assertNumQueries(1):
+            eq_(Addon.compatible_versions(ids, amo.FIREFOX.id, '3.6', 'all',
+                                          'normal'), versions)
+
+    def test_compatible_versions_invalidated(self):
+        # Delicious isn't compatible with Firefox 5 in strict mode, and we
+        # cache that.
+        eq_(Addon.compatible_versions([3615], amo.FIREFOX.id, '5.0'),
+            {3615: None})
+        with self.assertNumQueries(0):
+            Addon.compatible_versions([3615], amo.FIREFOX.id, '5.0')
+        Addon.objects.get(pk=3615).invalidate_d2c_versions()
+        with self.assertNumQueries(1):
+            Addon.compatible_versions([3615], amo.FIREFOX.id, '5.0')
+
 
 class LanguagePacks(UploadTest):
     fixtures = ['addons/listed', 'base/apps', 'base/platforms']
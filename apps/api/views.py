@@ -28,7 +28,7 @@ from addons.models import Addon, CompatOverride
 from amo.decorators import post_required
 from amo.models import manual_order
 from amo.urlresolvers import get_url_prefix
-from amo.utils import JSONEncoder
+from amo.utils import cache_ns_keys, chunked, JSONEncoder
 from api.authentication import AMOOAuthAuthentication
 from api.forms import PerformanceForm
 from api.utils import addon_to_dict, extract_filters
@@ -151,6 +151,13 @@ def addon_filter(addons, addon_type, limit, app, platform, version,
                                                     <= app.max.version_int)
         f_ignore = lambda app: app.min.version_int <= vint
         xs = [(a, a.compatible_apps) for a in addons]
+        if compat_mode == 'normal':
+            # This handles the cases for strict opt-in, binary components,
+            # and compat overrides. It's cached, and one lookup for all of
+            # the add-ons.
+            versions = Addon.compatible_versions([a.id for a in addons],
+                                                 APP.id, version, platform,
+                                                 compat_mode)
 
         # Iterate over addons, checking compatibility depending on compat_mode.
         addons = []
@@ -163,11 +170,7 @@ def addon_filter(addons, addon_type, limit, app, platform, version,
                 if app and f_ignore(app):
                     addons.append(addon)
             elif compat_mode == 'normal':
-                # This does a db hit but it's cached. This handles the cases
-                # for strict opt-in, binary components, and compat overrides.
-                v = addon.compatible_version(APP.id, version, platform,
-                                             compat_mode)
-                if v:  # There's a compatible version.
+                if versions[addon.id]:  # There's a compatible version.
                     addons.append(addon)
 
     # Put personas back in.
@@ -258,48 +261,77 @@ class AddonDetailView(APIView):
         return self.render('api/addon_detail.xml', {'addon': addon})
 
 
-def guid_search(request, api_version, guids):
-    lang = request.LANG
-
-    def guid_search_cache_key(guid):
-        key = 'guid_search:%s:%s:%s' % (api_version, lang, guid)
-        return hashlib.md5(smart_str(key)).hexdigest()
+def render_xml_fragments(request, template, contexts):
+    """
+    render_xml_to_string() for a bunch of `contexts`, loading the template
+    and running the context processors once for all of them.
+    """
+    if not jingo._helpers_loaded:
+        jingo.load_helpers()
 
-    guids = [g.strip() for g in guids.split(',')] if guids else []
+    base = {}
+    for processor in get_standard_processors():
+        base.update(processor(request))
 
-    addons_xml = cache.get_many([guid_search_cache_key(g) for g in guids])
-    dirty_keys = set()
+    template = xml_env.get_template(template)
+    return [template.render(**dict(base, **context)) for context in contexts]
 
-    for g in guids:
-        key = guid_search_cache_key(g)
-        if key not in addons_xml:
-            dirty_keys.add(key)
-            try:
-                addon = Addon.objects.get(guid=g, disabled_by_user=False,
-                                          status__in=SEARCHABLE_STATUSES)
 
-            except Addon.DoesNotExist:
-                addons_xml[key] = ''
+def guid_search_xml(request, api_version, guids):
+    """
+    Returns {guid: (addon xml, compat override xml)} for `guids`. All the
+    add-ons come from one query, so the transformer and translations run
+    once for the whole lot, and so do the overrides.
+    """
+    addons = Addon.objects.filter(guid__in=guids, disabled_by_user=False,
+                                  status__in=SEARCHABLE_STATUSES)
+    addons = dict((a.guid, a) for a in addons)
+    compat = (CompatOverride.objects.filter(guid__in=guids)
+              .transform(CompatOverride.transformer))
+    compat = dict((c.guid, c) for c in compat)
 
-            else:
-                addon_xml = render_xml_to_string(request,
-                                                 'api/includes/addon.xml',
-                                                 {'addon': addon,
-                                                  'api_version': api_version,
-                                                  'api': api})
-                addons_xml[key] = addon_xml
+    addons_xml = render_xml_fragments(
+        request, 'api/includes/addon.xml',
+        [{'addon': addons[g], 'api_version': api_version, 'api': api}
+         for g in guids if g in addons])
+    compat_xml = render_xml_fragments(
+        request, 'api/compat.xml',
+        [{'compat': [compat[g]]} for g in guids if g in compat])
 
-    cache.set_many(dict((k, v) for k, v in addons_xml.iteritems()
-                                                    if k in dirty_keys))
+    addons_xml, compat_xml = iter(addons_xml), iter(compat_xml)
+    return dict((g, (addons_xml.next() if g in addons else '',
+                     compat_xml.next() if g in compat else ''))
+                for g in guids)
 
-    compat = (CompatOverride.objects.filter(guid__in=guids)
-              .transform(CompatOverride.transformer))
 
-    addons_xml = [v for v in addons_xml.values() if v]
+def guid_search(request, api_version, guids):
+    lang = request.LANG
+    guids = [g.strip() for g in guids.split(',')] if guids else []
+    # Each guid once, in the order they were asked for.
+    seen = set()
+    guids = [g for g in guids if not (g in seen or seen.add(g))]
+
+    # The namespace is bumped when a compat override for the guid changes.
+    ns_keys = cache_ns_keys(['guid_search:%s' % g for g in guids])
+    keys = {}
+    for g, ns_key in zip(guids, ns_keys):
+        key = '%s:%s:%s:%s' % (ns_key, api_version, lang, g)
+        keys[g] = hashlib.md5(smart_str(key)).hexdigest()
+
+    found = cache.get_many(keys.values())
+    missed = [g for g in guids if keys[g] not in found]
+    if missed:
+        fresh = guid_search_xml(request, api_version, missed)
+        fresh = dict((keys[g], xml) for g, xml in fresh.items())
+        cache.set_many(fresh)
+        found.update(fresh)
+
+    results = [found[keys[g]] for g in guids]
+    addons_xml = [addon_xml for addon_xml, _ in results if addon_xml]
     return render_xml(request, 'api/search.xml',
                       {'addons_xml': addons_xml,
                        'total': len(addons_xml),
-                       'compat': compat,
+                       'compat_xml': [xml for _, xml in results if xml],
                        'api_version': api_version, 'api': api})
 
 
@@ -353,19 +385,24 @@ class SearchView(APIView):
         if waffle.switch_is_active('d2c-api-search'):
             is_d2c = True
             results = []
-            for addon in qs:
-                compat_version = addon.compatible_version(app_id, version,
-                                                          platform,
-                                                          compat_mode)
-                if compat_version:
-                    addon.compat_version = compat_version
-                    results.append(addon)
-                    if len(results) == limit:
-                        break
-                else:
-                    # We're excluding this addon because there are no
-                    # compatible versions. Decrement the total.
-                    total -= 1
+            # Look up the compatible versions a page of hits at a time.
+            for hits in chunked(qs, limit or MAX_LIMIT):
+                versions = Addon.compatible_versions([a.id for a in hits],
+                                                     app_id, version,
+                                                     platform, compat_mode)
+                for addon in hits:
+                    compat_version = versions[addon.id]
+                    if compat_version:
+                        addon.compat_version = compat_version
+                        results.append(addon)
+                        if len(results) == limit:
+                            break
+                    else:
+                        # We're excluding this addon because there are no
+                        # compatible versions. Decrement the total.
+                        total -= 1
+                if results and len(results) == limit:
+                    break
         else:
             is_d2c = False
             results = addons
@@ -51,6 +51,13 @@ def migrate_collection_users():
 # /Migration tasks
 
 
+@cronjobs.register
+def flush_synced_collections():
+    """Write the counts the discovery pane recorded to synced_collections."""
+    count = SyncedCollection.flush()
+    task_log.info('Flushed counts for %s synced collections.' % count)
+
+
 @cronjobs.register
 def update_collections_subscribers():
     """Update collections subscribers totals."""
@@ -12,22 +12,30 @@ from django.db import models, connection, transaction
 from django.db.models import Q
 
 import caching.base as caching
+import commonware.log
+import redisutils
 
 import amo
 import amo.models
 import sharing.utils as sharing
 from amo.helpers import absolutify
-from amo.utils import sorted_groupby
+from amo.utils import chunked, sorted_groupby
 from amo.urlresolvers import reverse
 from addons.models import Addon, AddonRecommendation
 from applications.models import Application
+from lib.recommend.scores import ScoreFile
 from stats.models import CollectionShareCountTotal
 from translations.fields import TranslatedField, LinkifiedField
 from users.models import UserProfile
 from versions import compare
 
+log = commonware.log.getLogger('z.collections')
+
 SPECIAL_SLUGS = amo.COLLECTION_SPECIAL_SLUGS
 
+# The scores the recs cron worked out, mapped in by every worker.
+recs_index = ScoreFile(settings.RECS_INDEX_PATH)
+
 
 class TopTags(object):
     """Descriptor to manage a collection's top tags in cache."""
@@ -527,6 +535,136 @@ class SyncedCollection(CollectionBase, amo.models.ModelBase):
             self.save()
         transaction.commit_unless_managed()
 
+    # Hits from the discovery pane are counted in redis and written to the db
+    # in bulk by flush(), from the flush_synced_collections cron.
+    counts_key = 'amo:synced:counts'
+    addons_key = 'amo:synced:addons'
+    # Held while a flush runs, and times out in case that flush dies.
+    flush_lock = 'amo:synced:flush:lock'
+    # A batch that fails this many flushes is set aside, so the hits behind
+    # it still get written. Set aside batches are kept for a week.
+    flush_tries = 3
+
+    @classmethod
+    def record(cls, addon_index, addon_ids, old_index=None):
+        """
+        Counts another user with `addon_ids`, and takes them off the
+        collection at `old_index` if that's where they were before.
+        """
+        pipe = redisutils.connections['master'].pipeline()
+        pipe.hincrby(cls.counts_key, addon_index, 1)
+        pipe.hsetnx(cls.addons_key, addon_index,
+                    ','.join(map(str, addon_ids)))
+        if old_index:
+            pipe.hincrby(cls.counts_key, old_index, -1)
+        pipe.execute()
+
+    @classmethod
+    def flush(cls):
+        """
+        Writes the counts recorded since the last flush to the db: one
+        upsert for the counts that went up, one update for those that went
+        down and one insert for the add-ons of all the new collections.
+        Returns how many collections were counted.
+        """
+        redis = redisutils.connections['master']
+        if not redis.setnx(cls.flush_lock, 1):
+            # Another flush is running. If it died before setting a
+            # timeout on the lock, give it one.
+            if redis.ttl(cls.flush_lock) in (None, -1):
+                redis.expire(cls.flush_lock, 60 * 10)
+            return 0
+        redis.expire(cls.flush_lock, 60 * 10)
+        try:
+            return cls._flush(redis)
+        finally:
+            redis.delete(cls.flush_lock)
+
+    @classmethod
+    def _flush(cls, redis):
+        counts, addons = cls.counts_key + ':flush', cls.addons_key + ':flush'
+        # Take what's there so far, new hits go into new keys. If the last
+        # flush failed its batch is still here, so finish that first.
+        if not redis.exists(counts) and redis.exists(cls.counts_key):
+            redis.rename(cls.counts_key, counts)
+            if redis.exists(cls.addons_key):
+                redis.rename(cls.addons_key, addons)
+
+        deltas = dict((index, int(delta)) for index, delta
+                      in redis.hgetall(counts).items() if int(delta))
+        new_addons = redis.hgetall(addons)
+        # The keys are taken one after the other, so a hit can have its
+        # count in this batch and its add-ons in the next, or the other way
+        # around. Collections are made from whichever batch has the add-ons.
+        indexes = set(deltas) | set(new_addons)
+        existing = set()
+        for chunk in chunked(list(indexes), 1000):
+            existing.update(cls.uncached.filter(addon_index__in=chunk)
+                            .values_list('addon_index', flat=True))
+        new = [i for i in indexes
+               if i not in existing and deltas.get(i, 0) >= 0]
+        missing = [i for i in new if i not in new_addons]
+        if missing:
+            new_addons.update(zip(missing,
+                                  redis.hmget(cls.addons_key, missing)))
+        new = [i for i in new if new_addons.get(i)]
+        changed = [i for i in existing if i in deltas] + new
+        tries = counts + ':tries'
+        try:
+            cls._write_counts(dict((i, deltas.get(i, 0)) for i in changed),
+                              dict((i, new_addons[i]) for i in new))
+        except Exception:
+            if redis.incr(tries) < cls.flush_tries:
+                raise
+            stamp = int(time.time())
+            log.error('Setting aside synced collection counts as :failed:%s.'
+                      % stamp, exc_info=True)
+            for key in counts, addons:
+                if redis.exists(key):
+                    failed = '%s:failed:%s' % (key, stamp)
+                    redis.rename(key, failed)
+                    redis.expire(failed, 60 * 60 * 24 * 7)
+            redis.delete(tries)
+            return 0
+
+        redis.delete(counts, addons, tries)
+        return len(changed)
+
+    @classmethod
+    @transaction.commit_on_success
+    def _write_counts(cls, deltas, new_addons):
+        if not deltas:
+            return
+        cursor = connection.cursor()
+        # count is unsigned, so the upsert only takes what it can add.
+        # Users moving off a collection take it down separately, and never
+        # below 0.
+        up = [(i, d) for i, d in deltas.items() if d >= 0]
+        down = [(d, i) for i, d in deltas.items() if d < 0]
+        for chunk in chunked(up, 1000):
+            cursor.executemany("""
+                INSERT INTO synced_collections (addon_index, count, created,
+                                                modified)
+                VALUES (%s, %s, NOW(), NOW())
+                ON DUPLICATE KEY UPDATE count=count + VALUES(count)""",
+                chunk)
+        for chunk in chunked(down, 1000):
+            cursor.executemany("""
+                UPDATE synced_collections
+                SET count=GREATEST(CAST(count AS SIGNED) + %s, 0)
+                WHERE addon_index=%s""", chunk)
+        values = []
+        for chunk in chunked(new_addons.keys(), 1000):
+            for id, index in (cls.uncached.filter(addon_index__in=chunk)
+                              .values_list('id', 'addon_index')):
+                values.extend((addon, id)
+                              for addon in new_addons[index].split(','))
+        for chunk in chunked(values, 1000):
+            cursor.executemany("""
+                INSERT IGNORE INTO synced_addons_collections
+                    (addon_id, collection_id)
+                VALUES (%s, %s)""", chunk)
+
 
 class SyncedCollectionAddon(models.Model):
     addon = models.ForeignKey(Addon)
@@ -549,6 +687,14 @@ class RecommendedCollection(Collection):
     @classmethod
     def build_recs(cls, addon_ids):
         """Get the top ranking add-ons according to recommendation scores."""
+        try:
+            index = recs_index.get()
+        except Exception:
+            log.error('Could not load the recs index.', exc_info=True)
+            index = None
+        if index is not None:
+            return index.ranked(addon_ids)
+
         scores = AddonRecommendation.scores(addon_ids)
         d = collections.defaultdict(int)
         for others in scores.values():
@@ -3,13 +3,14 @@ import random
 
 import mock
 from nose.tools import eq_
+import redisutils
 
 import amo
 import amo.tests
 from access.models import Group
 from addons.models import Addon, AddonRecommendation
 from bandwagon.models import (Collection, CollectionUser, CollectionWatcher,
-                              RecommendedCollection)
+                              RecommendedCollection, SyncedCollection)
 from devhub.models import ActivityLog
 from bandwagon import tasks
 from users.models import UserProfile
@@ -220,3 +221,75 @@ class TestRecommendations(amo.tests.TestCase):
         recs = RecommendedCollection.build_recs([7, 3, 8])
         # 3 should not be in the list since we already have it.
         eq_(recs, [1, 2])
+
+
+class TestSyncedCollection(amo.tests.TestCase):
+    fixtures = ['base/addon_3615', 'base/addon_5299_gcal']
+
+    def setUp(self):
+        self.ids = [3615, 5299]
+        self.index = SyncedCollection.make_index(self.ids)
+
+    def test_flush_new(self):
+        SyncedCollection.record(self.index, self.ids)
+        SyncedCollection.record(self.index, self.ids)
+        eq_(SyncedCollection.flush(), 1)
+        c = SyncedCollection.objects.get()
+        eq_(c.addon_index, self.index)
+        eq_(c.count, 2)
+        eq_(sorted(c.addons.values_list('id', flat=True)), self.ids)
+
+    def test_flush_existing(self):
+        c = SyncedCollection.objects.create(addon_index=self.index, count=5)
+        c.set_addons(self.ids)
+        SyncedCollection.record(self.index, self.ids)
+        SyncedCollection.record('new', [3615], old_index=self.index)
+        SyncedCollection.flush()
+        eq_(SyncedCollection.objects.get(id=c.id).count, 5)
+        eq_(SyncedCollection.objects.get(addon_index='new').count, 1)
+        eq_(c.addons.count(), 2)
+
+    def test_flush_once(self):
+        SyncedCollection.record(self.index, self.ids)
+        SyncedCollection.flush()
+        eq_(SyncedCollection.flush(), 0)
+        eq_(SyncedCollection.objects.get().count, 1)
+
+    def test_unknown_old_index(self):
+        SyncedCollection.record(self.index, self.ids, old_index='gone')
+        SyncedCollection.flush()
+        eq_(list(SyncedCollection.objects.values_list('addon_index',
+                                                      flat=True)),
+            [self.index])
+
+    def test_flush_down(self):
+        c = SyncedCollection.objects.create(addon_index=self.index, count=1)
+        c.set_addons(self.ids)
+        SyncedCollection.record('new', [3615], old_index=self.index)
+        SyncedCollection.record('new', [3615], old_index=self.index)
+        SyncedCollection.flush()
+        # Down to 0, not below it.
+        eq_(SyncedCollection.objects.get(id=c.id).count, 0)
+        eq_(SyncedCollection.objects.get(addon_index='new').count, 2)
+
+    def test_flush_locked(self):
+        redis = redisutils.connections['master']
+        redis.set(SyncedCollection.flush_lock, 1)
+        SyncedCollection.record(self.index, self.ids)
+        eq_(SyncedCollection.flush(), 0)
+        eq_(SyncedCollection.objects.count(), 0)
+        redis.delete(SyncedCollection.flush_lock)
+        eq_(SyncedCollection.flush(), 1)
+
+    def test_flush_failing(self):
+        SyncedCollection.record(self.index, self.ids)
+        with mock.patch.object(SyncedCollection, '_write_counts') as write:
+            write.side_effect = ValueError
+            for i in range(SyncedCollection.flush_tries - 1):
+                self.assertRaises(ValueError, SyncedCollection.flush)
+            # The batch is set aside, and doesn't hold up the next one.
+            eq_(SyncedCollection.flush(), 0)
+        SyncedCollection.record('new', [3615])
+        eq_(SyncedCollection.flush(), 1)
+        eq_(list(SyncedCollection.objects.values_list('addon_index',
+                                                      flat=True)), ['new'])
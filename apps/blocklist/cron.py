@@ -0,0 +1,14 @@
+import commonware.log
+import cronjobs
+
+from .utils import build
+
+log = commonware.log.getLogger('z.cron')
+
+
+@cronjobs.register
+def build_blocklist():
+    # Builds only happen on saves, so without this a quiet month lets the
+    # documents expire and every request renders its own.
+    generation = build()
+    log.info('Built blocklist generation %s.' % generation['id'])
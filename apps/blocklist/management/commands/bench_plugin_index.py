@@ -0,0 +1,88 @@
+from collections import namedtuple
+from optparse import make_option
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from blocklist.utils import find_slot, PluginIndex
+from versions.compare import version_int
+
+Plugin = namedtuple('Plugin', 'id min max')
+
+
+def random_version():
+    return '%s.%s' % (random.randint(1, 20), random.randint(0, 9))
+
+
+def fake_plugins(number):
+    """Plugins like the real ones: most with a range, some without."""
+    rv = []
+    for id in xrange(1, number + 1):
+        if random.random() < .2:
+            rv.append(Plugin(id, None, None))
+        else:
+            lo, hi = sorted([random_version(), random_version()],
+                            key=version_int)
+            rv.append(Plugin(id, lo, hi))
+    return rv
+
+
+def parse_each_time(plugins, appver):
+    """How API < 3 requests picked their plugins before the index."""
+    def between(ver, min, max):
+        if not (min and max):
+            return True
+        return version_int(min) < ver < version_int(max)
+    app_version = version_int(appver)
+    return [p for p in plugins if between(app_version, p.min, p.max)]
+
+
+class Command(BaseCommand):
+    """
+    Picks the plugins for a pile of API < 3 blocklist requests by parsing
+    every plugin's versions each time, the way it used to, and with a
+    PluginIndex. No db needed, the plugins are made up.
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('--plugins', action='store', type='int', default=3000,
+                    dest='plugins', help='Number of plugins, default: '
+                                         '%default'),
+        make_option('--requests', action='store', type='int', default=2000,
+                    dest='requests', help='Number of requests, default: '
+                                          '%default'),
+    )
+
+    def handle(self, *args, **options):
+        random.seed(0)
+        plugins = fake_plugins(options['plugins'])
+        appvers = [random_version() for i in xrange(options['requests'])]
+
+        start = time.time()
+        before = [parse_each_time(plugins, v) for v in appvers]
+        self.report('Parsing each request', len(appvers), time.time() - start)
+
+        start = time.time()
+        index = PluginIndex(plugins)
+        print 'Building the index: %.1fms, %s documents' % (
+            (time.time() - start) * 1000, len(index.variants))
+
+        # What a request does now: find its document in the generation.
+        bounds, names = index.lookup()
+        start = time.time()
+        for v in appvers:
+            names[find_slot(bounds, version_int(v))]
+        self.report('Finding the document', len(appvers), time.time() - start)
+
+        start = time.time()
+        after = [index.plugins(version_int(v)) for v in appvers]
+        self.report('Plugins from the index', len(appvers),
+                    time.time() - start)
+
+        if before != after:
+            raise CommandError('The index picked different plugins.')
+        print 'Same plugins for all %s requests.' % len(appvers)
+
+    def report(self, name, number, elapsed):
+        print '%s: %.0f requests/s' % (name, number / elapsed
+                                       if elapsed else 0)
@@ -0,0 +1,18 @@
+from django.core.cache import cache
+
+import commonware.log
+from celeryutils import task
+
+from amo.tasks import flush_front_end_cache_urls
+from .utils import build, PENDING_KEY
+
+log = commonware.log.getLogger('z.task')
+
+
+@task
+def build_blocklist(**kw):
+    # Saves from here on need another build.
+    cache.delete(PENDING_KEY)
+    generation = build()
+    log.info('Built blocklist generation %s.' % generation['id'])
+    flush_front_end_cache_urls.delay(['/blocklist/*'])
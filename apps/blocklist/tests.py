@@ -1,17 +1,23 @@
 import base64
+import collections
 from datetime import datetime
 from xml.dom import minidom
 
 from django.conf import settings
 from django.core.cache import cache
 
+import mock
 from nose.tools import eq_
 
 import amo
 import amo.tests
 from amo.urlresolvers import reverse
+from versions.compare import version_int
+from . import cron
 from .models import (BlocklistApp, BlocklistCA, BlocklistDetail,
                      BlocklistItem, BlocklistGfx, BlocklistPlugin)
+from .utils import (build, doc_key, get_doc, GENERATION_KEY, PluginIndex,
+                    render_once)
 
 base_xml = """
 <?xml version="1.0"?>
@@ -113,21 +119,16 @@ class BlocklistItemTest(BlocklistTest):
         eq_(self.client.get(self.fx4_url + 'other/junk/').status_code, 200)
 
     def test_app_guid(self):
+        items = lambda url: self.dom(url).getElementsByTagName('emItem')
         # There's one item for Firefox.
-        r = self.client.get(self.fx4_url)
-        eq_(r.status_code, 200)
-        eq_(len(r.context['items']), 1)
+        eq_(len(items(self.fx4_url)), 1)
 
         # There are no items for mobile.
-        r = self.client.get(self.mobile_url)
-        eq_(r.status_code, 200)
-        eq_(len(r.context['items']), 0)
+        eq_(len(items(self.mobile_url)), 0)
 
         # Without the app constraint we see the item.
         self.app.delete()
-        r = self.client.get(self.mobile_url)
-        eq_(r.status_code, 200)
-        eq_(len(r.context['items']), 1)
+        eq_(len(items(self.mobile_url)), 1)
 
     def test_item_guid(self):
         items = self.dom(self.fx4_url).getElementsByTagName('emItem')
@@ -427,3 +428,159 @@ class BlocklistCATest(BlocklistTest):
         dom = minidom.parseString(r.content)
         ca = dom.getElementsByTagName('caBlocklistEntry')[0]
         eq_(base64.b64decode(ca.childNodes[0].toxml()), self.ca.data)
+
+
+class BlocklistBuildTest(BlocklistTest):
+
+    def setUp(self):
+        super(BlocklistBuildTest, self).setUp()
+        self.item = BlocklistItem.objects.create(guid='guid@addon.com',
+                                                 details=self.details)
+
+    def test_etag(self):
+        r = self.client.get(self.fx4_url)
+        eq_(r.status_code, 200)
+        r = self.client.get(self.fx4_url, HTTP_IF_NONE_MATCH=r['ETag'])
+        eq_(r.status_code, 304)
+
+    def test_last_modified(self):
+        r = self.client.get(self.fx4_url)
+        r = self.client.get(self.fx4_url,
+                            HTTP_IF_MODIFIED_SINCE=r['Last-Modified'])
+        eq_(r.status_code, 304)
+
+    def test_changed(self):
+        etag = self.client.get(self.fx4_url)['ETag']
+        self.item.update(os='win')
+        r = self.client.get(self.fx4_url, HTTP_IF_NONE_MATCH=etag)
+        eq_(r.status_code, 200)
+        assert r['ETag'] != etag
+
+    def test_unchanged_across_builds(self):
+        doc = get_doc(3, amo.FIREFOX.guid, '4.0')
+        build()
+        eq_(get_doc(3, amo.FIREFOX.guid, '4.0'), doc)
+
+    def test_new_generation(self):
+        old = build()
+        eq_(build()['id'], old['id'] + 1)
+        eq_(cache.get(GENERATION_KEY)['id'], old['id'] + 1)
+
+    def test_no_queries(self):
+        build()
+        with self.assertNumQueries(0):
+            get_doc(3, amo.FIREFOX.guid, '4.0')
+            get_doc(2, amo.FIREFOX.guid, '2.0')
+
+    def test_not_built(self):
+        cache.delete(GENERATION_KEY)
+        eq_(get_doc(3, amo.FIREFOX.guid, '4.0'), None)
+        # The request renders its own and queues a build.
+        eq_(self.client.get(self.fx4_url).status_code, 200)
+        assert cache.get(GENERATION_KEY)
+
+    def test_unique_ids(self):
+        build()
+        cache.delete(GENERATION_KEY)
+        # Builds don't get their ids from the generation being served.
+        ids = [build()['id'] for i in range(3)]
+        eq_(len(set(ids)), 3)
+
+    def test_older_build_not_swapped_in(self):
+        newer = build()
+        # A build that started first but finished last.
+        with mock.patch('blocklist.utils.next_id') as next_id:
+            next_id.return_value = newer['id'] - 1
+            build()
+        eq_(cache.get(GENERATION_KEY)['id'], newer['id'])
+
+    def test_cron(self):
+        old = build()
+        cron.build_blocklist()
+        eq_(cache.get(GENERATION_KEY)['id'], old['id'] + 1)
+
+    def test_generation_does_not_expire(self):
+        with mock.patch('blocklist.utils.cache') as cache_mock:
+            cache_mock.get.return_value = None
+            build()
+        key, generation, timeout = cache_mock.set.call_args[0]
+        eq_((key, timeout), (GENERATION_KEY, 0))
+
+    def test_render_once(self):
+        key = doc_key('test', amo.FIREFOX.guid, 'api3')
+        doc = render_once(key, 3, amo.FIREFOX.guid, '4.0')
+        eq_(cache.get(key), doc)
+        assert not cache.get(key + ':lock')
+
+    @mock.patch('blocklist.utils.time.sleep')
+    def test_render_once_waits(self, sleep):
+        key = doc_key('test', amo.FIREFOX.guid, 'api3')
+        cache.set(key + ':lock', 1)
+        # Someone else is rendering it; the doc shows up while we wait.
+        sleep.side_effect = lambda s: cache.set(key, 'doc')
+        with self.assertNumQueries(0):
+            eq_(render_once(key, 3, amo.FIREFOX.guid, '4.0'), 'doc')
+
+    @mock.patch('blocklist.utils.time.sleep')
+    def test_render_once_gives_up(self, sleep):
+        key = doc_key('test', amo.FIREFOX.guid, 'api3')
+        cache.set(key + ':lock', 1)
+        doc = render_once(key, 3, amo.FIREFOX.guid, '4.0')
+        assert doc['xml']
+        # It's not ours to store.
+        eq_(cache.get(key), None)
+
+    def test_other_app(self):
+        url = reverse('blocklist', args=[3, '{some-other-app}', '1.0'])
+        eq_(len(self.dom(url).getElementsByTagName('emItem')), 1)
+
+    def test_legacy_variants(self):
+        BlocklistPlugin.objects.create(guid=amo.FIREFOX.guid, min='3.0',
+                                       max='4.0', severity=1)
+        generation = build()
+        bounds, names = generation['plugins'][amo.FIREFOX.guid]
+        eq_(len(set(names)), 2)
+        # Firefox 2 and 3.5 get different plugins, 2 and 5 the same ones.
+        assert get_doc(2, amo.FIREFOX.guid, '2.0') != get_doc(
+            2, amo.FIREFOX.guid, '3.5')
+        eq_(get_doc(2, amo.FIREFOX.guid, '2.0'),
+            get_doc(2, amo.FIREFOX.guid, '5.0'))
+
+
+class PluginIndexTest(amo.tests.TestCase):
+
+    def setUp(self):
+        Plugin = collections.namedtuple('Plugin', 'id min max')
+        self.plugins = [Plugin(1, '1.0', '2.0'), Plugin(2, '1.5', '3.0'),
+                        Plugin(3, None, None), Plugin(4, '2.0', '1.0'),
+                        Plugin(5, '1.5', None)]
+        self.index = PluginIndex(self.plugins)
+
+    def ids(self, version):
+        return [p.id for p in self.index.plugins(version_int(version))]
+
+    def test_plugins(self):
+        eq_(self.ids('0.5'), [3, 5])
+        eq_(self.ids('1.0'), [3, 5])
+        eq_(self.ids('1.2'), [1, 3, 5])
+        eq_(self.ids('1.7'), [1, 2, 3, 5])
+        eq_(self.ids('2.0'), [2, 3, 5])
+        eq_(self.ids('3.0'), [3, 5])
+        eq_(self.ids('4.0'), [3, 5])
+
+    def test_variants(self):
+        eq_(len(self.index.variants), 4)
+        eq_(self.index.variant(version_int('1.6')),
+            self.index.variant(version_int('1.9')))
+
+    def test_same_as_parsing(self):
+        def between(p, version):
+            if not (p.min and p.max):
+                return True
+            return version_int(p.min) < version < version_int(p.max)
+
+        for v in ('0.1', '1.0', '1.0.1', '1.5', '1.6b1', '2.0', '2.5', '3.0',
+                  '3.1', '10.0'):
+            version = version_int(v)
+            eq_(self.ids(v),
+                [p.id for p in self.plugins if between(p, version)])
@@ -0,0 +1,304 @@
+import base64
+import bisect
+import collections
+from datetime import datetime
+import hashlib
+from operator import attrgetter
+import time
+
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils.encoding import smart_str
+
+import jingo
+
+import amo
+from amo.utils import sorted_groupby
+from versions.compare import version_int
+from .models import BlocklistCA, BlocklistGfx, BlocklistItem, BlocklistPlugin
+
+
+App = collections.namedtuple('App', 'guid min max')
+BlItem = collections.namedtuple('BlItem', 'rows os modified block_id')
+
+# The blocklist is served from documents built ahead of time, a generation
+# at a time. This key points at the generation being served.
+GENERATION_KEY = 'blocklist:generation'
+# Set while a build is queued, so a burst of saves only builds once.
+PENDING_KEY = 'blocklist:pending'
+# Hands out generation ids, and makes sure only one build swaps at a time.
+COUNTER_KEY = 'blocklist:counter'
+SWAP_KEY = 'blocklist:swap'
+# Memcached reads anything longer than 30 days as a timestamp. The
+# build_blocklist cron builds a new generation well before this is up.
+TIMEOUT = 60 * 60 * 24 * 28
+# How long other requests wait for the one rendering a missing document.
+RENDER_WAIT = 5
+
+
+def get_items(apiver, app, appver=None):
+    # Collapse multiple blocklist items (different version ranges) into one
+    # item and collapse each item's apps.
+    addons = (BlocklistItem.uncached
+              .select_related('details')
+              .filter(Q(app__guid__isnull=True) | Q(app__guid=app))
+              .order_by('-modified')
+              .extra(select={'app_guid': 'blapps.guid',
+                             'app_min': 'blapps.min',
+                             'app_max': 'blapps.max'}))
+    items, details = {}, {}
+    for guid, rows in sorted_groupby(addons, 'guid'):
+        rows = list(rows)
+        rr = []
+        for id, rs in sorted_groupby(rows, 'id'):
+            rs = list(rs)
+            rr.append(rs[0])
+            rs[0].apps = [App(r.app_guid, r.app_min, r.app_max)
+                           for r in rs if r.app_guid]
+        os = [r.os for r in rr if r.os]
+        items[guid] = BlItem(rr, os[0] if os else None, rows[0].modified,
+                             rows[0].block_id)
+        details[guid] = sorted(rows, key=attrgetter('id'))[0]
+    return items, details
+
+
+def get_plugins(apiver, app, appver=None):
+    plugins = list(BlocklistPlugin.uncached.select_related('details')
+                   .filter(Q(guid__isnull=True) | Q(guid=app)))
+    if apiver < 3 and appver is not None:
+        plugins = PluginIndex(plugins).plugins(version_int(appver))
+    return plugins
+
+
+class PluginIndex(object):
+    """
+    API versions < 3 ignore targetApplication entries for plugins, so a
+    plugin with a min and max only applies to the app versions strictly
+    between them.
+
+    The ends of all the ranges, parsed once, sorted and deduped, split the
+    app versions into slots: slot 2i is between bounds[i - 1] and
+    bounds[i], slot 2i + 1 is bounds[i] itself. Every version in a slot
+    gets the same plugins, so an app version is a bisect away from them.
+    """
+
+    def __init__(self, plugins):
+        self.all = plugins
+        ranged = [(p.id, version_int(p.min), version_int(p.max))
+                  for p in plugins if p.min and p.max]
+        self.ranged = set(id for id, _, _ in ranged)
+        self.bounds = sorted(set(v for _, lo, hi in ranged for v in (lo, hi)))
+        where = dict((v, i) for i, v in enumerate(self.bounds))
+        # Walk the slots adding plugins where their range starts and
+        # dropping them where it ends.
+        starts = collections.defaultdict(list)
+        ends = collections.defaultdict(list)
+        for id, lo, hi in ranged:
+            if lo < hi:
+                starts[2 * where[lo] + 2].append(id)
+                ends[2 * where[hi] + 1].append(id)
+        active = set()
+        self.names, self.variants, self.lists = [], {}, {}
+        for slot in xrange(2 * len(self.bounds) + 1):
+            active.difference_update(ends[slot])
+            active.update(starts[slot])
+            ids = ','.join(map(str, sorted(active)))
+            name = 'plugins:%s' % hashlib.md5(ids).hexdigest()
+            if name not in self.variants:
+                self.variants[name] = frozenset(active)
+            self.names.append(name)
+
+    def variant(self, version):
+        """The name of the document for app version `version`."""
+        return self.names[find_slot(self.bounds, version)]
+
+    def plugins(self, version=None, variant=None):
+        """The plugins for app version `version`, or document `variant`."""
+        variant = variant or self.variant(version)
+        if variant not in self.lists:
+            ids = self.variants[variant]
+            self.lists[variant] = [p for p in self.all
+                                   if p.id not in self.ranged or p.id in ids]
+        return self.lists[variant]
+
+    def lookup(self):
+        """Just enough to pick a variant, to keep with the generation."""
+        return self.bounds, self.names
+
+
+def find_slot(bounds, version):
+    i = bisect.bisect_left(bounds, version)
+    if i < len(bounds) and bounds[i] == version:
+        return 2 * i + 1
+    return 2 * i
+
+
+def get_variant(generation, apiver, app, appver):
+    """The name of the document a request gets out of `generation`."""
+    if apiver >= 3:
+        return 'api3'
+    if app in generation['plugins']:
+        bounds, names = generation['plugins'][app]
+        return names[find_slot(bounds, version_int(appver))]
+    # Not one of our apps, so nothing was built for it up front.
+    return 'appver:%s' % appver
+
+
+def doc_key(generation_id, app, variant):
+    key = u'%s:%s:%s' % (generation_id, app, variant)
+    # Use md5 to make sure the memcached key is clean.
+    return 'blocklist:doc:%s' % hashlib.md5(smart_str(key)).hexdigest()
+
+
+def get_sections(app):
+    items = get_items(3, app)[0]
+    plugins = get_plugins(3, app)
+    gfxs = list(BlocklistGfx.objects.filter(Q(guid__isnull=True) |
+                                            Q(guid=app)))
+    return items, plugins, gfxs
+
+
+def get_cas():
+    try:
+        return base64.b64encode(BlocklistCA.objects.all()[0].data)
+    except IndexError:
+        return None
+
+
+def render(apiver, app, items, plugins, gfxs, cas):
+    # Find the latest created/modified date across all sections.
+    all_ = list(items.values()) + list(plugins) + list(gfxs)
+    last_update = max(x.modified for x in all_) if all_ else datetime.now()
+    # The client expects milliseconds, Python's time returns seconds.
+    last_update = int(time.mktime(last_update.timetuple()) * 1000)
+    data = dict(items=items, plugins=plugins, gfxs=gfxs, apiver=apiver,
+                appguid=app, last_update=last_update, cas=cas)
+    xml = jingo.env.get_template('blocklist/blocklist.xml').render(data)
+    return smart_str(xml)
+
+
+def make_doc(xml, old=None):
+    """
+    The document we store and serve for `xml`. It keeps the modified date
+    of the `old` document if nothing changed, so conditional requests
+    still get a 304 across builds.
+    """
+    etag = hashlib.md5(xml).hexdigest()
+    if old and old['etag'] == etag:
+        modified = old['modified']
+    else:
+        modified = datetime.utcnow().replace(microsecond=0)
+    return {'xml': xml, 'etag': etag, 'modified': modified}
+
+
+def render_doc(apiver, app, appver):
+    """Renders the one document a request needs, straight from the db."""
+    items, plugins, gfxs = get_sections(app)
+    if apiver < 3:
+        plugins = PluginIndex(plugins).plugins(version_int(appver))
+    return make_doc(render(apiver, app, items, plugins, gfxs, get_cas()))
+
+
+def build():
+    """
+    Renders the blocklist for every app and API version into a new
+    generation of documents, then swaps it in. Requests keep getting the
+    old generation until all of the new one is in the cache.
+    """
+    old = cache.get(GENERATION_KEY)
+    generation = {'id': next_id(), 'plugins': {}}
+    cas = get_cas()
+    docs = {}
+    for app in amo.APP_GUIDS:
+        items, plugins, gfxs = get_sections(app)
+        docs[app, 'api3'] = render(3, app, items, plugins, gfxs, cas)
+        index = PluginIndex(plugins)
+        generation['plugins'][app] = index.lookup()
+        for variant in index.variants:
+            docs[app, variant] = render(2, app, items,
+                                        index.plugins(variant=variant), gfxs,
+                                        cas)
+
+    old_docs = {}
+    if old:
+        old_docs = cache.get_many([doc_key(old['id'], app, variant)
+                                   for app, variant in docs])
+    new_docs = {}
+    for (app, variant), xml in docs.items():
+        previous = old and old_docs.get(doc_key(old['id'], app, variant))
+        new_docs[doc_key(generation['id'], app, variant)] = make_doc(
+            xml, previous)
+    cache.set_many(new_docs, TIMEOUT)
+    swap(generation)
+    return generation
+
+
+def next_id():
+    """
+    A generation id no other build gets, even one running at the same
+    time. The counter starts from the clock, so it still only goes up if
+    it falls out of the cache.
+    """
+    try:
+        return cache.incr(COUNTER_KEY)
+    except ValueError:
+        cache.add(COUNTER_KEY, int(time.time()), 0)
+        return cache.incr(COUNTER_KEY)
+
+
+def swap(generation):
+    """
+    Serves `generation` from now on, unless a build that started after it
+    has already been swapped in. The generation never expires; it's only
+    replaced by a newer one.
+    """
+    locked = False
+    for i in xrange(RENDER_WAIT * 10):
+        locked = cache.add(SWAP_KEY, 1, 60)
+        if locked:
+            break
+        time.sleep(.1)
+    try:
+        current = cache.get(GENERATION_KEY)
+        if current is None or current['id'] < generation['id']:
+            cache.set(GENERATION_KEY, generation, 0)
+    finally:
+        if locked:
+            cache.delete(SWAP_KEY)
+
+
+def get_doc(apiver, app, appver):
+    """The document for a request, or None if nothing has been built."""
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        return None
+    key = doc_key(generation['id'], app,
+                  get_variant(generation, apiver, app, appver))
+    doc = cache.get(key)
+    if doc is None:
+        # An app we don't build for, or it fell out of the cache. This is
+        # one document, not a rebuild, and the next request gets it.
+        doc = render_once(key, apiver, app, appver)
+    return doc
+
+
+def render_once(key, apiver, app, appver, timeout=TIMEOUT):
+    """
+    Renders a document that's missing from the cache and stores it at `key`.
+    One request at a time does the rendering; the rest wait a little for
+    it to show up, and only render their own if it doesn't.
+    """
+    lock = '%s:lock' % key
+    if cache.add(lock, 1, 60):
+        try:
+            doc = render_doc(apiver, app, appver)
+            cache.set(key, doc, timeout)
+        finally:
+            cache.delete(lock)
+        return doc
+    for i in xrange(RENDER_WAIT * 10):
+        time.sleep(.1)
+        doc = cache.get(key)
+        if doc is not None:
+            return doc
+    return render_doc(apiver, app, appver)
@@ -1,3 +1,4 @@
+import bisect
 import logging
 from collections import defaultdict
 
@@ -11,6 +12,7 @@ import redisutils
 import amo
 import amo.utils
 from addons.models import Addon
+from files.models import File
 from search.utils import floor_version
 from stats.models import UpdateCount
 from versions.compare import version_int as vint
@@ -20,17 +22,72 @@ from .models import AppCompat, CompatReport
 log = logging.getLogger('z.compat')
 
 
+class VersionBuckets(object):
+    """
+    Puts app versions into the `COMPAT` entries they belong to, where an
+    entry covers the versions after its `previous` up to its `main`. The
+    entries for an app don't overlap.
+
+    The bounds are parsed once and kept sorted, so each version is a bisect
+    away from its entry, and each distinct version string is only looked
+    up once.
+    """
+
+    def __init__(self, versions):
+        bounds = sorted((vint(v['main']), vint(v['previous']))
+                        for v in versions)
+        self.mains = [main for main, _ in bounds]
+        self.previous = [previous for _, previous in bounds]
+        self.seen = {}
+
+    def find(self, version):
+        """The vint of the `main` that `version` falls under, or None."""
+        if version not in self.seen:
+            ver = vint(floor_version(version))
+            i = bisect.bisect_left(self.mains, ver)
+            if i < len(self.mains) and self.previous[i] < ver:
+                self.seen[version] = self.mains[i]
+            else:
+                self.seen[version] = None
+        return self.seen[version]
+
+
+def tally_reports(app, versions):
+    """
+    Counts the success and failure reports for every add-on for `app`,
+    grouped by `major`.`minor` app version, in one query.
+
+    Returns {guid: {main vint: (success, failure)}}.
+    """
+    reports = (CompatReport.uncached.filter(app_guid=app.guid)
+               .values_list('guid', 'app_version', 'works_properly')
+               .annotate(Count('id')).order_by())
+    tallies = defaultdict(dict)
+    for guid, version, works_properly, count in reports:
+        main = versions.find(version)
+        if main is None:
+            continue
+        success, failure = tallies[guid].get(main, (0, 0))
+        if works_properly:
+            success += count
+        else:
+            failure += count
+        tallies[guid][main] = success, failure
+    return tallies
+
+
 @cronjobs.register
 def compatibility_report():
     redis = redisutils.connections['master']
     docs = defaultdict(dict)
+    latest = UpdateCount.objects.aggregate(d=Max('date'))['d']
 
     # Gather all the data for the index.
     for app in amo.APP_USAGE:
-        versions = [c for c in settings.COMPAT if c['app'] == app.id]
+        versions = VersionBuckets(
+            [c for c in settings.COMPAT if c['app'] == app.id])
 
         log.info(u'Making compat report for %s.' % app.pretty)
-        latest = UpdateCount.objects.aggregate(d=Max('date'))['d']
         qs = UpdateCount.objects.filter(addon__appsupport__app=app.id,
                                         addon__disabled_by_user=False,
                                         addon__status__in=amo.VALID_STATUSES,
@@ -38,13 +95,18 @@ def compatibility_report():
                                         date=latest)
 
         updates = dict(qs.values_list('addon', 'count'))
-        for chunk in amo.utils.chunked(updates.items(), 50):
+        reports = tally_reports(app, versions)
+        for chunk in amo.utils.chunked(updates.items(), 500):
             chunk = dict(chunk)
-            for addon in Addon.objects.filter(id__in=chunk):
+            addons = list(Addon.objects.filter(id__in=chunk))
+            binary = set(File.objects.filter(
+                version__in=[a.current_version.id for a in addons],
+                binary_components=True).values_list('version', flat=True))
+            for addon in addons:
                 doc = docs[addon.id]
                 doc.update(id=addon.id, slug=addon.slug, guid=addon.guid,
                            self_hosted=addon.is_selfhosted(),
-                           binary=addon.binary_components,
+                           binary=addon.current_version.id in binary,
                            name=unicode(addon.name), created=addon.created,
                            current_version=addon.current_version.version,
                            current_version_id=addon.current_version.pk)
@@ -53,33 +115,22 @@ def compatibility_report():
                                defaultdict(lambda: defaultdict(dict)))
                 doc.setdefault('top_95_all', {})
                 doc.setdefault('usage', {})[app.id] = updates[addon.id]
-                doc.setdefault('works', {}).setdefault(app.id, {})
-
-                # Populate with default counts for all app versions.
-                for ver in versions:
-                    doc['works'][app.id][vint(ver['main'])] = {
-                        'success': 0,
-                        'failure': 0,
-                        'total': 0,
-                        'failure_ratio': 0.0,
-                    }
 
-                # Group reports by `major`.`minor` app version.
-                reports = (CompatReport.objects
-                           .filter(guid=addon.guid, app_guid=app.guid)
-                           .values_list('app_version', 'works_properly')
-                           .annotate(Count('id')))
-                for ver, works_properly, cnt in reports:
-                    ver = vint(floor_version(ver))
-                    major = [v['main'] for v in versions
-                             if vint(v['previous']) < ver <= vint(v['main'])]
-                    if major:
-                        w = doc['works'][app.id][vint(major[0])]
-                        # Tally number of success and failure reports.
-                        w['success' if works_properly else 'failure'] += cnt
-                        w['total'] += cnt
-                        # Calculate % of incompatibility reports.
-                        w['failure_ratio'] = w['failure'] / float(w['total'])
+                # Default counts for all app versions, with the reports
+                # for this add-on tallied into them.
+                works = doc.setdefault('works', {}).setdefault(app.id, {})
+                tallies = reports.get(addon.guid, {})
+                for ver in versions.mains:
+                    success, failure = tallies.get(ver, (0, 0))
+                    total = success + failure
+                    works[ver] = {
+                        'success': success,
+                        'failure': failure,
+                        'total': total,
+                        # % of incompatibility reports.
+                        'failure_ratio': (failure / float(total)
+                                          if total else 0.0),
+                    }
 
                 if app not in addon.compatible_apps:
                     continue
@@ -9,7 +9,9 @@ import amo
 import amo.tests
 from amo.urlresolvers import reverse
 from addons.models import Addon
+from compat.cron import tally_reports, VersionBuckets
 from compat.models import CompatReport
+from versions.compare import version_int as vint
 
 
 # This is the structure sent to /compatibility/incoming from the ACR.
@@ -207,3 +209,38 @@ class TestReporterDetail(amo.tests.TestCase):
         r = self.check_table(good=1, bad=0, appver='', report_pks=[0])
         msg = 'Unknown (%s)' % app_guid
         assert msg in r.content, 'Expected %s in body' % msg
+
+
+class TestVersionBuckets(amo.tests.TestCase):
+
+    def setUp(self):
+        self.versions = VersionBuckets([
+            dict(app=1, main='14.0', previous='13.0'),
+            dict(app=1, main='13.0', previous='12.0'),
+            dict(app=1, main='4.0', previous='3.6')])
+
+    def test_find(self):
+        find = self.versions.find
+        eq_(find('14.0'), vint('14.0'))
+        eq_(find('14.0a1'), vint('14.0'))
+        eq_(find('13.0.1'), vint('13.0'))
+        eq_(find('13.0'), vint('13.0'))
+        eq_(find('3.7a'), vint('4.0'))
+        eq_(find('3.6'), None)
+        eq_(find('15.0'), None)
+
+    def test_tally(self):
+        app = amo.FIREFOX
+        for guid, version, works in (('a', '14.0', True), ('a', '14.0', True),
+                                     ('a', '13.0.1', False),
+                                     ('a', '13.0', False),
+                                     ('b', '99.0', False)):
+            CompatReport.objects.create(guid=guid, app_guid=app.guid,
+                                        app_version=version,
+                                        works_properly=works)
+        CompatReport.objects.create(guid='a', app_guid=amo.THUNDERBIRD.guid,
+                                    app_version='14.0', works_properly=True)
+        with self.assertNumQueries(1):
+            tallies = tally_reports(app, self.versions)
+        eq_(dict(tallies), {'a': {vint('14.0'): (2, 0),
+                                  vint('13.0'): (0, 2)}})
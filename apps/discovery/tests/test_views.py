@@ -163,8 +163,6 @@ class TestRecs(amo.tests.TestCase):
         eq_(one, two)
 
     def test_update_new_index(self):
-        waffle.models.Sample.objects.create(
-            name='disco-pane-store-collections', percent='100.0')
         response = self.client.post(self.url, self.json,
                                     content_type='application/json')
         one = json.loads(response.content)
@@ -179,10 +177,26 @@ class TestRecs(amo.tests.TestCase):
         # Tokens are based on guid list, so these should be different.
         assert one['token2'] != two['token2']
         assert one['addons'] != two['addons']
+        SyncedCollection.flush()
         eq_(SyncedCollection.objects.filter(addon_index=one['token2']).count(),
             1)
         eq_(SyncedCollection.objects.filter(addon_index=two['token2']).count(),
             1)
+        # They moved from the first collection to the second.
+        eq_(SyncedCollection.objects.get(addon_index=one['token2']).count, 0)
+        eq_(SyncedCollection.objects.get(addon_index=two['token2']).count, 1)
+
+    def test_record_all(self):
+        for i in range(3):
+            response = self.client.post(self.url, self.json,
+                                        content_type='application/json')
+        token = json.loads(response.content)['token2']
+        # Nothing is written until the counts are flushed.
+        eq_(SyncedCollection.objects.count(), 0)
+        SyncedCollection.flush()
+        c = SyncedCollection.objects.get(addon_index=token)
+        eq_(c.count, 3)
+        eq_(sorted(c.addons.values_list('id', flat=True)), sorted(self.ids))
 
 
 class TestModuleAdmin(amo.tests.TestCase):
@@ -5,8 +5,6 @@ import urlparse
 
 from django import http
 from django.contrib import admin
-from django.db import IntegrityError
-from django.db.models import F
 from django.forms.models import modelformset_factory
 from django.shortcuts import get_object_or_404, redirect
 from django.views.decorators.csrf import csrf_exempt
@@ -208,37 +206,15 @@ def recommendations(request, version, platform, limit=9, compat_mode=None):
     recs = _recommendations(request, version, platform, limit, index, ids,
                             recs, compat_mode)
 
-    # We're only storing a percentage of the collections we see because the db
-    # can't keep up with 100%.
-    if not waffle.sample_is_active('disco-pane-store-collections'):
-        return recs
-
     # Users have a token2 if they've been here before. The token matches
-    # addon_index in their SyncedCollection.
-    if 'token2' in POST:
-        token = POST['token2']
-        if token == index:
-            # We've seen them before and their add-ons have not changed.
-            return recs
-        elif token != index:
-            # We've seen them before and their add-ons changed. Remove the
-            # reference to their old synced collection.
-            (SyncedCollection.objects.filter(addon_index=index)
-             .update(count=F('count') - 1))
-
-    # Try to create the SyncedCollection. There's a unique constraint on
-    # addon_index so it will fail if this addon_index already exists. If we
-    # checked for existence first and then created a collection there would
-    # be a race condition between multiple users with the same addon_index.
-    try:
-        c = SyncedCollection.objects.create(addon_index=index, count=1)
-        c.set_addons(addon_ids)
-    except IntegrityError:
+    # addon_index in their SyncedCollection. If their add-ons haven't changed
+    # we've already counted them.
+    token = POST.get('token2')
+    if token != index:
         try:
-            (SyncedCollection.objects.filter(addon_index=index)
-             .update(count=F('count') + 1))
+            SyncedCollection.record(index, addon_ids, old_index=token)
         except Exception, e:
-            log.error(u'Could not count++ "%s" (%s).' % (index, e))
+            log.error(u'Could not record "%s" (%s).' % (index, e))
     return recs
 
 
@@ -537,7 +537,9 @@ def check_file(old_attr, new_attr, instance, sender, **kw):
 @File.on_change
 def clear_d2c_version(old_attr, new_attr, instance, sender, **kw):
     do_clear = False
-    fields = ['status', 'strict_compatibility', 'binary_components']
+    # The update service also caches the hash and filename it sends out.
+    fields = ['status', 'strict_compatibility', 'binary_components', 'hash',
+              'filename']
 
     for field in fields:
         if old_attr[field] != new_attr[field]:
@@ -0,0 +1,260 @@
+"""
+Streams update and download counts into elasticsearch with the _bulk api.
+
+Going through celery, a full reindex is hundreds of thousands of 50-row
+tasks. Here the table is read in id order off a server-side cursor, a pool of
+processes turns each batch of rows into bulk actions, and a few threads send
+those to elasticsearch. Only so many batches are in flight at once, so a slow
+cluster slows down the reader instead of piling everything up in memory.
+
+The id of the last row that's safely indexed is written to a checkpoint file
+after every batch, so an interrupted reindex can pick up where it stopped.
+"""
+import collections
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import Queue
+import threading
+import time
+import urllib2
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+
+import MySQLdb.cursors
+import multidb
+
+from . import search
+from .models import DownloadCount, UpdateCount
+
+log = logging.getLogger('z.stats')
+
+# How to turn a row of each table into a document.
+EXTRACT = {
+    UpdateCount: search.extract_update_count,
+    DownloadCount: search.extract_download_count,
+}
+
+
+class BulkError(Exception):
+    """Elasticsearch didn't take (all of) a bulk request."""
+
+
+def read(model, start=0, where=None, params=(), size=None):
+    """
+    Yields lists of up to `size` rows of `model` with an id above `start`,
+    in id order. `where` is extra sql for the WHERE clause.
+    """
+    size = size or settings.ES_BULK_SIZE
+    connection = connections[multidb.get_slave()]
+    connection.cursor()  # Make sure we're connected.
+    cursor = connection.connection.cursor(MySQLdb.cursors.SSCursor)
+    columns = ', '.join(f.column for f in model._meta.fields)
+    sql = 'SELECT %s FROM %s WHERE id > %%s %s ORDER BY id' % (
+        columns, model._meta.db_table, 'AND %s' % where if where else '')
+    try:
+        cursor.execute(sql, [start] + list(params))
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cursor.close()
+
+
+def transform(args):
+    """
+    Turns a batch of `model` rows into a _bulk request body for `index`
+    (None for the model's own). Returns (the last id in the batch, the
+    number of documents, the body).
+    """
+    model, rows, index = args
+    extract = EXTRACT[model]
+    index, doc_type = index or model._get_index(), model._meta.db_table
+    names = [f.attname for f in model._meta.fields]
+    lines = []
+    for row in rows:
+        obj = model(**dict(zip(names, row)))
+        action = {'_index': index, '_type': doc_type,
+                  '_id': '%s-%s' % (obj.addon_id, obj.date)}
+        lines.append(json.dumps({'index': action}))
+        lines.append(json.dumps(extract(obj), cls=DjangoJSONEncoder))
+    return rows[-1][0], len(rows), '\n'.join(lines) + '\n'
+
+
+class Checkpoint(object):
+    """
+    The last id of a table that made it into elasticsearch. A run filtered
+    with `where` and `params`, or into another `index`, gets a checkpoint
+    of its own, so resuming one run never skips rows another run left out.
+    """
+
+    def __init__(self, model, where=None, params=(), index=None):
+        name = model._meta.db_table
+        filters = [where, list(params)] if where else []
+        if index:
+            filters.append(index)
+        if filters:
+            filters = json.dumps(filters, cls=DjangoJSONEncoder)
+            name += '.%s' % hashlib.md5(filters).hexdigest()
+        self.path = os.path.join(settings.ES_BULK_CHECKPOINT_PATH, name)
+
+    def get(self):
+        try:
+            with open(self.path) as f:
+                return int(f.read().strip() or 0)
+        except IOError:
+            return 0
+
+    def set(self, last_id):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(last_id))
+        os.rename(tmp, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class BulkWriter(object):
+    """
+    Sends _bulk requests from `in_flight` threads. `send()` blocks once
+    that many requests are queued up as well.
+
+    Batches can finish out of order, so the checkpoint only moves up to
+    the last batch that has everything before it done too.
+    """
+
+    def __init__(self, checkpoint=None, in_flight=None, retries=None,
+                 backoff=1):
+        in_flight = in_flight or settings.ES_BULK_IN_FLIGHT
+        self.checkpoint = checkpoint
+        self.retries = (settings.ES_BULK_RETRIES if retries is None
+                        else retries)
+        self.backoff = backoff
+        self.hosts = list(settings.ES_HOSTS)
+        self.queue = Queue.Queue(maxsize=in_flight)
+        self.lock = threading.Lock()
+        self.sent, self.next, self.done = 0, 0, {}
+        self.indexed, self.error = 0, None
+        self.threads = [threading.Thread(target=self._work)
+                        for _ in xrange(in_flight)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def send(self, last_id, count, body):
+        if self.error:
+            raise self.error
+        self.queue.put((self.sent, last_id, count, body))
+        self.sent += 1
+
+    def close(self):
+        """Waits for everything that's been sent."""
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.error:
+            raise self.error
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            seq, last_id, count, body = item
+            if self.error:
+                continue
+            try:
+                self._post_with_retries(seq, body)
+            except Exception, e:
+                log.error('Giving up on bulk request %s.' % seq, exc_info=True)
+                self.error = e
+                continue
+            self._done(seq, last_id, count)
+
+    def _post_with_retries(self, seq, body):
+        for attempt in xrange(self.retries + 1):
+            try:
+                return self.post(self.hosts[seq % len(self.hosts)], body)
+            except Exception, e:
+                if attempt == self.retries:
+                    raise
+                wait = self.backoff * 2 ** attempt
+                log.warning('Bulk request %s failed (%s), retrying in %ss.'
+                            % (seq, e, wait))
+                time.sleep(wait)
+
+    def post(self, host, body):
+        request = urllib2.Request('http://%s/_bulk' % host, body)
+        response = json.loads(
+            urllib2.urlopen(request, timeout=settings.ES_TIMEOUT).read())
+        errors = [i for i in response.get('items', [])
+                  if i.values()[0].get('error')]
+        if errors:
+            raise BulkError('%s of %s documents failed: %s' % (
+                len(errors), len(response['items']), errors[0]))
+        return response
+
+    def _done(self, seq, last_id, count):
+        with self.lock:
+            self.indexed += count
+            self.done[seq] = last_id
+            last = None
+            while self.next in self.done:
+                last = self.done.pop(self.next)
+                self.next += 1
+            if last is not None and self.checkpoint:
+                self.checkpoint.set(last)
+
+
+def reindex(model, where=None, params=(), resume=False, processes=1,
+            index=None):
+    """
+    Indexes every row of `model` (filtered by the `where` sql) into
+    elasticsearch, or into `index` instead of the model's own. With
+    `resume`, starts after the last checkpoint.
+    """
+    checkpoint = Checkpoint(model, where, params, index)
+    start = checkpoint.get() if resume else 0
+    if not resume:
+        checkpoint.clear()
+    log.info('Streaming %s from id %s.' % (model._meta.db_table, start))
+
+    writer = BulkWriter(checkpoint)
+    batches = ((model, rows, index)
+               for rows in read(model, start, where, params))
+    try:
+        if processes > 1:
+            _transform_in_pool(batches, writer, processes)
+        else:
+            for batch in batches:
+                writer.send(*transform(batch))
+    finally:
+        # Let whatever is already sent finish so the checkpoint catches up.
+        writer.close()
+    log.info('Indexed %s %s.' % (writer.indexed, model._meta.db_table))
+    return writer.indexed
+
+
+def _transform_in_pool(batches, writer, processes):
+    pool = multiprocessing.Pool(processes)
+    # Keep a few batches ahead of the writer, but no more than that, or the
+    # reader would run through the whole table.
+    pending = collections.deque()
+    try:
+        for batch in batches:
+            pending.append(pool.apply_async(transform, [batch]))
+            if len(pending) > processes * 2:
+                writer.send(*pending.popleft().get())
+        while pending:
+            writer.send(*pending.popleft().get())
+    finally:
+        pool.terminate()
@@ -1,3 +1,5 @@
+import re
+
 from django.db import models
 
 import phpserialize as php
@@ -7,10 +9,97 @@ except ImportError:
     import json
 
 
+# Nearly every php blob we have is a flat array of string -> int counts, and
+# a regex can pull those apart without going through phpserialize.
+FLAT_ARRAY = re.compile(r'a:(\d+):{((?:s:\d+:"[^"]*";i:-?\d+;)*)}')
+FLAT_ITEM = re.compile(r's:(\d+):"([^"]*)";i:(-?\d+);')
+
+
+def unserialize(value):
+    """
+    Same as `phpserialize.unserialize(value, decode_strings=True)` for the
+    arrays, strings, numbers, booleans and nulls in our stats, only faster.
+    Raises ValueError if it can't make sense of `value`.
+    """
+    match = FLAT_ARRAY.match(value)
+    if match:
+        items = FLAT_ITEM.findall(match.group(2))
+        if (len(items) == int(match.group(1)) and
+            all(int(length) == len(key) for length, key, _ in items)):
+            return dict((key.decode('utf8'), int(count))
+                        for _, key, count in items)
+    try:
+        return _unserialize(value, 0)[0]
+    except (IndexError, TypeError):
+        raise ValueError('Could not unserialize %r' % value[:50])
+
+
+def _unserialize(value, pos):
+    """Returns the value starting at `pos` and the position after it."""
+    type_ = value[pos]
+    if type_ == 'a':
+        colon = value.index(':', pos + 2)
+        count = int(value[pos + 2:colon])
+        # Skip past the ':{'.
+        pos = colon + 2
+        result = {}
+        for _ in xrange(count):
+            key, pos = _unserialize(value, pos)
+            result[key], pos = _unserialize(value, pos)
+        if value[pos] != '}':
+            raise ValueError('Expected } at %s' % pos)
+        return result, pos + 1
+    if type_ == 's':
+        colon = value.index(':', pos + 2)
+        start = colon + 2
+        end = start + int(value[pos + 2:colon])
+        if value[end:end + 2] != '";':
+            raise ValueError('Bad string at %s' % pos)
+        return value[start:end].decode('utf8'), end + 2
+    if type_ in 'idb':
+        end = value.index(';', pos + 2)
+        data = value[pos + 2:end]
+        if type_ == 'i':
+            data = int(data)
+        elif type_ == 'd':
+            data = float(data)
+        else:
+            data = int(data) != 0
+        return data, end + 1
+    if type_ == 'N':
+        return None, pos + 2
+    raise ValueError('Unexpected %r at %s' % (type_, pos))
+
+
+class LazyStatsDict(object):
+    """
+    Keeps what came out of the db and only decodes it the first time the
+    field is used, since most queries only look at a couple of the fields.
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.field.name]
+        if isinstance(value, basestring):
+            value = self.field.to_python(value)
+            obj.__dict__[self.field.name] = value
+        return value
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.field.name] = value
+
+
 class StatsDictField(models.TextField):
 
     description = 'A dictionary of counts stored as serialized php.'
-    __metaclass__ = models.SubfieldBase
+
+    def contribute_to_class(self, cls, name):
+        super(StatsDictField, self).contribute_to_class(cls, name)
+        setattr(cls, self.name, LazyStatsDict(self))
 
     def db_type(self, connection):
         return 'text'
@@ -34,9 +123,12 @@ class StatsDictField(models.TextField):
             try:
                 if isinstance(value, unicode):
                     value = value.encode('utf8')
-                d = php.unserialize(value, decode_strings=True)
+                d = unserialize(value)
             except ValueError:
-                d = None
+                try:
+                    d = php.unserialize(value, decode_strings=True)
+                except ValueError:
+                    d = None
         if isinstance(d, dict):
             return d
         return None
@@ -0,0 +1,90 @@
+import logging
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from django_statsd.clients import statsd
+
+from stats.db import StatsDictField
+from stats.models import DownloadCount, UpdateCount
+
+log = logging.getLogger('z.stats')
+
+HELP = """\
+Rewrite the php serialized counts left in update_counts and download_counts
+as json, which is what we write now and a lot cheaper to read.
+
+Rows are converted --batch ids at a time. Progress is logged with the last id
+done, so an interrupted run can carry on with `--start=<id>`.
+"""
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', type='int', default=1000,
+                    help='The number of ids to convert at a time.'),
+        make_option('--start', type='int', default=0,
+                    help='Start after this id.'),
+        make_option('--pause', type='float', default=0,
+                    help='Seconds to wait between batches to go easy on '
+                         'the db.'),
+    )
+    help = HELP
+
+    def handle(self, *args, **kw):
+        for model in UpdateCount, DownloadCount:
+            convert(model, kw['batch'], kw['start'], kw['pause'])
+
+
+def convert(model, batch=1000, start=0, pause=0):
+    """Converts the rows of `model` after id `start`; returns how many."""
+    table = model._meta.db_table
+    fields = [f for f in model._meta.fields
+              if isinstance(f, StatsDictField)]
+    cursor = connection.cursor()
+    cursor.execute('SELECT MAX(id) FROM %s' % table)
+    last = cursor.fetchone()[0] or 0
+
+    began, seen, converted = time.time(), 0, 0
+    while start < last:
+        stop = start + batch
+        cursor.execute('SELECT id, %s FROM %s WHERE id > %%s AND id <= %%s'
+                       % (', '.join(f.column for f in fields), table),
+                       [start, stop])
+        rows = cursor.fetchall()
+
+        # {(columns to update): [(values..., id)]}
+        updates = {}
+        for row in rows:
+            columns, values = [], []
+            for field, value in zip(fields, row[1:]):
+                if not value or value[0] in '[{':
+                    continue
+                data = field.to_python(value)
+                # Leave anything we can't read alone.
+                if data is not None:
+                    columns.append(field.column)
+                    values.append(field.get_db_prep_value(data, connection))
+            if columns:
+                values.append(row[0])
+                updates.setdefault(tuple(columns), []).append(values)
+
+        for columns, values in updates.items():
+            cursor.executemany('UPDATE %s SET %s WHERE id=%%s' % (
+                table, ', '.join('%s=%%s' % c for c in columns)), values)
+            converted += len(values)
+        transaction.commit_unless_managed()
+
+        seen += len(rows)
+        statsd.incr('stats.convert_to_json.%s' % table,
+                    sum(len(v) for v in updates.values()))
+        elapsed = time.time() - began
+        log.info('%s: up to id %s, %s rows read, %s converted '
+                 '(%.0f rows/s).' % (table, stop, seen, converted,
+                                     seen / elapsed if elapsed else 0))
+        start = stop
+        if pause:
+            time.sleep(pause)
+    return converted
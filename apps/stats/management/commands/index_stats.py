@@ -1,13 +1,15 @@
 import logging
+import uuid
 from datetime import date, timedelta
 from optparse import make_option
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.db.models import Max, Min
 
 from celery.task.sets import TaskSet
 
 from amo.utils import chunked
+from stats import bulk, search
 from stats.models import CollectionCount, DownloadCount, UpdateCount
 from stats.tasks import (index_collection_counts, index_download_counts,
                          index_update_counts)
@@ -28,6 +30,24 @@ To limit the add-ons:
 To limit the  date range:
 
     `--date=2011-08-15` or `--date=2011-08-15:2011-08-22`
+
+To send update and download counts to elasticsearch in bulk from here
+instead of starting tasks:
+
+    `--stream`, with `--processes=4` to spread the work and `--resume` to
+    carry on from the last checkpoint of a run with the same filters.
+
+Update and download counts are read through an alias. To change their
+mapping without emptying the stats pages, stream them into a new index,
+which is made with the current mapping if it's missing, then swap it in:
+
+    `--stream --index=amo_stats_counts-2012-06-01`
+    `--swap=amo_stats_counts-2012-06-01`
+
+Days indexed by the cron while the stream ran went to the old index, so
+index those again with `--date` after the swap. The week and month series
+add up daily documents until `index_stats` without `--stream` has rebuilt
+the rollups.
 """
 
 
@@ -43,14 +63,42 @@ class Command(BaseCommand):
                          '(inclusive).'),
         make_option('--fixup', action='store_true',
                     help='Find and index rows we missed.'),
+        make_option('--stream', action='store_true',
+                    help='Index update and download counts in bulk from '
+                         'this process instead of starting tasks.'),
+        make_option('--resume', action='store_true',
+                    help='With --stream, start after the last row indexed '
+                         'by the previous run with the same --addons and '
+                         '--date.'),
+        make_option('--processes', type='int', default=1,
+                    help='With --stream, the number of processes turning '
+                         'rows into documents.'),
+        make_option('--index',
+                    help='With --stream, the new index to send update and '
+                         'download counts to.'),
+        make_option('--swap',
+                    help='Point the update and download counts alias at '
+                         'this index, and do nothing else.'),
     )
     help = HELP
 
     def handle(self, *args, **kw):
+        if kw.get('swap'):
+            old = search.swap_counts_index(kw['swap'])
+            log.info('Counts moved to %s from %s.' % (kw['swap'],
+                                                     ', '.join(old)))
+            return
+        if kw.get('index'):
+            if not kw.get('stream'):
+                raise CommandError('--index only works with --stream.')
+            search.create_counts_index(kw['index'])
+
         if kw.get('fixup'):
             fixup()
 
         addons, dates = kw['addons'], kw['date']
+        # Lets the tasks recompute each rollup once between them.
+        run = uuid.uuid4().hex
 
         queries = [
             (UpdateCount.objects, index_update_counts,
@@ -59,15 +107,20 @@ class Command(BaseCommand):
                 {'date': 'date'}),
         ]
 
-        if not addons:
+        if not (addons or kw.get('index')):
             # We can't filter this by addons, so if that is specified,
-            # we'll skip that.
+            # we'll skip that. It doesn't go in a new counts index either.
             queries.append((CollectionCount.objects, index_collection_counts,
                             {'date': 'date'}))
 
         for qs, task, fields in queries:
             date_field = fields['date']
 
+            if kw.get('stream') and qs.model in bulk.EXTRACT:
+                stream(qs.model, addons, dates, kw.get('resume'),
+                       kw.get('processes') or 1, kw.get('index'))
+                continue
+
             qs = qs.order_by('-%s' % date_field).values_list('id', flat=True)
             if addons:
                 pks = [int(a.strip()) for a in addons.split(',')]
@@ -99,13 +152,27 @@ class Command(BaseCommand):
                                   today - timedelta(days=start))
                     create_tasks(task, list(qs.filter(**{
                                             '%s__range' % date_field:
-                                            date_range})))
+                                            date_range})), rollup_run=run)
             else:
-                create_tasks(task, list(qs))
+                create_tasks(task, list(qs), rollup_run=run)
+
+
+def stream(model, addons, dates, resume, processes, index=None):
+    where, params = [], []
+    if addons:
+        pks = [int(a.strip()) for a in addons.split(',')]
+        where.append('addon_id IN (%s)' % ','.join(['%s'] * len(pks)))
+        params.extend(pks)
+    if dates:
+        start, _, stop = dates.partition(':')
+        where.append('date BETWEEN %s AND %s')
+        params.extend([start, stop or start])
+    bulk.reindex(model, ' AND '.join(where), params, resume=resume,
+                 processes=processes, index=index)
 
 
-def create_tasks(task, qs):
-    ts = [task.subtask(args=[chunk]) for chunk in chunked(qs, 50)]
+def create_tasks(task, qs, **kw):
+    ts = [task.subtask(args=[chunk], kwargs=kw) for chunk in chunked(qs, 50)]
     TaskSet(ts).apply_async()
 
 
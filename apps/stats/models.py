@@ -75,6 +75,53 @@ class UpdateCount(SearchMixin, models.Model):
         db_table = 'update_counts'
 
 
+class RollupOptions(object):
+
+    def __init__(self, db_table):
+        self.db_table = db_table
+
+
+class StatsRollup(SearchMixin):
+    """
+    Weekly or monthly totals of a daily stats model, for each add-on. These
+    only live in elasticsearch, next to the daily documents, and are kept up
+    to date by the tasks that index those.
+    """
+    model = None
+    period = None
+    # Whether the series shows the daily average (like ADUs) or the total.
+    mean = False
+
+    @classmethod
+    def _get_index(cls):
+        return cls.model._get_index()
+
+
+class DownloadCountWeek(StatsRollup):
+    model, period = DownloadCount, 'week'
+    _meta = RollupOptions('download_counts_week')
+
+
+class DownloadCountMonth(StatsRollup):
+    model, period = DownloadCount, 'month'
+    _meta = RollupOptions('download_counts_month')
+
+
+class UpdateCountWeek(StatsRollup):
+    model, period, mean = UpdateCount, 'week', True
+    _meta = RollupOptions('update_counts_week')
+
+
+class UpdateCountMonth(StatsRollup):
+    model, period, mean = UpdateCount, 'month', True
+    _meta = RollupOptions('update_counts_month')
+
+
+ROLLUPS = dict(((r.model, r.period), r) for r in
+               (DownloadCountWeek, DownloadCountMonth, UpdateCountWeek,
+                UpdateCountMonth))
+
+
 class AddonShareCount(models.Model):
     addon = models.ForeignKey('addons.Addon')
     count = models.PositiveIntegerField()
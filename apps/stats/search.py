@@ -1,11 +1,15 @@
 import collections
+from datetime import timedelta
+
+from django.core.cache import cache
 
 import elasticutils
 import pyes.exceptions as pyes
 
 import amo
 from applications.models import AppVersion
-from stats.models import CollectionCount, DownloadCount, UpdateCount
+from stats.models import (CollectionCount, DownloadCount, ROLLUPS,
+                          UpdateCount)
 
 
 def es_dict(items):
@@ -87,6 +91,101 @@ def extract_download_count(dl):
             'id': dl.id}
 
 
+def period_start(period, day):
+    """The first day of the week or month that `day` is in."""
+    if period == 'week':
+        # Weeks start on Sunday, same as the charts.
+        return day - timedelta(days=(day.weekday() + 1) % 7)
+    return day.replace(day=1)
+
+
+def period_end(period, start):
+    """The last day of the week or month starting on `start`."""
+    if period == 'week':
+        return start + timedelta(days=6)
+    next_month = (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return next_month - timedelta(days=1)
+
+
+def _add_up(totals, items):
+    for item in items:
+        totals[item['k']] = totals.get(item['k'], 0) + item['v']
+
+
+def sum_docs(docs):
+    """
+    Adds up daily update or download count documents into one, breakdowns
+    and all.
+    """
+    rv, totals = {'count': 0}, {}
+    for doc in docs:
+        rv['count'] += doc['count']
+        for field, value in doc.items():
+            if field in ('addon', 'date', 'count', 'id'):
+                continue
+            if isinstance(value, dict):
+                # apps: {guid: [{'k': app version, 'v': count}]}
+                nested = totals.setdefault(field, {})
+                for key, items in value.items():
+                    _add_up(nested.setdefault(key, {}), items)
+            else:
+                _add_up(totals.setdefault(field, {}), value)
+    for field, counts in totals.items():
+        if counts and isinstance(counts.values()[0], dict):
+            rv[field] = dict((k, es_dict(v)) for k, v in counts.items())
+        else:
+            rv[field] = es_dict(counts)
+    return rv
+
+
+def extract_rollup(rollup, addon, start, docs):
+    """The `rollup` document for `addon` out of its daily `docs`."""
+    doc = sum_docs(docs)
+    doc.update(addon=addon, date=start, days=len(docs),
+               end=period_end(rollup.period, start))
+    return doc
+
+
+# How long a reindex remembers which rollups it has done.
+ROLLUP_RUN = 60 * 60 * 24
+
+
+def index_rollups(model, days, run=None):
+    """
+    Recomputes the weekly and monthly rollups of `model` covering the
+    (addon id, date) pairs in `days`. The documents are sent in bulk, so
+    flush afterwards.
+
+    A reindex hands every task the same `run` id, so each rollup is only
+    recomputed by the first of its tasks to get to it instead of once per
+    task. Rollups are read from the db, which already has all the rows the
+    reindex was started for.
+    """
+    extract = {UpdateCount: extract_update_count,
+               DownloadCount: extract_download_count}[model]
+    for period in 'week', 'month':
+        rollup = ROLLUPS[model, period]
+        periods = collections.defaultdict(set)
+        for addon, day in days:
+            periods[period_start(period, day)].add(addon)
+        for start, addons in periods.items():
+            if run:
+                addons = [a for a in addons if cache.add(
+                    'stats:rollup:%s:%s:%s:%s' % (run, rollup._meta.db_table,
+                                                  start, a), 1, ROLLUP_RUN)]
+                if not addons:
+                    continue
+            qs = model.objects.filter(
+                addon__in=addons,
+                date__range=(start, period_end(period, start)))
+            docs = collections.defaultdict(list)
+            for obj in qs:
+                docs[obj.addon_id].append(extract(obj))
+            for addon, addon_docs in docs.items():
+                rollup.index(extract_rollup(rollup, addon, start, addon_docs),
+                             bulk=True, id='%s-%s' % (addon, start))
+
+
 def extract_addon_collection(collection_count, addon_collections,
                              collection_stats):
     addon_collection_count = sum([c.count for c in addon_collections])
@@ -110,6 +209,49 @@ def get_all_app_versions():
     return dict(rv)
 
 
+# The breakdowns in each kind of document that are lists of
+# {'k': key, 'v': count}.
+BREAKDOWNS = {UpdateCount: ('versions', 'os', 'locales', 'status'),
+              DownloadCount: ('sources',)}
+
+
+def add_breakdowns(mapping, model):
+    """
+    Keeps the breakdown keys of `model` whole instead of analyzing them, so
+    a terms facet hands back the real keys for csv columns.
+    """
+    key = {'type': 'string', 'index': 'not_analyzed'}
+    keyed = {'properties': {'k': key, 'v': {'type': 'long'}}}
+    for field in BREAKDOWNS.get(model, ()):
+        mapping['properties'][field] = keyed
+    if model is UpdateCount:
+        # apps: {guid: [{'k': app version, 'v': count}]}
+        mapping['dynamic_templates'] = [
+            {'app_versions': {'path_match': 'apps.*.k', 'mapping': key}}]
+
+
+def breakdown_keys_whole(model):
+    """
+    Whether the index maps the breakdown keys of `model` the way
+    `add_breakdowns` does. Indexes made before that tokenize them, and have
+    to be reindexed into a new index and swapped in (`index_stats --index`
+    and `--swap`) before a facet gets them right.
+    """
+    doc_type = model._meta.db_table
+    try:
+        mapping = elasticutils.get_es().get_mapping(doc_type,
+                                                    model._get_index())
+    except pyes.ElasticSearchException:
+        return False
+    mapping = mapping.get(doc_type, {})
+    properties = mapping.get('properties', {})
+    for field in BREAKDOWNS.get(model, ()):
+        key = properties.get(field, {}).get('properties', {}).get('k', {})
+        if key.get('index') != 'not_analyzed':
+            return False
+    return model is not UpdateCount or 'dynamic_templates' in mapping
+
+
 def setup_indexes():
     es = elasticutils.get_es()
     for model in CollectionCount, DownloadCount, UpdateCount:
@@ -118,20 +260,84 @@ def setup_indexes():
             es.create_index_if_missing(index)
         except pyes.ElasticSearchException:
             pass
+        es.put_mapping(model._meta.db_table, daily_mapping(model), index)
+
+    for rollup in ROLLUPS.values():
+        es.put_mapping(rollup._meta.db_table, rollup_mapping(rollup),
+                       rollup._get_index())
+
 
-        mapping = {
-            'properties': {
-                'id': {'type': 'long'},
-                'count': {'type': 'long'},
-                'data': {'dynamic': 'true',
-                         'properties': {
-                            'v': {'type': 'long'},
-                            'k': {'type': 'string'}
-                        }
-                },
-                'date': {'format': 'dateOptionalTime',
-                         'type': 'date'}
-            }
+def daily_mapping(model):
+    mapping = {
+        'properties': {
+            'id': {'type': 'long'},
+            'count': {'type': 'long'},
+            'data': {'dynamic': 'true',
+                     'properties': {
+                        'v': {'type': 'long'},
+                        'k': {'type': 'string'}
+                    }
+            },
+            'date': {'format': 'dateOptionalTime',
+                     'type': 'date'}
         }
-        es.put_mapping(model._meta.db_table, mapping,
-                       model._get_index())
+    }
+    add_breakdowns(mapping, model)
+    return mapping
+
+
+def rollup_mapping(rollup):
+    mapping = {
+        'properties': {
+            'count': {'type': 'long'},
+            'days': {'type': 'long'},
+            'date': {'format': 'dateOptionalTime', 'type': 'date'},
+            'end': {'format': 'dateOptionalTime', 'type': 'date'},
+        }
+    }
+    add_breakdowns(mapping, rollup.model)
+    return mapping
+
+
+# Update and download counts, and their rollups, are read and written
+# through UpdateCount._get_index(), an alias that can be moved to a new
+# index once a reindex has filled it.
+COUNTS = (DownloadCount, UpdateCount)
+
+
+def counts_types():
+    return list(COUNTS) + [r for r in ROLLUPS.values() if r.model in COUNTS]
+
+
+def create_counts_index(index):
+    """
+    Makes `index` with the current update and download count mappings, for
+    `index_stats --stream --index` to fill while the alias still points at
+    the old one.
+    """
+    es = elasticutils.get_es()
+    es.create_index_if_missing(index)
+    for type_ in counts_types():
+        mapping = (daily_mapping(type_) if type_ in COUNTS
+                   else rollup_mapping(type_))
+        es.put_mapping(type_._meta.db_table, mapping, index)
+
+
+def swap_counts_index(index):
+    """
+    Points the update and download counts alias at `index` and drops the
+    counts from the index it pointed at before, which can still hold other
+    stats.
+    """
+    es = elasticutils.get_es()
+    alias = UpdateCount._get_index()
+    old = [i for i in es.get_alias(alias) if i != index]
+    es.change_aliases([('remove', i, alias) for i in old] +
+                      [('add', index, alias)])
+    for i in old:
+        for type_ in counts_types():
+            try:
+                es.delete_mapping(i, type_._meta.db_table)
+            except pyes.ElasticSearchException:
+                pass
+    return old
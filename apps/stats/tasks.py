@@ -196,6 +196,9 @@ def index_update_counts(ids, **kw):
             key = '%s-%s' % (update.addon_id, update.date)
             UpdateCount.index(search.extract_update_count(update),
                               bulk=True, id=key)
+        search.index_rollups(UpdateCount,
+                             [(u.addon_id, u.date) for u in qs],
+                             run=kw.get('rollup_run'))
         es.flush_bulk(forced=True)
     except Exception, exc:
         index_update_counts.retry(args=[ids], exc=exc)
@@ -205,7 +208,7 @@ def index_update_counts(ids, **kw):
 @task
 def index_download_counts(ids, **kw):
     es = elasticutils.get_es()
-    qs = DownloadCount.objects.filter(id__in=ids)
+    qs = list(DownloadCount.objects.filter(id__in=ids))
     if qs:
         log.info('Indexing %s downloads for %s.' % (len(qs), qs[0].date))
     try:
@@ -213,6 +216,9 @@ def index_download_counts(ids, **kw):
             key = '%s-%s' % (dl.addon_id, dl.date)
             DownloadCount.index(search.extract_download_count(dl),
                                 bulk=True, id=key)
+        search.index_rollups(DownloadCount,
+                             [(d.addon_id, d.date) for d in qs],
+                             run=kw.get('rollup_run'))
         es.flush_bulk(forced=True)
     except Exception, exc:
         index_download_counts.retry(args=[ids], exc=exc)
@@ -0,0 +1,158 @@
+import json
+import shutil
+import tempfile
+
+from django.conf import settings
+
+import mock
+from nose.tools import eq_
+
+import amo.tests
+from stats import bulk, search
+from stats.models import DownloadCount, UpdateCount
+
+
+class TestBulk(amo.tests.TestCase):
+    fixtures = ['stats/test_models']
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        patcher = mock.patch.object(settings, 'ES_BULK_CHECKPOINT_PATH',
+                                    self.tmp)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def bodies(self, post):
+        return [c[0][1] for c in post.call_args_list]
+
+    def ids(self, post):
+        ids = []
+        for body in self.bodies(post):
+            lines = body.splitlines()
+            ids.extend(json.loads(line)['id'] for line in lines[1::2])
+        return ids
+
+    def test_read(self):
+        batches = list(bulk.read(DownloadCount, size=3))
+        eq_([len(rows) for rows in batches], [3, 3, 3, 1])
+        ids = [row[0] for rows in batches for row in rows]
+        eq_(ids, sorted(DownloadCount.objects.values_list('id', flat=True)))
+
+    def test_read_where(self):
+        rows = list(bulk.read(DownloadCount, where='addon_id = %s',
+                              params=[5]))[0]
+        eq_(len(rows), DownloadCount.objects.filter(addon=5).count())
+
+    def test_transform(self):
+        rows = list(bulk.read(UpdateCount))[0]
+        last_id, count, body = bulk.transform((UpdateCount, rows, None))
+        eq_(count, 3)
+        eq_(last_id, rows[-1][0])
+        lines = body.splitlines()
+        eq_(len(lines), 6)
+
+        update = UpdateCount.objects.get(id=rows[0][0])
+        eq_(json.loads(lines[0]),
+            {'index': {'_index': UpdateCount._get_index(),
+                       '_type': 'update_counts',
+                       '_id': '%s-%s' % (update.addon_id, update.date)}})
+        doc = json.loads(lines[1])
+        expected = search.extract_update_count(update)
+        eq_(doc['date'], update.date.isoformat())
+        eq_(doc['count'], expected['count'])
+        eq_(sorted(doc['os']), sorted(expected['os']))
+
+    def test_transform_index(self):
+        rows = list(bulk.read(UpdateCount))[0]
+        body = bulk.transform((UpdateCount, rows, 'new_counts'))[2]
+        eq_(json.loads(body.splitlines()[0])['index']['_index'],
+            'new_counts')
+
+    @mock.patch.object(bulk.BulkWriter, 'post')
+    def test_reindex(self, post):
+        with mock.patch.object(settings, 'ES_BULK_SIZE', 4):
+            eq_(bulk.reindex(DownloadCount), 10)
+        eq_(post.call_count, 3)
+        eq_(sorted(self.ids(post)),
+            sorted(DownloadCount.objects.values_list('id', flat=True)))
+        eq_(bulk.Checkpoint(DownloadCount).get(), max(self.ids(post)))
+
+    @mock.patch.object(bulk.BulkWriter, 'post')
+    def test_resume(self, post):
+        ids = sorted(DownloadCount.objects.values_list('id', flat=True))
+        bulk.Checkpoint(DownloadCount).set(ids[5])
+        eq_(bulk.reindex(DownloadCount, resume=True), 4)
+        eq_(sorted(self.ids(post)), ids[6:])
+
+    @mock.patch.object(bulk.BulkWriter, 'post')
+    def test_resume_filtered(self, post):
+        # A filtered run's checkpoint doesn't carry over to other runs.
+        bulk.Checkpoint(DownloadCount, 'addon_id = %s', [5]).set(1000)
+        eq_(bulk.reindex(DownloadCount, resume=True), 10)
+        eq_(bulk.Checkpoint(DownloadCount, 'addon_id = %s', [5]).get(), 1000)
+        eq_(bulk.reindex(DownloadCount, 'addon_id = %s', [5], resume=True), 0)
+
+    @mock.patch.object(bulk.BulkWriter, 'post')
+    def test_resume_index(self, post):
+        # Neither does a run into another index.
+        bulk.Checkpoint(DownloadCount).set(1000)
+        eq_(bulk.reindex(DownloadCount, resume=True, index='new_counts'), 10)
+        eq_(bulk.Checkpoint(DownloadCount).get(), 1000)
+
+    @mock.patch.object(bulk.BulkWriter, 'post')
+    def test_no_resume(self, post):
+        bulk.Checkpoint(DownloadCount).set(1000)
+        eq_(bulk.reindex(DownloadCount), 10)
+
+    def test_checkpoint_in_order(self):
+        checkpoint = mock.Mock()
+        writer = bulk.BulkWriter(checkpoint, in_flight=1)
+        writer._done(1, 20, 5)
+        assert not checkpoint.set.called
+        writer._done(0, 10, 5)
+        checkpoint.set.assert_called_with(20)
+        writer._done(2, 30, 5)
+        checkpoint.set.assert_called_with(30)
+        eq_(writer.indexed, 15)
+        writer.close()
+
+    @mock.patch.object(bulk.BulkWriter, 'post')
+    def test_retry(self, post):
+        responses = [bulk.BulkError(), {}]
+
+        def side_effect(host, body):
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        post.side_effect = side_effect
+        checkpoint = mock.Mock()
+        writer = bulk.BulkWriter(checkpoint, in_flight=1, backoff=0)
+        writer.send(10, 5, 'body')
+        writer.close()
+        eq_(post.call_count, 2)
+        checkpoint.set.assert_called_with(10)
+
+    @mock.patch.object(bulk.BulkWriter, 'post')
+    def test_give_up(self, post):
+        post.side_effect = bulk.BulkError()
+        checkpoint = mock.Mock()
+        writer = bulk.BulkWriter(checkpoint, in_flight=1, retries=2,
+                                 backoff=0)
+        writer.send(10, 5, 'body')
+        with self.assertRaises(bulk.BulkError):
+            writer.close()
+        eq_(post.call_count, 3)
+        assert not checkpoint.set.called
+
+    @mock.patch('stats.bulk.urllib2.urlopen')
+    def test_post_errors(self, urlopen):
+        urlopen.return_value.read.return_value = json.dumps(
+            {'items': [{'index': {'_id': '1', 'ok': True}},
+                       {'index': {'_id': '2', 'error': 'nope'}}]})
+        writer = bulk.BulkWriter(in_flight=1)
+        with self.assertRaises(bulk.BulkError):
+            writer.post('localhost:9200', 'body')
+        writer.close()
@@ -121,6 +121,28 @@ class TestIndexStats(amo.tests.TestCase):
         eq_(len([c for c in calls if c[0][0] == tasks.index_download_counts]),
             1 + (downloads[0] - downloads[-1]).days / 5)
 
+    @mock.patch('stats.management.commands.index_stats.bulk.reindex')
+    def test_stream(self, reindex, tasks_mock):
+        call_command('index_stats', addons='4, 5', date='2009-06-01',
+                     stream=True, processes=2)
+        eq_([c[0][0] for c in reindex.call_args_list],
+            [UpdateCount, DownloadCount])
+        eq_(reindex.call_args[0][1:],
+            ('addon_id IN (%s,%s) AND date BETWEEN %s AND %s',
+             [4, 5, '2009-06-01', '2009-06-01']))
+        eq_(reindex.call_args[1], {'resume': None, 'processes': 2})
+        assert not tasks_mock.called
+
+    @mock.patch('stats.management.commands.index_stats.bulk.reindex')
+    def test_stream_collections(self, reindex, tasks_mock):
+        call_command('index_stats', addons=None, date='2009-06-01',
+                     stream=True, resume=True)
+        eq_(reindex.call_count, 2)
+        eq_(reindex.call_args[1], {'resume': True, 'processes': 1})
+        # Collection counts still go through tasks.
+        eq_(tasks_mock.call_count, 1)
+        eq_(tasks_mock.call_args[0][0], tasks.index_collection_counts)
+
 
 class TestIndexLatest(amo.tests.ESTestCase):
     es = True
@@ -4,17 +4,20 @@ import json
 
 from django.conf import settings
 from django.core import mail
-from django.db import models
+from django.core.management import call_command
+from django.db import connection, models
 from django.utils import translation
 
+import mock
 import phpserialize as php
 from nose.tools import eq_
 
 import amo
 import amo.tests
 from addons.models import Addon
-from stats.models import Contribution
-from stats.db import StatsDictField
+from stats.management.commands.convert_stats_to_json import convert
+from stats.models import Contribution, UpdateCount
+from stats.db import StatsDictField, unserialize
 from users.models import UserProfile
 from market.models import Refund
 
@@ -34,6 +37,74 @@ class TestStatsDictField(amo.tests.TestCase):
         val = {'a': 1}
         eq_(StatsDictField().to_python(json.dumps(val)), val)
 
+    def test_to_python_php_nested(self):
+        val = {'{ec8030f7-c20a-464f-9b0e-13a3a9e97384}': {'3.6': 10},
+               'x': 1.5, 'y': None, 3: True}
+        eq_(StatsDictField().to_python(php.serialize(val)), val)
+
+    def test_to_python_php_unicode(self):
+        val = {u'ñandú': 1, u'a";i:2;': 3}
+        eq_(StatsDictField().to_python(php.serialize(val)), val)
+
+    def test_to_python_php_fallback(self):
+        # phpserialize doesn't mind upper case types, we leave those to it.
+        eq_(StatsDictField().to_python('A:1:{s:1:"a";I:1;}'), {'a': 1})
+
+    def test_to_python_garbage(self):
+        eq_(StatsDictField().to_python('a:2:{s:1:"a";i:1;'), None)
+        eq_(StatsDictField().to_python(''), None)
+
+    def test_unserialize(self):
+        for val in ({}, {'a': 1, 'b': -2}, {'a': {'b': {'c': 1}}},
+                    {u'é': u'ü'}):
+            eq_(unserialize(php.serialize(val)),
+                php.unserialize(php.serialize(val), decode_strings=True))
+
+    def test_lazy(self):
+        update = UpdateCount(versions=php.serialize({'1.0': 5}))
+        assert isinstance(update.__dict__['versions'], basestring)
+        with mock.patch.object(StatsDictField, 'to_python') as to_python:
+            to_python.return_value = {'1.0': 5}
+            eq_(update.versions, {'1.0': 5})
+            eq_(update.versions, {'1.0': 5})
+            eq_(to_python.call_count, 1)
+
+    def test_lazy_set(self):
+        update = UpdateCount(versions=None)
+        eq_(update.versions, None)
+        update.versions = {'1.0': 5}
+        eq_(update.versions, {'1.0': 5})
+
+
+class TestConvertToJson(amo.tests.TestCase):
+    fixtures = ['stats/test_models']
+
+    def setUp(self):
+        self.update = UpdateCount.objects.all()[0]
+        self.versions = self.update.versions
+        cursor = connection.cursor()
+        cursor.execute('UPDATE update_counts SET version=%s, os=%s '
+                       'WHERE id=%s', [php.serialize(self.versions), 'bad',
+                                       self.update.id])
+
+    def raw(self, column):
+        cursor = connection.cursor()
+        cursor.execute('SELECT %s FROM update_counts WHERE id=%%s' % column,
+                       [self.update.id])
+        return cursor.fetchone()[0]
+
+    def test_convert(self):
+        assert self.raw('version').startswith('a:')
+        call_command('convert_stats_to_json', batch=1)
+        eq_(json.loads(self.raw('version')), self.versions)
+        # We don't know what to do with it, so it's left alone.
+        eq_(self.raw('os'), 'bad')
+
+    def test_convert_start(self):
+        eq_(convert(UpdateCount, start=self.update.id), 0)
+        eq_(convert(UpdateCount, start=self.update.id - 1), 1)
+        eq_(json.loads(self.raw('version')), self.versions)
+
 
 class TestContributionModel(amo.tests.TestCase):
     fixtures = ['stats/test_models.json']
@@ -4,6 +4,8 @@ import datetime
 from decimal import Decimal
 import json
 
+from django.core.serializers.json import DjangoJSONEncoder
+
 import mock
 from nose.tools import eq_
 from pyquery import PyQuery as pq
@@ -15,7 +17,7 @@ from bandwagon.models import Collection
 from stats import views, tasks
 from stats import search
 from stats.models import (CollectionCount, DownloadCount, GlobalStat,
-                          UpdateCount)
+                          ROLLUPS, UpdateCount)
 from users.models import UserProfile
 
 
@@ -705,6 +707,146 @@ class TestResponses(ESStatsTest):
                           2009-06-07,10,3,2
                           2009-06-01,10,3,2""")
 
+    @mock.patch.object(views, 'keys_whole', lambda model: False)
+    def test_downloads_sources_csv_analyzed_keys(self):
+        # Indexes from before the keys were kept whole.
+        r = self.get_view_response('stats.sources_series', group='day',
+                                   format='csv')
+        eq_(r.status_code, 200)
+        self.csv_eq(r, """date,count,search,api
+                          2009-09-03,10,3,2
+                          2009-08-03,10,3,2
+                          2009-07-03,10,3,2
+                          2009-06-28,10,3,2
+                          2009-06-20,10,3,2
+                          2009-06-12,10,3,2
+                          2009-06-07,10,3,2
+                          2009-06-01,10,3,2""")
+
+    def test_facet_fields_ok(self):
+        start = datetime.date(2009, 6, 1)
+        with mock.patch.object(views, 'keys_whole') as keys_whole:
+            keys_whole.return_value = True
+            assert views.facet_fields_ok(
+                UpdateCount, (start, start + datetime.timedelta(days=364)))
+            # More days than a series holds.
+            assert not views.facet_fields_ok(
+                UpdateCount, (start, start + datetime.timedelta(days=365)))
+            keys_whole.return_value = False
+            assert not views.facet_fields_ok(UpdateCount, (start, start))
+
+    def test_breakdown_keys_whole(self):
+        # The test indexes are set up with the current mapping.
+        assert search.breakdown_keys_whole(UpdateCount)
+        assert search.breakdown_keys_whole(DownloadCount)
+
+    def test_downloads_month_json(self):
+        r = self.get_view_response('stats.downloads_series', group='month',
+                                   format='json')
+        eq_(r.status_code, 200)
+        self.assertListEqual(json.loads(r.content), [
+            {"count": 10, "date": "2009-09-01", "end": "2009-09-30"},
+            {"count": 10, "date": "2009-08-01", "end": "2009-08-31"},
+            {"count": 10, "date": "2009-07-01", "end": "2009-07-31"},
+            {"count": 50, "date": "2009-06-01", "end": "2009-06-30"},
+        ])
+
+    def test_downloads_month_without_rollups(self):
+        # A --stream reindex only writes the daily documents.
+        rollup = ROLLUPS[DownloadCount, 'month']
+        with mock.patch.object(rollup, 'search') as search_:
+            search_.return_value = mock.MagicMock()
+            r = self.get_view_response('stats.downloads_series',
+                                       group='month', format='json')
+        eq_(r.status_code, 200)
+        self.assertListEqual(json.loads(r.content), [
+            {"count": 10, "date": "2009-09-01", "end": "2009-09-30"},
+            {"count": 10, "date": "2009-08-01", "end": "2009-08-31"},
+            {"count": 10, "date": "2009-07-01", "end": "2009-07-31"},
+            {"count": 50, "date": "2009-06-01", "end": "2009-06-30"},
+        ])
+
+    def test_downloads_week_json(self):
+        # The range starts on a Monday, so the first week is cut short.
+        r = self.get_view_response('stats.downloads_series', group='week',
+                                   format='json')
+        eq_(r.status_code, 200)
+        self.assertListEqual(json.loads(r.content), [
+            {"count": 10, "date": "2009-08-30", "end": "2009-09-05"},
+            {"count": 10, "date": "2009-08-02", "end": "2009-08-08"},
+            {"count": 20, "date": "2009-06-28", "end": "2009-07-04"},
+            {"count": 10, "date": "2009-06-14", "end": "2009-06-20"},
+            {"count": 20, "date": "2009-06-07", "end": "2009-06-13"},
+            {"count": 10, "date": "2009-06-01", "end": "2009-06-06"},
+        ])
+
+    def test_downloads_sources_week_json(self):
+        r = self.get_view_response('stats.sources_series', group='week',
+                                   format='json', end='20090620')
+        eq_(r.status_code, 200)
+        self.assertListEqual(json.loads(r.content), [
+            {"count": 10, "date": "2009-06-14", "end": "2009-06-20",
+             "data": {"api": 2, "search": 3}},
+            {"count": 20, "date": "2009-06-07", "end": "2009-06-13",
+             "data": {"api": 4, "search": 6}},
+            {"count": 10, "date": "2009-06-01", "end": "2009-06-06",
+             "data": {"api": 2, "search": 3}},
+        ])
+
+    def test_usage_month_json(self):
+        # Usage is the daily average.
+        r = self.get_view_response('stats.usage_series', group='month',
+                                   format='json')
+        eq_(r.status_code, 200)
+        self.assertListEqual(json.loads(r.content), [
+            {"count": 1250, "date": "2009-06-01", "end": "2009-06-30"},
+        ])
+
+    def test_usage_by_app_week_json(self):
+        r = self.get_view_response('stats.apps_series', group='week',
+                                   format='json')
+        eq_(r.status_code, 200)
+        self.assertListEqual(json.loads(r.content), [
+            {
+                "data": {
+                    "{ec8030f7-c20a-464f-9b0e-13a3a9e97384}": {"4.0": 1250}
+                },
+                "count": 1250,
+                "date": "2009-06-01",
+                "end": "2009-06-06"
+            },
+        ])
+
+    def test_overview_month(self):
+        r = self.get_view_response('stats.overview_series', group='month',
+                                   format='json')
+        eq_(r.status_code, 200)
+        eq_(json.loads(r.content)[-1],
+            {"date": "2009-06-01", "end": "2009-06-30",
+             "data": {"downloads": 50, "updates": 1250}})
+
+    def test_series_fields(self):
+        date_range = (datetime.date(2009, 6, 1), datetime.date(2009, 9, 30))
+        eq_(views.series_fields(UpdateCount, 'locales', addon=4,
+                                date__range=date_range),
+            set(['el', 'en-us']))
+        eq_(views.series_fields(UpdateCount, 'apps', addon=4,
+                                date__range=date_range),
+            {'{ec8030f7-c20a-464f-9b0e-13a3a9e97384}': set(['4.0'])})
+        eq_(views.series_fields(DownloadCount, 'sources', addon=4,
+                                date__range=date_range),
+            set(['api', 'search']))
+
+    def test_empty_series_not_cached(self):
+        r = self.get_view_response('stats.downloads_series', group='day',
+                                   format='json', start='20100101',
+                                   end='20100201')
+        eq_(json.loads(r.content), [])
+        eq_(r['Cache-Control'], 'max-age=0')
+        r = self.get_view_response('stats.downloads_series', group='day',
+                                   format='json')
+        eq_(r['Cache-Control'], 'max-age=604800')
+
     def test_contributions_series_json(self):
         r = self.get_view_response('stats.contributions_series', group='day',
                                    format='json')
@@ -735,6 +877,136 @@ class TestResponses(ESStatsTest):
                           2009-06-01,1,5.0,5.0""")
 
 
+class TestStreaming(amo.tests.TestCase):
+
+    def setUp(self):
+        self.rows = [{'date': datetime.date(2009, 6, day), 'count': day,
+                      'data': {'a': day}} for day in range(1, 6)]
+
+    def test_peek(self):
+        first, rows = views.peek(iter(self.rows))
+        eq_(first, self.rows[0])
+        eq_(list(rows), self.rows)
+        first, rows = views.peek(iter([]))
+        eq_(first, None)
+        eq_(list(rows), [])
+
+    @mock.patch.object(views, 'STREAM_ROWS', 2)
+    def test_stream_json(self):
+        chunks = list(views.stream_json(iter(self.rows)))
+        eq_(len(chunks), 3)
+        eq_(json.loads(''.join(chunks)),
+            json.loads(json.dumps(self.rows, cls=DjangoJSONEncoder)))
+        eq_(list(views.stream_json(iter([]))), ['[]'])
+
+    @mock.patch.object(views, 'STREAM_ROWS', 2)
+    def test_stream_csv(self):
+        rows = views.csv_rows(iter(self.rows))
+        chunks = list(views.stream_csv(u'# header\n', rows,
+                                       ['date', 'count', 'a']))
+        eq_(len(chunks), 3)
+        lines = ''.join(chunks).splitlines()
+        eq_(lines[:3], ['# header', 'date,count,a', '2009-06-01,1,1'])
+        eq_(len(lines), 7)
+
+
+class TestRollups(amo.tests.TestCase):
+
+    def test_period_start(self):
+        eq_(search.period_start('week', datetime.date(2009, 6, 3)),
+            datetime.date(2009, 5, 31))
+        eq_(search.period_start('week', datetime.date(2009, 5, 31)),
+            datetime.date(2009, 5, 31))
+        eq_(search.period_start('month', datetime.date(2009, 6, 3)),
+            datetime.date(2009, 6, 1))
+
+    def test_period_end(self):
+        eq_(search.period_end('week', datetime.date(2009, 5, 31)),
+            datetime.date(2009, 6, 6))
+        eq_(search.period_end('month', datetime.date(2009, 2, 1)),
+            datetime.date(2009, 2, 28))
+        eq_(search.period_end('month', datetime.date(2009, 12, 1)),
+            datetime.date(2009, 12, 31))
+
+    def test_sum_docs(self):
+        docs = [{'addon': 4, 'date': None, 'id': 1, 'count': 3,
+                 'os': search.es_dict({'Linux': 1, 'Mac': 2}),
+                 'apps': {'a': search.es_dict({'4.0': 3})}},
+                {'addon': 4, 'date': None, 'id': 2, 'count': 5,
+                 'os': search.es_dict({'Linux': 5}),
+                 'apps': []}]
+        doc = search.sum_docs(docs)
+        eq_(doc['count'], 8)
+        eq_(views.extract(doc['os']), {'Linux': 6, 'Mac': 2})
+        eq_(views.extract(doc['apps']), {'a': {'4.0': 3}})
+
+    def test_sum_days(self):
+        days = [dict(date=datetime.date(2009, 6, d), count=d,
+                     data={'a': {'b': 1}}) for d in (20, 9, 2, 1)]
+        ranges = [(datetime.date(2009, 6, 20), datetime.date(2009, 6, 30)),
+                  (datetime.date(2009, 6, 1), datetime.date(2009, 6, 6))]
+        with mock.patch.object(views, 'daily_series') as daily:
+            daily.return_value = days
+            rows = views.sum_days(UpdateCount, 'apps', ranges, {})
+        # One year at a time covers both.
+        eq_(daily.call_count, 1)
+        eq_(sorted(rows, key=lambda r: r['date']), [
+            {'date': ranges[1][0], 'end': ranges[1][1], 'count': 3,
+             'days': 2, 'data': {'a': {'b': 2}}},
+            {'date': ranges[0][0], 'end': ranges[0][1], 'count': 20,
+             'days': 1, 'data': {'a': {'b': 1}}}])
+
+    def test_average(self):
+        eq_(views.average(5, 2), 3)
+        eq_(views.average({'a': {'b': 3}, 'c': 1}, 3), {'a': {'b': 1},
+                                                       'c': 0})
+
+
+class TestIndexRollups(amo.tests.TestCase):
+    fixtures = ['stats/test_models']
+
+    def test_once_per_run(self):
+        dl = DownloadCount.objects.all()[0]
+        days = [(dl.addon_id, dl.date)]
+        week = ROLLUPS[DownloadCount, 'week']
+        month = ROLLUPS[DownloadCount, 'month']
+        with mock.patch.object(week, 'index') as index:
+            with mock.patch.object(month, 'index'):
+                search.index_rollups(DownloadCount, days, run='a')
+                search.index_rollups(DownloadCount, days, run='a')
+                eq_(index.call_count, 1)
+                search.index_rollups(DownloadCount, days, run='b')
+                eq_(index.call_count, 2)
+                search.index_rollups(DownloadCount, days)
+                eq_(index.call_count, 3)
+
+
+class TestCountsIndex(amo.tests.TestCase):
+
+    @mock.patch('stats.search.elasticutils')
+    def test_create(self, elasticutils):
+        es = elasticutils.get_es.return_value
+        search.create_counts_index('new')
+        es.create_index_if_missing.assert_called_with('new')
+        calls = [c[0] for c in es.put_mapping.call_args_list]
+        eq_(sorted(doc_type for doc_type, _, _ in calls),
+            sorted(t._meta.db_table for t in search.counts_types()))
+        eq_(set(index for _, _, index in calls), set(['new']))
+
+    @mock.patch('stats.search.elasticutils')
+    def test_swap(self, elasticutils):
+        es = elasticutils.get_es.return_value
+        es.get_alias.return_value = ['old']
+        alias = UpdateCount._get_index()
+        eq_(search.swap_counts_index('new'), ['old'])
+        es.change_aliases.assert_called_with([('remove', 'old', alias),
+                                              ('add', 'new', alias)])
+        # Only the counts go, whatever else is in the old index stays.
+        eq_(sorted(c[0] for c in es.delete_mapping.call_args_list),
+            sorted(('old', t._meta.db_table)
+                   for t in search.counts_types()))
+
+
 # Test the SQL query by using known dates, for weeks and months etc.
 class TestSiteQuery(amo.tests.TestCase):
 
@@ -1,8 +1,8 @@
+import bisect
 import csv
 import cStringIO
 import itertools
 import time
-from types import GeneratorType
 from datetime import date, timedelta
 
 from django import http
@@ -32,7 +32,9 @@ from amo.urlresolvers import reverse
 from amo.utils import memoize
 
 from .decorators import allow_cross_site_request
-from .models import CollectionCount, Contribution, DownloadCount, UpdateCount
+from .models import (CollectionCount, Contribution, DownloadCount, ROLLUPS,
+                     UpdateCount)
+from .search import breakdown_keys_whole, period_end, period_start
 
 SERIES_GROUPS = ('day', 'week', 'month')
 SERIES_GROUPS_DATE = ('date', 'week', 'month')  # Backwards compat.
@@ -43,6 +45,8 @@ COLLECTION_SERIES = ('downloads', 'subscribers', 'ratings')
 GLOBAL_SERIES = ('addons_in_use', 'addons_updated', 'addons_downloaded',
                  'collections_created', 'reviews_created', 'addons_created',
                  'users_created')
+# How many rows to write out at a time when streaming a series.
+STREAM_ROWS = 100
 
 
 def dashboard(request):
@@ -54,14 +58,26 @@ def dashboard(request):
                          'stats_base_url': stats_base_url})
 
 
-def get_series(model, extra_field=None, **filters):
+def get_series(model, extra_field=None, group=None, **filters):
     """
     Get a generator of dicts for the stats model given by the filters.
 
     Returns {'date': , 'count': } by default. Add an extra field (such as
     application faceting) by passing `extra_field=apps`. `apps` should be in
     the query result.
+
+    With a `group` of week or month and a `date__range`, there's a row for
+    each period instead, read from the rollups where there are any. Its
+    `date` and `end` are the first and last day of the period in the range.
     """
+    if group in ('week', 'month') and 'date__range' in filters:
+        if (model, group) in ROLLUPS:
+            return rollup_series(ROLLUPS[model, group], extra_field,
+                                 **filters)
+    return daily_series(model, extra_field, **filters)
+
+
+def daily_series(model, extra_field=None, **filters):
     extra = () if extra_field is None else (extra_field,)
     # Put a slice on it so we get more than 10 (the default), but limit to 365.
     qs = (model.search().order_by('-date').filter(**filters)
@@ -75,6 +91,106 @@ def get_series(model, extra_field=None, **filters):
         yield rv
 
 
+def rollup_series(rollup, extra_field=None, **filters):
+    """
+    Rows for each period of `rollup` in the `date__range` filter, newest
+    first. The periods at either end that are only partly in the range, and
+    any whole period without a rollup document (like after a --stream
+    reindex, which only writes daily documents), are added up from the daily
+    rows.
+    """
+    start, end = filters.pop('date__range')
+    extra = () if extra_field is None else (extra_field,)
+    rows, partial = [], []
+    day, whole = period_start(rollup.period, start), []
+    while day <= end:
+        last = period_end(rollup.period, day)
+        if start <= day and last <= end:
+            whole.append(day)
+        else:
+            partial.append((max(day, start), min(last, end)))
+        day = last + timedelta(days=1)
+
+    if whole:
+        qs = (rollup.search().order_by('-date')
+              .filter(date__range=(whole[0], whole[-1]), **filters)
+              .values_dict('date', 'count', 'days', *extra))[:365]
+        for val in qs:
+            date_ = date(*val['date'].timetuple()[:3])
+            row = dict(count=val['count'], days=val['days'], date=date_,
+                       end=period_end(rollup.period, date_))
+            if extra_field:
+                row['data'] = extract(val[extra_field])
+            rows.append(row)
+        found = set(row['date'] for row in rows)
+        partial.extend((day, period_end(rollup.period, day))
+                       for day in whole if day not in found)
+
+    rows.extend(sum_days(rollup.model, extra_field, partial, filters))
+    rows.sort(key=lambda row: row['date'], reverse=True)
+    for row in rows:
+        days = row.pop('days')
+        if rollup.mean:
+            row['count'] = average(row['count'], days)
+            if extra_field:
+                row['data'] = average(row['data'], days)
+        yield row
+
+
+def sum_days(model, extra_field, ranges, filters):
+    """
+    A row for each (first day, last day) in `ranges` that has any daily rows
+    of `model`, with their counts added up. The days are read a year at a
+    time, the most `daily_series` returns, not a query per range.
+    """
+    ranges = sorted(ranges)
+    if not ranges:
+        return []
+    spans = [list(ranges[0])]
+    for first, last in ranges[1:]:
+        if (last - spans[-1][0]).days < 365:
+            spans[-1][1] = last
+        else:
+            spans.append([first, last])
+
+    starts = [first for first, _ in ranges]
+    rows = {}
+    for span in spans:
+        for day in daily_series(model, extra_field,
+                                date__range=tuple(span), **filters):
+            i = bisect.bisect_right(starts, day['date']) - 1
+            if i < 0 or day['date'] > ranges[i][1]:
+                # One of the days in between with a rollup of its own.
+                continue
+            if i not in rows:
+                rows[i] = dict(count=0, days=0, date=ranges[i][0],
+                               end=ranges[i][1])
+                if extra_field:
+                    rows[i]['data'] = {}
+            row = rows[i]
+            row['count'] += day['count']
+            row['days'] += 1
+            if extra_field:
+                add_counts(row['data'], day['data'])
+    return rows.values()
+
+
+def add_counts(totals, counts):
+    """Adds the (nested) dict of `counts` into `totals`."""
+    for key, value in counts.items():
+        if isinstance(value, dict):
+            add_counts(totals.setdefault(key, {}), value)
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+
+def average(counts, days):
+    """Daily average of a count or a (nested) dict of counts."""
+    if hasattr(counts, 'items'):
+        return dict((k, average(v, days)) for k, v in counts.items())
+    return int(round(float(counts) / days)) if days else 0
+
+
 def csv_fields(series):
     """
     Figure out all the keys in the `data` dict for csv columns.
@@ -91,6 +207,62 @@ def csv_fields(series):
     return rv, fields
 
 
+def csv_rows(series):
+    """
+    The `data` dicts of a series, plus `count` and `date` from the top level,
+    one at a time. Get the columns from `series_fields`.
+    """
+    for row in series:
+        row['data'].update(count=row['count'], date=row['date'])
+        yield row['data']
+
+
+def facet_fields_ok(model, date_range):
+    """
+    Whether `series_fields` gets the csv columns of a `model` breakdown
+    right for `date_range`. The index has to keep the keys whole, which
+    indexes made before `add_breakdowns` in search.py don't. Also, the range
+    can't hold more days than a series is cut off at, or the facet would
+    add columns for rows that aren't in it. Otherwise use `csv_fields`.
+    """
+    start, end = date_range
+    return (end - start).days < 365 and keys_whole(model)
+
+
+@memoize(prefix='stats_breakdown_keys', time=60 * 60)
+def keys_whole(model):
+    # Mappings only change when the indexes are set up again.
+    return breakdown_keys_whole(model)
+
+
+def series_fields(model, field, **filters):
+    """
+    All the keys of the `field` breakdown in a series, for csv columns.
+
+    This is a terms facet over the series instead of a pass through all of
+    it. Applications come back as {app guid: set of app versions}.
+    """
+    start, end = filters.pop('date__range')
+    qs = model.search().query(date__gte=start, date__lte=end, **filters)
+    if field == 'apps':
+        guids = amo.APP_GUIDS.keys()
+        names = dict(('app%s' % idx, guid) for idx, guid in enumerate(guids))
+        paths = dict((name, 'apps.%s.k' % guid)
+                     for name, guid in names.items())
+    else:
+        paths = {field: '%s.k' % field}
+    facets = dict((name, {'terms': {'field': path, 'size': 10000}})
+                  for name, path in paths.items())
+    results = qs.facet(**facets)[:0].raw().get('facets', {})
+    keys = dict((name, set(t['term'] for t in results.get(name, {})
+                                                     .get('terms', [])))
+                for name in paths)
+    if field == 'apps':
+        return dict((names[name], versions)
+                    for name, versions in keys.items() if versions)
+    return keys[field]
+
+
 def extract(dicts):
     """Turn a list of dicts like we store in ES into one big dict.
 
@@ -110,10 +282,15 @@ def overview_series(request, addon, group, start, end, format):
     date_range = check_series_params_or_404(group, start, end, format)
     check_stats_permission(request, addon)
 
-    dls = get_series(DownloadCount, addon=addon.id, date__range=date_range)
-    updates = get_series(UpdateCount, addon=addon.id, date__range=date_range)
+    dls = get_series(DownloadCount, addon=addon.id, group=group,
+                     date__range=date_range)
+    updates = get_series(UpdateCount, addon=addon.id, group=group,
+                         date__range=date_range)
 
-    series = zip_overview(dls, updates)
+    if group == 'day':
+        series = zip_overview(dls, updates)
+    else:
+        series = zip_overview_periods(dls, updates)
 
     return render_json(request, addon, series)
 
@@ -121,16 +298,16 @@ def overview_series(request, addon, group, start, end, format):
 def zip_overview(downloads, updates):
     # Jump through some hoops to make sure we're matching dates across download
     # and update series and inserting zeroes for any missing days.
-    downloads, updates = list(downloads), list(updates)
-    if not (downloads or updates):
+    first_download, downloads = peek(downloads)
+    first_update, updates = peek(updates)
+    if not (first_download or first_update):
         return
     start_date = None
-    if downloads:
-        start_date = downloads[0]['date']
-    if updates:
-        d = updates[0]['date']
+    if first_download:
+        start_date = first_download['date']
+    if first_update:
+        d = first_update['date']
         start_date = max(start_date, d) if start_date else d
-    downloads, updates = iter(downloads), iter(updates)
 
     def iterator(series):
         item = next(series)
@@ -149,13 +326,27 @@ def zip_overview(downloads, updates):
                'data': {'downloads': dl_count, 'updates': up_count}}
 
 
+def zip_overview_periods(downloads, updates):
+    # Weeks and months line up across both series already, there's just no
+    # row for a period without any counts.
+    periods = {}
+    for key, series in ('downloads', downloads), ('updates', updates):
+        for row in series:
+            data = periods.setdefault((row['date'], row['end']),
+                                      {'downloads': 0, 'updates': 0})
+            data[key] = row['count']
+    for (start, end), data in sorted(periods.items(), reverse=True):
+        yield {'date': start, 'end': end, 'data': data}
+
+
 @addon_view
 def downloads_series(request, addon, group, start, end, format):
     """Generate download counts grouped by ``group`` in ``format``."""
     date_range = check_series_params_or_404(group, start, end, format)
     check_stats_permission(request, addon)
 
-    series = get_series(DownloadCount, addon=addon.id, date__range=date_range)
+    series = get_series(DownloadCount, addon=addon.id, group=group,
+                        date__range=date_range)
 
     if format == 'csv':
         return render_csv(request, addon, series, ['date', 'count'])
@@ -170,10 +361,15 @@ def sources_series(request, addon, group, start, end, format):
     check_stats_permission(request, addon)
 
     series = get_series(DownloadCount, extra_field='_source.sources',
-                        addon=addon.id, date__range=date_range)
+                        addon=addon.id, group=group, date__range=date_range)
 
     if format == 'csv':
-        series, fields = csv_fields(series)
+        if facet_fields_ok(DownloadCount, date_range):
+            fields = series_fields(DownloadCount, 'sources', addon=addon.id,
+                                   date__range=date_range)
+            series = csv_rows(series)
+        else:
+            series, fields = csv_fields(series)
         return render_csv(request, addon, series,
                           ['date', 'count'] + list(fields))
     elif format == 'json':
@@ -186,7 +382,8 @@ def usage_series(request, addon, group, start, end, format):
     date_range = check_series_params_or_404(group, start, end, format)
     check_stats_permission(request, addon)
 
-    series = get_series(UpdateCount, addon=addon.id, date__range=date_range)
+    series = get_series(UpdateCount, addon=addon.id, group=group,
+                        date__range=date_range)
 
     if format == 'csv':
         return render_csv(request, addon, series, ['date', 'count'])
@@ -209,49 +406,71 @@ def usage_breakdown_series(request, addon, group,
         'statuses': '_source.status',
     }
     series = get_series(UpdateCount, extra_field=fields[field],
-                        addon=addon.id, date__range=date_range)
+                        addon=addon.id, group=group, date__range=date_range)
     if field == 'locales':
         series = process_locales(series)
 
     if format == 'csv':
         if field == 'applications':
             series = flatten_applications(series)
-        series, fields = csv_fields(series)
-        return render_csv(request, addon, series,
-                          ['date', 'count'] + list(fields))
+        if not facet_fields_ok(UpdateCount, date_range):
+            series, keys = csv_fields(series)
+            return render_csv(request, addon, series,
+                              ['date', 'count'] + list(keys))
+
+        keys = series_fields(UpdateCount, fields[field][len('_source.'):],
+                             addon=addon.id, date__range=date_range)
+        if field == 'applications':
+            keys = set(app_column(guid, version)
+                       for guid, versions in keys.items()
+                       for version in versions)
+        elif field == 'locales':
+            names = locale_names()
+            keys = set(locale_column(names, key) for key in keys
+                       if key in names)
+        return render_csv(request, addon, csv_rows(series),
+                          ['date', 'count'] + list(keys))
     elif format == 'json':
         return render_json(request, addon, series)
 
 
+def app_column(guid, version):
+    # unicode() to decode the gettext proxy.
+    return ' '.join([unicode(amo.APP_GUIDS[guid].pretty), version])
+
+
 def flatten_applications(series):
     """Convert app guids to pretty names, flatten count structure."""
     for row in series:
         if 'data' in row:
             new = {}
             for app, versions in row['data'].items():
-                app = amo.APP_GUIDS.get(app)
-                if not app:
+                if app not in amo.APP_GUIDS:
                     continue
-                # unicode() to decode the gettext proxy.
-                appname = unicode(app.pretty)
                 for ver, count in versions.items():
-                    key = ' '.join([appname, ver])
-                    new[key] = count
+                    new[app_column(app, ver)] = count
             row['data'] = new
         yield row
 
 
+def locale_names():
+    return dict((k.lower(), v['native'])
+                for k, v in product_details.languages.items())
+
+
+def locale_column(names, locale):
+    return u'%s (%s)' % (names[locale], locale)
+
+
 def process_locales(series):
     """Convert locale codes to pretty names, skip any unknown locales."""
-    languages = dict((k.lower(), v['native'])
-                     for k, v in product_details.languages.items())
+    languages = locale_names()
     for row in series:
         if 'data' in row:
             new = {}
             for key, count in row['data'].items():
                 if key in languages:
-                    k = u'%s (%s)' % (languages[key], key)
-                    new[k] = count
+                    new[locale_column(languages, key)] = count
             row['data'] = new
         yield row
 
@@ -617,6 +836,24 @@ def fudge_headers(response, stats):
         patch_cache_control(response, max_age=seven_days)
 
 
+def peek(series):
+    """
+    Returns the first row of `series` (None if it's empty) and an iterator
+    over all of it, so we can look before we start streaming.
+    """
+    series = iter(series)
+    try:
+        first = next(series)
+    except StopIteration:
+        return None, iter(())
+    return first, itertools.chain([first], series)
+
+
+class Chunks(list):
+    """A stand-in file that collects what's written to it."""
+    write = list.append
+
+
 class UnicodeCSVDictWriter(csv.DictWriter):
     """A DictWriter that writes a unicode stream."""
 
@@ -650,33 +887,57 @@ class UnicodeCSVDictWriter(csv.DictWriter):
 @allow_cross_site_request
 def render_csv(request, addon, stats, fields,
                title=None, show_disclaimer=None):
-    """Render a stats series in CSV."""
+    """Render a stats series in CSV, writing the rows out as they come."""
     # Start with a header from the template.
     ts = time.strftime('%c %z')
     context = {'addon': addon, 'timestamp': ts, 'title': title,
                'show_disclaimer': show_disclaimer}
-    response = jingo.render(request, 'stats/csv_header.txt', context)
+    header = jingo.render_to_string(request, 'stats/csv_header.txt', context)
 
-    writer = UnicodeCSVDictWriter(response, fields, restval=0,
-                                  extrasaction='ignore')
-    writer.writeheader()
-    writer.writerows(stats)
-
-    fudge_headers(response, list)
+    first, stats = peek(stats)
+    response = http.HttpResponse(stream_csv(header, stats, fields))
+    fudge_headers(response, first is not None)
     response['Content-Type'] = 'text/csv; charset=utf-8'
     return response
 
 
+def stream_csv(header, stats, fields):
+    out = Chunks([header])
+    writer = UnicodeCSVDictWriter(out, fields, restval=0,
+                                  extrasaction='ignore')
+    writer.writeheader()
+    for idx, row in enumerate(stats, 1):
+        writer.writerow(row)
+        if idx % STREAM_ROWS == 0:
+            yield u''.join(out)
+            del out[:]
+    yield u''.join(out)
+
+
 @allow_cross_site_request
 def render_json(request, addon, stats):
-    """Render a stats series in JSON."""
-    response = http.HttpResponse(mimetype='text/json')
+    """Render a stats series in JSON, writing the rows out as they come."""
+    if hasattr(stats, 'items'):
+        # Not a series, nothing to stream.
+        response = http.HttpResponse(mimetype='text/json')
+        fudge_headers(response, stats)
+        simplejson.dump(stats, response, cls=DjangoJSONEncoder)
+        return response
+
+    first, stats = peek(stats)
+    response = http.HttpResponse(stream_json(stats), mimetype='text/json')
+    fudge_headers(response, first is not None)
+    return response
 
-    # XXX: Subclass DjangoJSONEncoder to handle generators.
-    if isinstance(stats, GeneratorType):
-        stats = list(stats)
 
+def stream_json(stats):
     # Django's encoder supports date and datetime.
-    fudge_headers(response, stats)
-    simplejson.dump(stats, response, cls=DjangoJSONEncoder)
-    return response
+    encode = DjangoJSONEncoder().encode
+    out = ['[']
+    for idx, row in enumerate(stats):
+        out.append(', ' + encode(row) if idx else encode(row))
+        if len(out) >= STREAM_ROWS:
+            yield ''.join(out)
+            del out[:]
+    out.append(']')
+    yield ''.join(out)
@@ -1,9 +1,27 @@
+from array import array
 import re
 
 from django.utils.encoding import smart_str
 
 MAXVERSION = 2 ** 63 - 1
 
+# array('q') only exists from Python 3.3, 'l' is 64 bits on our servers.
+try:
+    array('q')
+    INT64 = 'q'
+except ValueError:
+    INT64 = 'l'
+
+# How many of the most recent version strings to keep around in
+# `version_int()`. When it fills up it's simply emptied, the hot strings
+# will be back soon enough.
+CACHE_SIZE = 10000
+_version_int_cache = {}
+
+# The number of digits each part after the major gets in a version int:
+# minor1, minor2, minor3, alpha, alpha_ver, pre and pre_ver.
+_WIDTHS = tuple(10 ** w for w in (2, 2, 2, 1, 2, 1, 2))
+
 version_re = re.compile(r"""(?P<major>\d+|\*)      # major (x in x.y)
                             \.?(?P<minor1>\d+|\*)? # minor1 (y in x.y)
                             \.?(?P<minor2>\d+|\*)? # minor2 (z in x.y.z)
@@ -60,16 +78,79 @@ def version_dict(version):
 
 
 def version_int(version):
-    d = version_dict(smart_str(version))
-    for key in ['alpha_ver', 'major', 'minor1', 'minor2', 'minor3',
-                'pre_ver']:
-        if not d[key]:
-            d[key] = 0
-    atrans = {'a': 0, 'b': 1}
-    d['alpha'] = atrans.get(d['alpha'], 2)
-    d['pre'] = 0 if d['pre'] else 1
-
-    v = "%d%02d%02d%02d%d%02d%d%02d" % (d['major'], d['minor1'],
-            d['minor2'], d['minor3'], d['alpha'], d['alpha_ver'], d['pre'],
-            d['pre_ver'])
-    return min(int(v), MAXVERSION)
+    """
+    Turns a version string into an integer that sorts the way the versions
+    do. Results for strings are memoized, this is called for every update
+    ping and every compatible version lookup.
+    """
+    try:
+        return _version_int_cache[version]
+    except (KeyError, TypeError):
+        pass
+
+    vint = _version_int(version)
+    if isinstance(version, basestring):
+        if len(_version_int_cache) >= CACHE_SIZE:
+            _version_int_cache.clear()
+        _version_int_cache[version] = vint
+    return vint
+
+
+def _version_int(version):
+    match = version_re.match(smart_str(version))
+    if not match:
+        return _encode(0, 0, 0, 0, 2, 0, 1, 0)
+
+    (major, minor1, minor2, minor3, alpha, alpha_ver, pre,
+     pre_ver) = match.groups()
+    return _encode(_part(major), _part(minor1), _part(minor2),
+                   _part(minor3), {'a': 0, 'b': 1}.get(alpha, 2),
+                   _part(alpha_ver), 0 if pre else 1, _part(pre_ver))
+
+
+def _part(value):
+    # The same as version_dict() followed by zeroing out the blanks.
+    if value == '*':
+        return 99
+    return int(value) if value else 0
+
+
+def _encode(major, *parts):
+    """
+    Does arithmetically what formatting each part with %02d (or %d), joining
+    them up and parsing the result would: a part that doesn't fit in its
+    digits pushes everything before it further left.
+    """
+    vint = major
+    for part, scale in zip(parts, _WIDTHS):
+        while part >= scale:
+            scale *= 10
+        vint = vint * scale + part
+    return min(vint, MAXVERSION)
+
+
+def version_ints(versions):
+    """
+    `version_int()` for a whole list of version strings at once, returned as
+    an array of 64 bit ints. Use numpy.frombuffer(result, numpy.int64) if you
+    need it as a NumPy vector.
+    """
+    cache = _version_int_cache
+    result = array(INT64)
+    append = result.append
+    for version in versions:
+        try:
+            append(cache[version])
+        except (KeyError, TypeError):
+            append(version_int(version))
+    return result
+
+
+def dicts_from_ints(version_ints):
+    """`dict_from_int()` for a list or array of version ints."""
+    return [dict_from_int(v) for v in version_ints]
+
+
+def nums(version_ints):
+    """`num()` for a list or array of version ints."""
+    return [num(v) for v in version_ints]
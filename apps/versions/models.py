@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+from datetime import datetime
 import os
 
 from django.conf import settings
@@ -534,3 +535,26 @@ class ApplicationsVersions(caching.base.CachingMixin, models.Model):
             return _(u'{app} {min} and later').format(app=self.application,
                                                       min=self.min)
         return u'%s %s - %s' % (self.application, self.min, self.max)
+
+
+def clear_compatversion_cache_on_appversion(sender, instance, **kw):
+    """Clears compatversion cache when the min/max of a Version change."""
+    if kw.get('raw'):
+        return
+    # applications_versions has no modified column, so touch the version
+    # for the services update index to see the change.
+    Version.objects.filter(id=instance.version_id).update(
+        modified=datetime.now())
+    try:
+        instance.version.addon.invalidate_d2c_versions()
+    except models.ObjectDoesNotExist:
+        # The version is being deleted, which clears the cache itself.
+        pass
+
+
+models.signals.post_save.connect(clear_compatversion_cache_on_appversion,
+                                 sender=ApplicationsVersions,
+                                 dispatch_uid='clear_compatversion_cache_av')
+models.signals.post_delete.connect(clear_compatversion_cache_on_appversion,
+                                   sender=ApplicationsVersions,
+                                   dispatch_uid='clear_compatversion_cache_av')
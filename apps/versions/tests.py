@@ -23,8 +23,10 @@ from files.tests.test_models import UploadTest
 from users.models import UserProfile
 from versions import views
 from versions.models import Version, ApplicationsVersions
+from versions import compare
 from versions.compare import (MAXVERSION, version_int, dict_from_int,
-                              version_dict)
+                              dicts_from_ints, nums, version_dict,
+                              version_ints)
 
 
 def test_version_int():
@@ -66,6 +68,43 @@ def test_version_int_unicode():
     eq_(version_int(u'\u2322 ugh stephend'), 200100)
 
 
+def test_version_int_wide_parts():
+    # Parts too big for their digits push everything before them left, the
+    # same as the old string formatting did.
+    eq_(version_int('1.100'), 11000000200100)
+    eq_(version_int('1.0b100'), 10000001100100)
+    eq_(version_int('3.0pre9'), 3000000200009)
+
+
+def test_version_int_cache():
+    compare._version_int_cache.clear()
+    eq_(version_int('3.6.12'), 3061200200100)
+    eq_(compare._version_int_cache['3.6.12'], 3061200200100)
+    # Only strings are cached.
+    version_int(3)
+    assert 3 not in compare._version_int_cache
+
+
+@mock.patch.object(compare, 'CACHE_SIZE', 2)
+def test_version_int_cache_size():
+    compare._version_int_cache.clear()
+    for v in ['1.0', '2.0', '3.0']:
+        version_int(v)
+    eq_(compare._version_int_cache.keys(), ['3.0'])
+
+
+def test_version_ints():
+    versions = ['3.5.0a1pre2', '', '*', '3.6.*', '1.100', None]
+    eq_(list(version_ints(versions)), [version_int(v) for v in versions])
+    eq_(list(version_ints([])), [])
+
+
+def test_bulk_from_ints():
+    ints = version_ints(['3.5.0a1pre2', '4.0'])
+    eq_(dicts_from_ints(ints), [dict_from_int(i) for i in ints])
+    eq_(nums(ints), ['3.5.0.0', '4.0.0.0'])
+
+
 def test_dict_from_int():
     d = dict_from_int(3050000001002)
     eq_(d['major'], 3)
@@ -379,6 +418,13 @@ class TestVersion(amo.tests.TestCase):
         amo.tests.version_factory(addon=addon)
         assert inv_mock.called
 
+    @mock.patch('addons.models.Addon.invalidate_d2c_versions')
+    def test_invalidate_d2c_version_signals_on_appversion(self, inv_mock):
+        av = Addon.objects.get(pk=3615).current_version.apps.all()[0]
+        inv_mock.reset_mock()
+        av.save()
+        assert inv_mock.called
+
 
 class TestViews(amo.tests.TestCase):
     fixtures = ['addons/eula+contrib-addon', 'base/apps']
@@ -1,5 +1,11 @@
+import httplib
 import json
-import urllib2
+from multiprocessing.dummy import Pool
+import Queue
+import socket
+import threading
+import time
+import urlparse
 
 from django.conf import settings
 from django_statsd.clients import statsd
@@ -13,46 +19,144 @@ class SigningError(Exception):
     pass
 
 
+class SigningClient(object):
+    """
+    Talks to the signing server over a pool of keep-alive connections. There
+    are only `size` connections, so that's as many receipts as are signed at
+    once; anyone else waits for a connection to come free.
+    """
+    headers = {'Content-Type': 'application/json'}
+
+    def __init__(self, server, size=4, timeout=10, retries=1):
+        self.server = server
+        self.args = (server, size, timeout, retries)
+        url = urlparse.urlparse(server)
+        self.scheme, self.host = url.scheme, url.netloc
+        self.path = url.path.rstrip('/') + '/1.0/sign'
+        self.size, self.timeout, self.retries = size, timeout, retries
+        self.connections = Queue.LifoQueue()
+        for _ in xrange(size):
+            self.connections.put(None)
+        self.workers = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.host, timeout=self.timeout)
+        return httplib.HTTPConnection(self.host, timeout=self.timeout)
+
+    def post(self, body):
+        """
+        Returns the (status, body) of the response to POSTing `body`.
+        Connection errors and server errors are retried `retries` times.
+        """
+        try:
+            conn = self.connections.get(timeout=self.timeout)
+        except Queue.Empty:
+            raise SigningError('No connection to the signing server free')
+        try:
+            for attempt in xrange(self.retries + 1):
+                last = attempt == self.retries
+                if conn is None:
+                    conn = self.connect()
+                start = time.time()
+                try:
+                    conn.request('POST', self.path, body, self.headers)
+                    response = conn.getresponse()
+                    data = response.read()
+                except Exception, e:
+                    # Most likely a kept alive connection the server closed,
+                    # either way the connection is no good any more.
+                    conn.close()
+                    conn = None
+                    if last or not isinstance(e, (socket.error,
+                                                  httplib.HTTPException)):
+                        raise
+                    statsd.incr('services.sign.retry')
+                    continue
+                statsd.timing('services.sign.request',
+                              (time.time() - start) * 1000)
+                if response.will_close:
+                    conn.close()
+                    conn = None
+                if response.status >= 500 and not last:
+                    statsd.incr('services.sign.retry')
+                    continue
+                return response.status, data
+        finally:
+            self.connections.put(conn)
+
+    def map(self, func, items):
+        """`func` over `items` on `size` threads, results in order."""
+        with self.lock:
+            if self.workers is None:
+                self.workers = Pool(self.size)
+        return self.workers.map(func, items)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """The `SigningClient` for the signing server in the settings."""
+    global _client
+    if not settings.SIGNING_SERVER:
+        return None
+    args = (settings.SIGNING_SERVER, settings.SIGNING_SERVER_POOL_SIZE,
+            settings.SIGNING_SERVER_TIMEOUT, settings.SIGNING_SERVER_RETRIES)
+    with _client_lock:
+        if _client is None or _client.args != args:
+            _client = SigningClient(*args)
+        return _client
+
+
 def sign(receipt):
     """
     Send the receipt to the signing service.
 
-    This could possibly be made async via celery.
+    Connections to the signing service are kept open and reused, see
+    `SigningClient`.
     """
-    destination = settings.SIGNING_SERVER
+    client = get_client()
     # If no destination is set. Just ignore this request.
-    if not destination:
+    if not client:
         return
 
-    destination += '/1.0/sign'
-    timeout = settings.SIGNING_SERVER_TIMEOUT
-
     receipt_json = json.dumps(receipt)
-    log.info('Calling service: %s' % destination)
+    log.info('Calling service: %s' % client.server)
     log.info('Receipt contents: %s' % receipt_json)
-    headers = {'Content-Type': 'application/json'}
     data = receipt if isinstance(receipt, basestring) else receipt_json
-    request = urllib2.Request(destination, data, headers)
 
     try:
         with statsd.timer('services.sign'):
-            response = urllib2.urlopen(request, timeout=timeout)
-    except urllib2.HTTPError, error:
-        # Will occur when a 3xx or greater code is returned
-        log.error('Posting to signing failed: %s'
-                  % (error.code))
-        raise SigningError
+            status, body = client.post(data)
+    except SigningError:
+        log.error('Posting to signing failed: no connection free')
+        raise
     except:
         # Will occur when some other error occurs.
         log.error('Posting to signing failed', exc_info=True)
         raise SigningError
 
-    if response.getcode() != 200:
-        log.error('Posting to signing failed: %s'
-                  % (response.getcode()))
+    if status != 200:
+        log.error('Posting to signing failed: %s' % status)
         raise SigningError
 
-    return json.loads(response.read())['receipt']
+    return json.loads(body)['receipt']
+
+
+def sign_many(receipts):
+    """
+    Signs a list of receipts, as many at once as the client has connections,
+    and returns them in the same order. Raises SigningError if any of them
+    can't be signed.
+    """
+    client = get_client()
+    if not client:
+        return [None] * len(receipts)
+    with statsd.timer('services.sign.batch'):
+        return client.map(sign, receipts)
 
 
 def decode(receipt):
@@ -0,0 +1,75 @@
+"""
+A stand-in for the receipt signing server, for development and for
+benchmarking the signing client without a real one. It takes the same
+POST /1.0/sign requests and signs with a local key, which is fine for
+throughput, but the certificate part isn't one the verifier would trust.
+
+    python stub.py /path/to/key.pem [port]
+"""
+import BaseHTTPServer
+import json
+import SocketServer
+import sys
+import threading
+
+import jwt
+
+
+def sign(receipt, key):
+    """A signed receipt in the '<certificate>~<receipt>' form."""
+    cert = jwt.encode({'typ': 'certified-key', 'iss': 'signing-stub'},
+                      key, u'RS512')
+    return '%s~%s' % (cert, jwt.encode(receipt, key, u'RS512'))
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep connections alive, like the real thing behind its load balancer.
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        if self.path != '/1.0/sign':
+            return self.respond(404, {'error': 'Not found'})
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            receipt = json.loads(self.rfile.read(length))
+        except ValueError:
+            return self.respond(400, {'error': 'Bad receipt'})
+        self.respond(200, {'receipt': sign(receipt, self.server.key)})
+
+    def respond(self, status, data):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, key_path, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.key = jwt.rsa_load(key_path)
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server_address
+
+
+def start(key_path, port=0):
+    """Runs a stub server in a background thread; returns the server."""
+    server = Server(key_path, port)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    server = Server(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 0)
+    print 'Signing stub on %s' % server.url
+    server.serve_forever()
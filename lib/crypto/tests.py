@@ -2,43 +2,105 @@
 from django.conf import settings
 
 import json
+import socket
+
 import mock
 from nose.tools import eq_, raises
 
 import amo.tests
-from lib.crypto.receipt import sign, SigningError
+from lib.crypto import receipt
+from lib.crypto.receipt import sign, sign_many, SigningError
 
 
-@mock.patch('lib.metrics.urllib2.urlopen')
+@mock.patch('lib.crypto.receipt.SigningClient.connect')
 @mock.patch.object(settings, 'SIGNING_SERVER', 'http://localhost')
 class TestReceipt(amo.tests.TestCase):
 
-    def test_called(self, urlopen):
-        urlopen.return_value = self.get_response(200)
+    def setUp(self):
+        # Don't reuse connections from other tests.
+        receipt._client = None
+
+    def test_called(self, connect):
+        conn = connect.return_value
+        conn.getresponse.return_value = self.get_response(200)
         sign('my-receipt')
-        eq_(urlopen.call_args[0][0].data, 'my-receipt')
+        eq_(conn.request.call_args[0][:3], ('POST', '/1.0/sign',
+                                            'my-receipt'))
 
-    def test_some_unicode(self, urlopen):
-        urlopen.return_value = self.get_response(200)
+    def test_some_unicode(self, connect):
+        connect.return_value.getresponse.return_value = self.get_response(200)
         sign({'name': u'Вагиф Сәмәдоғлу'})
 
-    def get_response(self, code):
+    def get_response(self, code, will_close=False):
         response = mock.Mock()
-        response.getcode = mock.Mock()
-        response.getcode.return_value = code
+        response.status = code
+        response.will_close = will_close
         response.read.return_value = json.dumps({'receipt': ''})
         return response
 
     @raises(SigningError)
-    def test_error(self, urlopen):
-        urlopen.return_value = self.get_response(403)
+    def test_error(self, connect):
+        connect.return_value.getresponse.return_value = self.get_response(403)
+        sign('x')
+
+    def test_good(self, connect):
+        connect.return_value.getresponse.return_value = self.get_response(200)
+        sign('x')
+
+    @raises(SigningError)
+    def test_other(self, connect):
+        connect.return_value.getresponse.return_value = self.get_response(206)
+        sign('x')
+
+    def test_keep_alive(self, connect):
+        connect.return_value.getresponse.return_value = self.get_response(200)
         sign('x')
+        sign('y')
+        eq_(connect.call_count, 1)
 
-    def test_good(self, urlopen):
-        urlopen.return_value = self.get_response(200)
+    def test_closed(self, connect):
+        response = self.get_response(200, will_close=True)
+        connect.return_value.getresponse.return_value = response
         sign('x')
+        sign('y')
+        eq_(connect.call_count, 2)
+
+    def test_retry(self, connect):
+        responses = [socket.error(), self.get_response(500),
+                     self.get_response(200)]
+
+        def getresponse():
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        connect.return_value.getresponse.side_effect = getresponse
+        with mock.patch.object(settings, 'SIGNING_SERVER_RETRIES', 2):
+            sign('x')
+        eq_(responses, [])
 
     @raises(SigningError)
-    def test_other(self, urlopen):
-        urlopen.return_value = self.get_response(206)
+    def test_no_more_retries(self, connect):
+        connect.return_value.getresponse.side_effect = socket.error()
         sign('x')
+
+    @mock.patch.object(settings, 'SIGNING_SERVER_POOL_SIZE', 1)
+    @raises(SigningError)
+    def test_no_connection_free(self, connect):
+        with mock.patch.object(settings, 'SIGNING_SERVER_TIMEOUT', 0.01):
+            client = receipt.get_client()
+            client.connections.get()
+            sign('x')
+
+    def test_sign_many(self, connect):
+        conn = connect.return_value
+        conn.getresponse.return_value = self.get_response(200)
+        eq_(sign_many(['x', 'y', 'z']), ['', '', ''])
+        eq_(sorted(c[0][2] for c in conn.request.call_args_list),
+            ['x', 'y', 'z'])
+
+    @mock.patch.object(settings, 'SIGNING_SERVER', '')
+    def test_no_server(self, connect):
+        eq_(sign('x'), None)
+        eq_(sign_many(['x', 'y']), [None, None])
@@ -0,0 +1,79 @@
+"""
+Benchmarks the pairwise loop the recs cron used to run against
+`sparse.top_similar()` on synthetic add-on/collection data, and checks that
+both come up with the same scores.
+
+    python bench.py [add-ons] [collections] [processes]
+"""
+import array
+import operator
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import recommend
+from recommend import sparse
+
+
+def synthetic(addons, collections, seed=42):
+    """
+    {addon: array of collection ids}, with a few popular collections and a
+    long tail, and at least 4 collections per add-on like the cron wants.
+    """
+    rand = random.Random(seed)
+    data = {}
+    for addon in xrange(1, addons + 1):
+        count = min(collections, 4 + int(rand.paretovariate(1.5)))
+        cs = set()
+        while len(cs) < count:
+            cs.add(min(collections, int(rand.paretovariate(0.7))))
+        data[addon] = array.array('l', sorted(cs))
+    return data
+
+
+def pairwise(addons):
+    """What recs() did: every add-on against every other, fully sorted."""
+    sim = recommend.similarity
+    sims = {}
+    for addon, collections in addons.iteritems():
+        xs = [(other, sim(collections, cs))
+              for other, cs in addons.iteritems()]
+        others = sorted(xs, key=operator.itemgetter(1), reverse=True)
+        sims[addon] = [(k, v) for k, v in others[:11] if k != addon][:10]
+    return sims
+
+
+def main(addons=2000, collections=5000, processes=1):
+    data = synthetic(addons, collections)
+    print '%s add-ons, %s collections, %.1f collections per add-on' % (
+        len(data), collections,
+        sum(len(v) for v in data.values()) / float(len(data)))
+
+    start = time.time()
+    old = pairwise(data)
+    old_time = time.time() - start
+    print 'pairwise: %.2fs' % old_time
+
+    start = time.time()
+    new = {}
+    for block in sparse.top_similar(data, processes=processes):
+        new.update(block)
+    new_time = time.time() - start
+    print 'sparse (%s, %s processes): %.2fs (%.1fx)' % (
+        'scipy' if sparse.scipy else 'python', processes, new_time,
+        old_time / new_time)
+
+    # Ties can come out in a different order, the scores can't.
+    mismatches = [a for a in data if [s for _, s in old[a]] !=
+                                     [s for _, s in new[a]]]
+    print '%s add-ons with different scores' % len(mismatches)
+    return not mismatches
+
+
+if __name__ == '__main__':
+    args = map(int, sys.argv[1:])
+    sys.exit(0 if main(*args) else 1)
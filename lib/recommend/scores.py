@@ -0,0 +1,179 @@
+"""
+A read-only index of recommendation scores, {addon: [(other_addon, score)]},
+in a file that every process maps into memory instead of asking the db.
+
+The rows are laid out like a CSR matrix: the add-on ids in order, where
+each add-on's run of entries starts, then the other add-ons and the scores
+of all the entries back to back. The file is mapped, not read, so all the
+workers on a box share one copy in the page cache.
+
+The file is written next to its final path and renamed into place, so a
+reader never sees half of it. Processes still using the old file keep
+their mapping until `ScoreFile` notices the new one and maps that.
+
+numpy does the gather and sum when it's installed; otherwise the entries
+are unpacked straight out of the mapping.
+"""
+from array import array
+import mmap
+import os
+import struct
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+MAGIC = 'RECSCOR1'
+# Magic, number of add-ons, number of entries.
+HEADER = struct.Struct('<8sII')
+
+
+def write(path, recs):
+    """Writes {addon: {other_addon: score}} to an index file at `path`."""
+    ids = sorted(recs)
+    offsets, others, scores = array('I', [0]), array('i'), array('d')
+    for addon in ids:
+        for other, score in sorted(recs[addon].items()):
+            others.append(other)
+            scores.append(score)
+        offsets.append(len(others))
+    tmp = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(ids), len(others)))
+        for a in (array('i', ids), offsets, others, scores):
+            if a.typecode == 'd':
+                # Keep the doubles aligned for numpy.
+                f.write('\0' * (-f.tell() % 8))
+            f.write(_little(a).tostring())
+    os.rename(tmp, path)
+
+
+def _little(a):
+    if struct.pack('=I', 1) != struct.pack('<I', 1):
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a
+
+
+class ScoreIndex(object):
+    """The index in one file, mapped into memory."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.size, self.entries = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise ValueError('%s is not a score index.' % path)
+        pos = HEADER.size
+        self.ids_at, pos = pos, pos + 4 * self.size
+        self.offsets_at, pos = pos, pos + 4 * (self.size + 1)
+        self.others_at, pos = pos, pos + 4 * self.entries
+        self.scores_at = pos + (-pos % 8)
+        if numpy is not None:
+            self.ids = self._array('<i4', self.ids_at, self.size)
+            self.offsets = self._array('<u4', self.offsets_at, self.size + 1)
+            self.others = self._array('<i4', self.others_at, self.entries)
+            self.scores = self._array('<f8', self.scores_at, self.entries)
+
+    def _array(self, dtype, offset, count):
+        return numpy.frombuffer(self.map, dtype=dtype, count=count,
+                                offset=offset)
+
+    def _unpack(self, fmt, at, index, count=1):
+        size = struct.calcsize('<' + fmt)
+        return struct.unpack_from('<%s%s' % (count, fmt), self.map,
+                                  at + size * index)
+
+    def _row(self, addon):
+        """The (start, end) of `addon`'s entries, or None."""
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._unpack('i', self.ids_at, mid)[0] < addon:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.size and self._unpack('i', self.ids_at, lo)[0] == addon:
+            return self._unpack('I', self.offsets_at, lo, 2)
+
+    def scores_for(self, addon):
+        """{other_addon: score} for `addon`, like `AddonRecommendation`."""
+        row = self._row(addon)
+        if not row or row[0] == row[1]:
+            return {}
+        start, end = row
+        return dict(zip(self._unpack('i', self.others_at, start, end - start),
+                        self._unpack('d', self.scores_at, start,
+                                     end - start)))
+
+    def ranked(self, addon_ids):
+        """
+        The other add-ons recommended for `addon_ids`, best first: each
+        one's scores summed over all of `addon_ids`, ties by id.
+        """
+        if numpy is not None:
+            return self._ranked_numpy(addon_ids)
+        totals = {}
+        for addon in set(addon_ids):
+            for other, score in self.scores_for(addon).iteritems():
+                totals[other] = totals.get(other, 0) + score
+        mine = set(addon_ids)
+        ranked = sorted((-score, other) for other, score in totals.iteritems()
+                        if other not in mine)
+        return [other for _, other in ranked]
+
+    def _ranked_numpy(self, addon_ids):
+        ids = numpy.unique(numpy.asarray(list(addon_ids), dtype='<i4'))
+        if not len(ids) or not self.size:
+            return []
+        rows = numpy.searchsorted(self.ids, ids)
+        rows = rows[rows < self.size]
+        rows = rows[numpy.in1d(self.ids[rows], ids)]
+        if not len(rows):
+            return []
+        starts, ends = self.offsets[rows], self.offsets[rows + 1]
+        take = numpy.concatenate([numpy.arange(s, e)
+                                  for s, e in zip(starts, ends)])
+        if not len(take):
+            return []
+        others, inverse = numpy.unique(self.others[take],
+                                       return_inverse=True)
+        totals = numpy.bincount(inverse, weights=self.scores[take])
+        keep = ~numpy.in1d(others, ids)
+        others, totals = others[keep], totals[keep]
+        # others is sorted, so a stable sort on the score breaks ties by id.
+        order = numpy.argsort(-totals, kind='mergesort')
+        return others[order].tolist()
+
+
+class ScoreFile(object):
+    """
+    Hands out the `ScoreIndex` at `path`, mapping it again when the file
+    is replaced. That's checked at most every `interval` seconds.
+    """
+
+    def __init__(self, path, interval=60):
+        self.path = path
+        self.interval = interval
+        self.index, self.checked = None, 0
+
+    def get(self):
+        """The index, or None if there isn't one."""
+        now = time.time()
+        if now - self.checked < self.interval:
+            return self.index
+        self.checked = now
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self.index = None
+            return None
+        if (self.index is None or
+            (stat.st_ino, stat.st_mtime) != (self.index.stat.st_ino,
+                                             self.index.stat.st_mtime)):
+            self.index = ScoreIndex(self.path)
+        return self.index
@@ -0,0 +1,280 @@
+"""
+Find the most similar items for a lot of items at once.
+
+Items are sets of ids (add-ons and the collections they're in) and the
+similarity is the same as `recommend.similarity()`: 1 / (1 + the size of the
+symmetric difference). Comparing every item to every other item one pair at
+a time is N^2 calls, plus a sort of N items for each one.
+
+Here the item x set incidence matrix is built once and, a block of rows at a
+time, the intersections |A & B| come from a sparse product of the matrix
+with its transpose. The symmetric difference is then |A| + |B| - 2|A & B|
+and only the top N of each row are picked out, without sorting the rest.
+
+scipy.sparse does the product when it's installed; otherwise an inverted
+index of set -> items does the same sparse product in plain Python. Blocks
+can be spread over a pool of processes.
+"""
+import bisect
+import heapq
+import itertools
+import multiprocessing
+
+try:
+    import numpy
+    import scipy.sparse
+except ImportError:
+    numpy = scipy = None
+
+
+# Sets holding more than HEAVY_SHARE of the items (and at least HEAVY_MIN) are
+# counted as bitmasks in the plain Python product, up to HEAVY_MAX of them.
+HEAVY_SHARE = 0.1
+HEAVY_MIN = 100
+HEAVY_MAX = 12
+BITS = [bin(x).count('1') for x in xrange(1 << HEAVY_MAX)]
+
+# The matrix for the current run. It's a module global so that forked pool
+# workers share it instead of having it pickled over to them.
+_matrix = None
+
+
+class Incidence(object):
+    """The item x set incidence matrix."""
+
+    def __init__(self, items):
+        """`items` is a dict of {item_id: sequence of set ids}."""
+        self.ids = sorted(items)
+        self.rows = dict((i, r) for r, i in enumerate(self.ids))
+        self.sets = [sorted(set(items[i])) for i in self.ids]
+        self.sizes = [len(s) for s in self.sets]
+
+        # Rows of the transpose: set id -> the rows that have it.
+        self.inverted = {}
+        for row, sets in enumerate(self.sets):
+            for s in sets:
+                self.inverted.setdefault(s, []).append(row)
+
+        self.sparse = None
+        if scipy is not None:
+            # Every set gets a column, so this comes before the heavy sets
+            # are taken out of the inverted index.
+            columns = dict((s, c) for c, s in enumerate(self.inverted))
+            rows = [r for r, sets in enumerate(self.sets) for s in sets]
+            cols = [columns[s] for sets in self.sets for s in sets]
+            self.sparse = scipy.sparse.csr_matrix(
+                (numpy.ones(len(rows), dtype=numpy.int32), (rows, cols)),
+                shape=(len(self.ids), len(columns)))
+            self.sparse_t = self.sparse.T.tocsr()
+            self.sparse_ids = numpy.array(self.ids)
+            self.sparse_sizes = numpy.array(self.sizes, dtype=numpy.int64)
+            # Rows by size, then id: the best of the items that share
+            # nothing with a row come first.
+            self.by_size = numpy.lexsort((self.sparse_ids,
+                                          self.sparse_sizes))
+
+        # A handful of sets hold most of the items, and counting those one
+        # item at a time would make every row cost O(N). They're kept as a
+        # bitmask per item instead, and items with the same mask are grouped
+        # by size: the best items in a group that share no other set with a
+        # row are the smallest ones.
+        limit = max(HEAVY_MIN, len(self.ids) * HEAVY_SHARE)
+        heavy = sorted((s for s, rows in self.inverted.iteritems()
+                        if len(rows) > limit),
+                       key=lambda s: -len(self.inverted[s]))[:HEAVY_MAX]
+        self.masks = [0] * len(self.ids)
+        for bit, s in enumerate(heavy):
+            for row in self.inverted.pop(s):
+                self.masks[row] |= 1 << bit
+        self.light = [[s for s in sets if s in self.inverted]
+                      for sets in self.sets]
+
+        groups = {}
+        for row, mask in enumerate(self.masks):
+            groups.setdefault(mask, []).append(row)
+        self.groups = []
+        for mask, rows in groups.iteritems():
+            rows.sort(key=lambda r: (self.sizes[r], self.ids[r]))
+            self.groups.append((mask, self.sizes[rows[0]], rows))
+
+
+    def __len__(self):
+        return len(self.ids)
+
+    def top(self, rows, n):
+        """
+        Returns [(item_id, [(other_id, similarity), ...])] for a list of
+        rows, best first. Ties go to the lower id.
+        """
+        if self.sparse is not None:
+            return self._top_scipy(rows, n)
+        return self._top_python(rows, n)
+
+    def _top_python(self, rows, n):
+        ids, sizes, masks = self.ids, self.sizes, self.masks
+        bits = BITS
+        result = []
+        for row in rows:
+            shared = self._shared(row)
+            size, mask = sizes[row], masks[row]
+            best = [(size + sizes[o] - 2 * (c + bits[mask & masks[o]]),
+                     ids[o]) for o, c in shared.iteritems()]
+            best = heapq.nsmallest(n, best)
+
+            # Everything else only shares heavy sets with the row, so within
+            # a group the smallest items are the best, and a group can be
+            # skipped when even its smallest item can't make the cut.
+            bounds = [(size + least - 2 * bits[mask & m], i)
+                      for i, (m, least, _) in enumerate(self.groups)]
+            if len(best) == n:
+                worst = best[-1][0]
+                bounds = [b for b in bounds if b[0] <= worst]
+            bounds.sort()
+            for bound, i in bounds:
+                if len(best) == n and bound > best[-1][0]:
+                    break
+                group = self.groups[i][2]
+                diff = bound - sizes[group[0]]
+                extra = itertools.islice(
+                    (o for o in group if o != row and o not in shared), n)
+                best = heapq.nsmallest(
+                    n, itertools.chain(best, ((diff + sizes[o], ids[o])
+                                              for o in extra)))
+
+            result.append((ids[row], [(other, 1. / (1. + d))
+                                      for d, other in best]))
+        return result
+
+    def _shared(self, row):
+        """
+        One row of the sparse product: how many of the smaller sets `row`
+        shares with every other item that shares at least one.
+        """
+        shared = {}
+        for s in self.light[row]:
+            for other in self.inverted[s]:
+                shared[other] = shared.get(other, 0) + 1
+        shared.pop(row, None)
+        return shared
+
+    def reached(self, item_ids, worst):
+        """
+        Returns the ids of the items that one of `item_ids` is at least as
+        similar to as their current nth best. `worst` is {item_id: the
+        symmetric difference of its nth best}; items that aren't in it are
+        always reached.
+        """
+        sizes, masks, bits = self.sizes, self.masks, BITS
+        inf = float('inf')
+        worst = [worst.get(i, inf) for i in self.ids]
+
+        # Within a group, |B| + |A| - 2|A & B| <= worst(B) comes down to
+        # |B| - worst(B) <= 2|A & B| - |A|, so with the group sorted on the
+        # left side the items that are reached are a prefix of it.
+        groups = []
+        for mask, _, members in self.groups:
+            members = sorted(members, key=lambda r: sizes[r] - worst[r])
+            groups.append((mask, [sizes[r] - worst[r] for r in members],
+                           members))
+
+        reached = set()
+        for row in (self.rows[i] for i in item_ids if i in self.rows):
+            # An item doesn't reach itself, but another one can reach it.
+            reached_before = row in reached
+            size, mask = sizes[row], masks[row]
+            for o, c in self._shared(row).iteritems():
+                diff = size + sizes[o] - 2 * (c + bits[mask & masks[o]])
+                if diff <= worst[o]:
+                    reached.add(o)
+            # Sharing smaller sets only makes the difference smaller, so the
+            # heavy sets alone are enough to reach the rest.
+            for m, keys, members in groups:
+                i = bisect.bisect_right(keys, 2 * bits[mask & m] - size)
+                reached.update(members[:i])
+            if not reached_before:
+                reached.discard(row)
+        return set(self.ids[r] for r in reached)
+
+    def _top_scipy(self, rows, n):
+        ids, sizes = self.sparse_ids, self.sparse_sizes
+        # The block's rows of the product stay sparse: only the items that
+        # share a set with a row are in it.
+        product = (self.sparse[rows] * self.sparse_t).tocsr()
+        seen = numpy.zeros(len(ids), dtype=bool)
+        result = []
+        for i, row in enumerate(rows):
+            start, end = product.indptr[i], product.indptr[i + 1]
+            cols = product.indices[start:end]
+            shared = product.data[start:end].astype(numpy.int64)
+            # Of everything else only the smallest few can make the cut.
+            seen[cols] = True
+            seen[row] = True
+            take = n + 1
+            while True:
+                rest = self.by_size[:take]
+                rest = rest[~seen[rest]]
+                if len(rest) >= n or take >= len(ids):
+                    break
+                take *= 4
+            rest = rest[:n]
+            seen[cols] = False
+            seen[row] = False
+            others = numpy.concatenate((cols, rest))
+            diff = sizes[row] + sizes[others] - 2 * numpy.concatenate(
+                (shared, numpy.zeros(len(rest), dtype=numpy.int64)))
+            # Never recommend an item for itself.
+            keep = others != row
+            others, diff = others[keep], diff[keep]
+            if len(diff) > n:
+                # Only sort what can make the cut, ties included.
+                cut = numpy.partition(diff, n - 1)[n - 1]
+                keep = diff <= cut
+                others, diff = others[keep], diff[keep]
+            top = numpy.lexsort((ids[others], diff))[:n]
+            result.append((self.ids[row],
+                           [(int(ids[o]), 1. / (1. + d))
+                            for o, d in zip(others[top], diff[top])]))
+        return result
+
+
+def _init(matrix):
+    global _matrix
+    _matrix = matrix
+
+
+def _top_block(args):
+    rows, n = args
+    return _matrix.top(rows, n)
+
+
+def top_similar(items, n=10, block_size=1000, processes=1, only=None):
+    """
+    Yields a {item_id: [(other_id, similarity), ...]} dict for each block of
+    `block_size` items, holding the `n` most similar other items of each,
+    best first. With `processes` > 1 the blocks are worked out by a pool.
+
+    `items` can be an `Incidence` that's already been built. `only` limits
+    the rows that are worked out to those item ids; they're still compared
+    with everything in `items`.
+    """
+    matrix = items if isinstance(items, Incidence) else Incidence(items)
+    if only is None:
+        rows = range(len(matrix))
+    else:
+        rows = sorted(matrix.rows[i] for i in only if i in matrix.rows)
+    blocks = [(rows[i:i + block_size], n)
+              for i in xrange(0, len(rows), block_size)]
+
+    if processes > 1:
+        # Set up the matrix before forking so the workers share it.
+        _init(matrix)
+        pool = multiprocessing.Pool(processes)
+        try:
+            for block in pool.imap(_top_block, blocks):
+                yield dict(block)
+        finally:
+            pool.terminate()
+            _init(None)
+    else:
+        for rows, n in blocks:
+            yield dict(matrix.top(rows, n))
@@ -1,4 +1,5 @@
 from array import array
+from nose import SkipTest
 from nose.tools import eq_
 
 import recommend
@@ -31,3 +32,157 @@ def test_symmetric_diff_count():
 # The algorithm is in flux so this is minimal coverage.
 def test_similarity():
     eq_(1/2., recommend.similarity([1], [1, 2]))
+
+
+def _pairwise(items, n):
+    sims = {}
+    for item, sets in items.items():
+        xs = sorted((-recommend.similarity(sets, other_sets), other)
+                    for other, other_sets in items.items() if other != item)
+        sims[item] = [(other, -score) for score, other in xs[:n]]
+    return sims
+
+
+def _items(count, seed=1):
+    import random
+    rand = random.Random(seed)
+    return dict((i, sorted(set(min(300, int(rand.paretovariate(0.7)))
+                               for _ in xrange(rand.randint(1, 8)))))
+                for i in xrange(1, count + 1))
+
+
+def test_top_similar():
+    from recommend import sparse
+    items = _items(400)
+    expected = _pairwise(items, 10)
+    got = {}
+    for block in sparse.top_similar(items, n=10, block_size=64):
+        got.update(block)
+    eq_(sorted(got), sorted(items))
+    for item in items:
+        eq_(got[item], expected[item])
+
+
+def test_top_similar_scipy():
+    from recommend import sparse
+    if sparse.scipy is None:
+        raise SkipTest
+    items = _items(400)
+    matrix = sparse.Incidence(items)
+    # Some of the sets are heavy enough to be taken out of the index.
+    assert any(matrix.masks)
+    rows = range(len(matrix))
+    expected = _pairwise(items, 10)
+    eq_(dict(matrix._top_scipy(rows, 10)), expected)
+    eq_(matrix._top_scipy(rows, 10), matrix._top_python(rows, 10))
+
+
+def test_top_similar_small():
+    from recommend import sparse
+    items = {1: [1, 2], 2: [1, 2], 3: [5]}
+    eq_(dict(*sparse.top_similar(items, n=10)),
+        {1: [(2, 1.), (3, 1 / 4.)],
+         2: [(1, 1.), (3, 1 / 4.)],
+         3: [(1, 1 / 4.), (2, 1 / 4.)]})
+
+
+def test_top_similar_empty():
+    from recommend import sparse
+    eq_(list(sparse.top_similar({})), [])
+
+
+def _scores(seed=1):
+    import random
+    rand = random.Random(seed)
+    return dict((a, dict((rand.randint(1, 300), rand.random())
+                         for _ in xrange(rand.randint(0, 10))))
+                for a in xrange(1, 200))
+
+
+def _ranked(recs, addon_ids):
+    totals = {}
+    for addon in set(addon_ids):
+        for other, score in recs.get(addon, {}).items():
+            totals[other] = totals.get(other, 0) + score
+    return [other for _, other in sorted((-score, other) for other, score
+                                         in totals.items()
+                                         if other not in addon_ids)]
+
+
+def _check_ranked(numpy):
+    import os
+    import tempfile
+    from recommend import scores
+    recs = _scores()
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    old_numpy, scores.numpy = scores.numpy, numpy
+    try:
+        scores.write(path, recs)
+        index = scores.ScoreIndex(path)
+        eq_(index.scores_for(1), recs[1])
+        eq_(index.scores_for(1000), {})
+        for ids in ([], [1], [1, 2, 3], range(1, 300, 7), [1000]):
+            eq_(index.ranked(ids), _ranked(recs, ids))
+    finally:
+        scores.numpy = old_numpy
+        os.remove(path)
+
+
+def test_score_index():
+    _check_ranked(None)
+
+
+def test_score_index_numpy():
+    from recommend import scores
+    if scores.numpy is None:
+        raise SkipTest
+    _check_ranked(scores.numpy)
+
+
+def test_ranked_numpy_matches_python():
+    import os
+    import tempfile
+    from recommend import scores
+    if scores.numpy is None:
+        raise SkipTest
+    recs = _scores(2)
+    # Ties, which both break by id.
+    recs[1] = {10: .5, 11: .25, 12: .5, 2: 1.}
+    recs[2] = {11: .25, 13: .75, 1: 1.}
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    old_numpy = scores.numpy
+    try:
+        scores.write(path, recs)
+        index = scores.ScoreIndex(path)
+        for ids in ([], [1], [2], [1, 2], [2, 1, 1], [1, 1000],
+                    range(1, 300, 7), range(1, 200), [1000]):
+            expected = index.ranked(ids)
+            scores.numpy = None
+            eq_(index.ranked(ids), expected)
+            scores.numpy = old_numpy
+    finally:
+        scores.numpy = old_numpy
+        os.remove(path)
+
+
+def test_score_file_swap():
+    import os
+    import tempfile
+    from recommend import scores
+    path = tempfile.mktemp()
+    f = scores.ScoreFile(path, interval=0)
+    eq_(f.get(), None)
+    try:
+        scores.write(path, {1: {2: 1.}})
+        eq_(f.get().scores_for(1), {2: 1.})
+        old = f.get()
+        scores.write(path, {1: {3: 1.}})
+        new = f.get()
+        assert new is not old
+        eq_(new.scores_for(1), {3: 1.})
+        # Anyone still holding the old index can keep using it.
+        eq_(old.scores_for(1), {2: 1.})
+    finally:
+        os.remove(path)
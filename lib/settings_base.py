@@ -84,6 +84,46 @@ SERVICES_DATABASE = {
     'PASSWORD': '',
     'HOST': '',
 }
+# An optional read replica for the read only services queries (update checks
+# and receipt verification), with the same keys as SERVICES_DATABASE. Keep
+# its lag low, a receipt can be verified right after the purchase.
+SERVICES_DATABASE_SLAVE = {}
+# The connection pool each services endpoint gets, per process. Connections
+# are pinged when they're checked out if PING is set, and replaced if they
+# don't answer. SERVICES_DATABASE_POOLS overrides these per endpoint, like
+# {'update': {'SIZE': 20}}. The endpoints are update, verify and index.
+SERVICES_DATABASE_POOL = {
+    'SIZE': 5,
+    'OVERFLOW': 10,
+    'RECYCLE': 300,
+    'TIMEOUT': 30,
+    'PING': True,
+}
+SERVICES_DATABASE_POOLS = {}
+
+# Keep an in-process index of update candidates in each services worker so
+# that update pings don't have to hit the db.
+SERVICES_UPDATE_INDEX = False
+# How often (in seconds) the index picks up changed rows from the db, and how
+# often it's rebuilt from scratch to drop anything that was deleted.
+SERVICES_UPDATE_INDEX_REFRESH = 60
+SERVICES_UPDATE_INDEX_REBUILD = 60 * 60 * 6
+# The fraction of answers from the index that are also run through the update
+# query and compared. Mismatches are logged and counted in statsd.
+SERVICES_UPDATE_INDEX_CHECK = 0
+# Cache the rendered update rdf in each worker (this many responses) and in
+# memcached, for this many seconds.
+SERVICES_UPDATE_CACHE = False
+SERVICES_UPDATE_CACHE_SIZE = 10000
+SERVICES_UPDATE_CACHE_TIMEOUT = 60 * 60
+# The most add-ons a client can ask about in one batch update check.
+SERVICES_UPDATE_BATCH_SIZE = 100
+# Remember this many receipts the receipt verifier has checked the signature
+# of, for this many seconds, so they don't have to be checked again.
+SERVICES_VERIFY_CACHE_SIZE = 1000
+SERVICES_VERIFY_CACHE_TIMEOUT = 60 * 60
+# The most receipts for one app that can be verified in one batch.
+SERVICES_VERIFY_BATCH_SIZE = 100
 
 DATABASE_ROUTERS = ('multidb.PinningMasterSlaveRouter',)
 
@@ -933,6 +973,9 @@ REDIRECT_URL = 'http://outgoing.mozilla.org/v1/'
 REDIRECT_SECRET_KEY = ''
 
 PFS_URL = 'https://pfs.mozilla.org/plugins/PluginFinderService.php'
+# The plugin rules the PFS service serves from. It picks up changes to this
+# file without a restart.
+PFS_RULES = path('services', 'pfs.json')
 # Allow URLs from these servers. Use full domain names.
 REDIRECT_URL_WHITELIST = ['addons.mozilla.org']
 
@@ -1244,6 +1287,25 @@ DEFAULT_SUGGESTED_CONTRIBUTION = 5
 # Path to `ps`.
 PS_BIN = '/bin/ps'
 
+# The recs cron works out recommendations this many add-ons at a time, and
+# spreads the blocks over this many processes.
+RECS_BLOCK_SIZE = 500
+RECS_PROCESSES = 1
+
+# Where the recs cron keeps the collections it saw last time, so the next run
+# only has to work out what changed. Remove it (or run `recs full`) to rebuild
+# everything.
+RECS_STATE_PATH = os.path.join(TMP_PATH, 'recs-state.pickle')
+# The recs cron writes every add-on's recommendation scores here when it's
+# done, and the web heads map the file to build the discovery pane recs
+# without going to the db. It should be somewhere they can all read it.
+RECS_INDEX_PATH = os.path.join(NETAPP_STORAGE, 'recs-scores.index')
+
+# deliver_hotness writes the add-ons whose hotness changed this many at a
+# time, pausing this many seconds between batches to spare the db.
+HOTNESS_BATCH = 1000
+HOTNESS_THROTTLE = 1
+
 BLOCKLIST_COOKIE = 'BLOCKLIST_v1'
 
 # The maximum file size that is shown inside the file viewer.
@@ -1337,14 +1399,25 @@ BUILDER_VERSIONS_URL = ('https://builder.addons.mozilla.org/repackage/' +
 
 ## Elastic Search
 ES_HOSTS = ['127.0.0.1:9200']
+# Update and download counts go through an alias, so they can be reindexed
+# into a new index and swapped in (see `manage.py index_stats --help`).
 ES_INDEXES = {'default': 'amo',
-              'update_counts': 'amo_stats',
-              'download_counts': 'amo_stats',
+              'update_counts': 'amo_stats_counts',
+              'download_counts': 'amo_stats_counts',
               'stats_contributions': 'amo_stats',
               'stats_collections_counts': 'amo_stats',
               'users_install': 'amo_stats'}
 ES_TIMEOUT = 30
 
+# `index_stats --stream` sends ES_BULK_SIZE documents in each _bulk request,
+# with up to ES_BULK_IN_FLIGHT requests going at once. Failed requests are
+# retried ES_BULK_RETRIES times. The last id indexed from each table is kept
+# in ES_BULK_CHECKPOINT_PATH for `--resume`.
+ES_BULK_SIZE = 2000
+ES_BULK_IN_FLIGHT = 4
+ES_BULK_RETRIES = 5
+ES_BULK_CHECKPOINT_PATH = TMP_PATH
+
 # Default AMO user id to use for tasks.
 TASK_USER_ID = 4757633
 
@@ -1452,6 +1525,11 @@ SIGNING_SERVER_ACTIVE = False
 SIGNING_SERVER = ''
 # And how long we'll give the server to respond.
 SIGNING_SERVER_TIMEOUT = 10
+# How many connections to keep open to the signing server, which is also the
+# most receipts we'll have it sign at once, and how many times to retry when
+# a request fails.
+SIGNING_SERVER_POOL_SIZE = 4
+SIGNING_SERVER_RETRIES = 1
 
 # True when the Django app is running from the test suite.
 IN_TEST_SUITE = False
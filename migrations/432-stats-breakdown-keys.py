@@ -0,0 +1,26 @@
+import elasticutils
+import pyes.exceptions as pyes
+
+from stats.models import CollectionCount, UpdateCount
+from stats.search import breakdown_keys_whole
+
+
+def run():
+    # Update and download counts are read through an alias now, so their
+    # mapping can be changed by reindexing into a new index and swapping it
+    # in. Until then the alias points at the index they've always been in,
+    # with the collection counts, and nothing is dropped.
+    es = elasticutils.get_es()
+    alias = UpdateCount._get_index()
+    try:
+        es.get_mapping(UpdateCount._meta.db_table, alias)
+        print 'skipping'
+        return
+    except pyes.ElasticSearchException:
+        pass
+    es.add_alias(alias, [CollectionCount._get_index()])
+
+    if not breakdown_keys_whole(UpdateCount):
+        print ('The stats csv columns skip the facets until the counts are '
+               'reindexed; see `manage.py index_stats --help` for --index '
+               'and --swap.')
@@ -1,6 +1,9 @@
 # -*- coding: utf8 -*-
 import calendar
 import json
+import os
+import shutil
+import tempfile
 from urllib import urlencode
 import time
 
@@ -67,6 +70,8 @@ class TestVerify(amo.tests.TestCase):
                           'product': {'url': 'http://f.com',
                                       'storedata': urlencode({'id': 3615})},
                           'exp': calendar.timegm(time.gmtime()) + 1000}
+        verify.keys.clear()
+        verify.verified.clear()
 
     def get_decode(self, addon_id, receipt, check_purchase=True):
         # Ensure that the verify code is using the test database cursor.
@@ -277,6 +282,49 @@ class TestVerify(amo.tests.TestCase):
         self.assertRaises(M2Crypto.RSA.RSAError, verify.decode_receipt,
                           receipt + 'x')
 
+    def test_crack_receipt_cached(self):
+        self.addon.update(type=amo.ADDON_WEBAPP, manifest_url='http://a.com')
+        receipt = create_receipt(self.make_install().pk)
+        decode = verify.jwt.decode
+        with mock.patch.object(verify.jwt, 'decode') as jwt_decode:
+            jwt_decode.side_effect = decode
+            first = verify.decode_receipt(receipt)
+            # What the caller does with it doesn't change the cache.
+            first['exp'] = 0
+            second = verify.decode_receipt(receipt)
+        eq_(jwt_decode.call_count, 1)
+        eq_(second['typ'], u'purchase-receipt')
+        assert second['exp']
+
+    def test_key_loaded_once(self):
+        self.addon.update(type=amo.ADDON_WEBAPP, manifest_url='http://a.com')
+        receipt = create_receipt(self.make_install().pk)
+        rsa_load = verify.jwt.rsa_load
+        with mock.patch.object(verify.jwt, 'rsa_load') as load:
+            load.side_effect = rsa_load
+            verify.decode_receipt(receipt)
+            verify.verified.clear()
+            verify.decode_receipt(receipt)
+        eq_(load.call_count, 1)
+
+    def test_key_reloaded(self):
+        self.addon.update(type=amo.ADDON_WEBAPP, manifest_url='http://a.com')
+        receipt = create_receipt(self.make_install().pk)
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'key.pem')
+        shutil.copy(amo.tests.AMOPaths.sample_key(), path)
+
+        rsa_load = verify.jwt.rsa_load
+        with mock.patch.object(utils.settings, 'WEBAPPS_RECEIPT_KEY', path):
+            with mock.patch.object(verify.jwt, 'rsa_load') as load:
+                load.side_effect = rsa_load
+                verify.decode_receipt(receipt)
+                stamp = os.stat(path).st_mtime + 10
+                os.utime(path, (stamp, stamp))
+                verify.decode_receipt(receipt)
+        eq_(load.call_count, 2)
+
     @mock.patch.object(verify, 'decode_receipt')
     def get_headers(self, decode_receipt):
         decode_receipt.return_value = ''
@@ -292,3 +340,71 @@ class TestVerify(amo.tests.TestCase):
     def test_no_cache(self):
         hdrs = self.get_headers()
         assert ('Cache-Control', 'no-cache') in hdrs, 'No cache header needed'
+
+
+@mock.patch.object(verify, 'decode_receipt', json.loads)
+class TestBatchVerify(amo.tests.TestCase):
+    fixtures = ['base/addon_3615', 'base/users']
+
+    def setUp(self):
+        self.addon = Addon.objects.get(pk=3615)
+        self.user = UserProfile.objects.get(email='regular@mozilla.com')
+        self.other = UserProfile.objects.get(email='clouserw@gmail.com')
+
+    def receipt(self, uuid, addon_id=3615):
+        # decode_receipt is json.loads here.
+        storedata = urlencode({'id': addon_id})
+        return json.dumps({'user': {'type': 'directed-identifier',
+                                    'value': uuid},
+                           'product': {'url': 'http://f.com',
+                                       'storedata': storedata},
+                           'exp': calendar.timegm(time.gmtime()) + 1000})
+
+    def make_install(self, user, uuid):
+        install = Installed.objects.create(addon=self.addon, user=user)
+        install.update(uuid=uuid)
+
+    def verify(self, receipts, check_purchase=True):
+        v = verify.BatchVerify(3615, receipts, {})
+        v.cursor = connection.cursor()
+        return [r['status'] for r in
+                json.loads(v(check_purchase=check_purchase))]
+
+    def test_batch(self):
+        self.make_install(self.user, 'some-uuid')
+        self.make_install(self.other, 'other-uuid')
+        eq_(self.verify([self.receipt('some-uuid'), self.receipt('nope'),
+                         'garbage', self.receipt('other-uuid', addon_id=1),
+                         self.receipt('OTHER-uuid')]),
+            ['ok', 'invalid', 'invalid', 'invalid', 'ok'])
+
+    def test_premium(self):
+        self.addon.update(premium_type=amo.ADDON_PREMIUM)
+        self.make_install(self.user, 'some-uuid')
+        self.make_install(self.other, 'other-uuid')
+        purchase = AddonPurchase.objects.create(addon=self.addon,
+                                                user=self.user)
+        receipts = [self.receipt('some-uuid'), self.receipt('other-uuid')]
+        eq_(self.verify(receipts), ['ok', 'invalid'])
+        eq_(self.verify(receipts, check_purchase=False), ['ok', 'ok'])
+        purchase.update(type=amo.CONTRIB_REFUND)
+        eq_(self.verify(receipts), ['refunded', 'invalid'])
+
+    def test_queries(self):
+        self.addon.update(premium_type=amo.ADDON_PREMIUM)
+        self.make_install(self.user, 'some-uuid')
+        self.make_install(self.other, 'other-uuid')
+        receipts = [self.receipt('some-uuid'), self.receipt('other-uuid')]
+        with self.assertNumQueries(2):
+            self.verify(receipts * 10)
+
+    def test_nothing_decoded(self):
+        with self.assertNumQueries(0):
+            eq_(self.verify(['garbage']), ['invalid'])
+
+    @mock.patch.object(utils.settings, 'SERVICES_VERIFY_BATCH_SIZE', 2)
+    def test_is_valid(self):
+        assert verify.BatchVerify(3615, ['a', 'b'], {}).is_valid()
+        assert not verify.BatchVerify(3615, [], {}).is_valid()
+        assert not verify.BatchVerify(3615, ['a', 'b', 'c'], {}).is_valid()
+        assert not verify.BatchVerify(3615, ['a', 1], {}).is_valid()
@@ -0,0 +1,62 @@
+from optparse import make_option
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from lib.crypto import receipt, stub
+
+
+class Command(BaseCommand):
+    """
+    Signs a pile of receipts, one at a time and in batches, and reports the
+    throughput and latency. Without --server this runs against the local
+    signing stub with the receipt key, so it works offline.
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('--number', action='store', type='int', default=500,
+                    dest='number', help='Number of receipts, default: '
+                                        '%default'),
+        make_option('--server', action='store', type='string',
+                    dest='server', help='The signing server to use.'),
+        make_option('--pool', action='store', type='int',
+                    dest='pool', help='Connections to keep open, default: '
+                                      'SIGNING_SERVER_POOL_SIZE'),
+    )
+
+    def handle(self, *args, **options):
+        server = options.get('server')
+        if not server:
+            server = stub.start(settings.WEBAPPS_RECEIPT_KEY).url
+            print 'Started the signing stub on %s.' % server
+        pool = options.get('pool') or settings.SIGNING_SERVER_POOL_SIZE
+        number = options['number']
+        receipts = [{'typ': 'purchase-receipt', 'iat': int(time.time()),
+                     'user': {'type': 'directed-identifier',
+                              'value': 'bench-%s' % i}}
+                    for i in xrange(number)]
+
+        # Only for this process, sign() picks these up.
+        settings.SIGNING_SERVER = server
+        settings.SIGNING_SERVER_POOL_SIZE = pool
+
+        times = []
+        start = time.time()
+        for r in receipts:
+            before = time.time()
+            receipt.sign(r)
+            times.append(time.time() - before)
+        self.report('sign()', number, time.time() - start, times)
+
+        start = time.time()
+        receipt.sign_many(receipts)
+        self.report('sign_many() on %s connections' % pool, number,
+                    time.time() - start)
+
+    def report(self, name, number, elapsed, times=None):
+        print '%s: %s receipts in %.2fs, %.0f/s' % (
+            name, number, elapsed, number / elapsed if elapsed else 0)
+        if times:
+            times = sorted(times)
+            print '    p50 %.1fms, p90 %.1fms, p99 %.1fms' % tuple(
+                times[int(len(times) * p)] * 1000 for p in (.5, .9, .99))
@@ -5,6 +5,7 @@ HOME=/tmp
 # Every minute!
 * * * * * {{ z_cron }} fast_current_version
 * * * * * {{ z_cron }} migrate_collection_users
+* * * * * {{ z_cron }} flush_synced_collections
 
 # Every 30 minutes.
 */30 * * * * {{ z_cron }} tag_jetpacks
@@ -54,6 +55,7 @@ HOME=/tmp
 30 8 * * * {{ z_cron }} personas_adu
 30 9 * * * {{ z_cron }} share_count_totals
 30 10 * * * {{ z_cron }} recs
+30 11 * * * {{ z_cron }} build_blocklist
 30 20 * * * {{ z_cron }} update_perf
 30 22 * * * {{ z_cron }} deliver_hotness
 40 23 * * * {{ z_cron }} update_compat_info_for_fx4
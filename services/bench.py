@@ -0,0 +1,449 @@
+"""
+Replays a mix of requests through the services WSGI apps, in this process
+or across worker processes, and reports the throughput, latency and
+queries per request of each app as JSON, so that runs can be compared
+across commits.
+
+The apps run against SERVICES_DATABASE, so point that at a db with some
+data in it, like a local copy of the dev db. Without --mix the requests
+are generated from what's in there; --save writes them out, one JSON
+object per line, so the same mix can be replayed later.
+
+--seed N fills a scratch schema next to it (--db, SERVICES_DATABASE's
+name plus _bench by default) with N synthetic add-ons, their versions,
+files and compat ranges, and installs and purchases to verify, and runs
+against that. The tables are copied from SERVICES_DATABASE and the rows
+only depend on N, so with --random-seed as well, two runs replay the
+same requests against the same data.
+
+    python bench.py --requests 5000 --workers 4 --output before.json
+    python bench.py --seed 10000 --random-seed 1 --output before.json
+"""
+from cStringIO import StringIO
+import json
+import multiprocessing
+import optparse
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib
+from urlparse import parse_qsl
+
+import MySQLdb as mysql
+import MySQLdb.cursors
+
+import utils
+from utils import (settings, ADDON_PREMIUM, APP_GUIDS, CONTRIB_PURCHASE,
+                   STATUS_PUBLIC)
+
+try:
+    from compare import version_int
+except ImportError:
+    from apps.versions.compare import version_int
+
+APPS = ('update', 'update_batch', 'verify', 'pfs')
+# How much of a generated mix each app gets, roughly what production sees.
+WEIGHTS = {'update': 80, 'update_batch': 5, 'verify': 5, 'pfs': 10}
+
+OSES = ['WINNT', 'Darwin', 'Linux', 'SunOS']
+CLIENT_OSES = ['Windows NT 5.1', 'Windows NT 6.0', 'Windows NT 6.1',
+               'Intel Mac OS X 10.7', 'PPC Mac OS X 10.5',
+               'Linux i686', 'Linux x86_64', 'SunOS 5.11']
+LOCALES = ['en-US', 'de', 'fr', 'ja-JP', 'pt-BR']
+COMPAT_MODES = ['strict', 'normal', 'normal', 'ignore']
+
+# The tables the apps read, copied empty into the --seed schema.
+SEED_TABLES = ('addons', 'versions', 'files', 'applications', 'appversions',
+               'applications_versions', 'incompatible_versions',
+               'users_install', 'addon_purchase')
+SEED_APP_VERSIONS = ['3.0', '3.5', '3.6', '4.0', '5.0', '6.0', '7.0', '8.0',
+                     '9.0', '10.0', '11.0', '12.0', '13.0', '14.0', '15.0',
+                     '16.0', '17.0', '18.0']
+# Every seeded row was created, modified and reviewed then.
+SEED_DATE = '2012-06-01 00:00:00'
+
+# The queries run by this thread, counted by the cursors below.
+counts = threading.local()
+
+
+class CountingCursor(MySQLdb.cursors.Cursor):
+
+    def execute(self, *args, **kw):
+        counts.queries = getattr(counts, 'queries', 0) + 1
+        return super(CountingCursor, self).execute(*args, **kw)
+
+
+def getconn(db=None):
+    db = db or settings.SERVICES_DATABASE
+    return mysql.connect(host=db['HOST'], user=db['USER'],
+                         passwd=db['PASSWORD'], db=db['NAME'],
+                         cursorclass=CountingCursor)
+
+
+def seed(number, name):
+    """
+    Makes the `name` schema with empty copies of SEED_TABLES, and fills it
+    with `number` add-ons. The rows come from a generator seeded on
+    `number`, so the same number always gives the same data.
+    """
+    rand = random.Random(number)
+    source = settings.SERVICES_DATABASE['NAME']
+    conn = getconn()
+    cursor = conn.cursor()
+    # Columns the apps don't read are left to their defaults.
+    cursor.execute("SET SESSION sql_mode = ''")
+    cursor.execute('CREATE DATABASE IF NOT EXISTS `%s`' % name)
+    for table in SEED_TABLES:
+        cursor.execute('DROP TABLE IF EXISTS `%s`.`%s`' % (name, table))
+        cursor.execute('CREATE TABLE `%s`.`%s` LIKE `%s`.`%s`' %
+                       (name, table, source, table))
+    cursor.execute('USE `%s`' % name)
+
+    def insert(table, columns, rows):
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            table, ', '.join(columns), ', '.join(['%s'] * len(columns)))
+        for i in xrange(0, len(rows), 1000):
+            cursor.executemany(sql, rows[i:i + 1000])
+
+    now = SEED_DATE
+    app_ids = sorted(APP_GUIDS.values())
+    insert('applications', ['id', 'guid'],
+           [(app, guid) for guid, app in APP_GUIDS.items()])
+    appversions, app_versions = [], {}
+    for app in app_ids:
+        for version in SEED_APP_VERSIONS:
+            appversions.append((len(appversions) + 1, app, version,
+                                version_int(version)))
+            app_versions.setdefault(app, []).append(len(appversions))
+    insert('appversions', ['id', 'application_id', 'version', 'version_int'],
+           appversions)
+
+    addons, versions, files, compat = [], [], [], []
+    installs, purchases = [], []
+    for addon in xrange(1, number + 1):
+        premium = ADDON_PREMIUM if rand.random() < .05 else 0
+        addons.append((addon, '{bench-%d}' % addon, STATUS_PUBLIC, 1,
+                       premium, now, now))
+        for i in xrange(rand.randint(1, 5)):
+            version = len(versions) + 1
+            versions.append((version, addon, '1.%d' % i, now, now))
+            files.append((version, version, 1, STATUS_PUBLIC,
+                          'sha256:%032x' % rand.getrandbits(128),
+                          'bench-%d-1.%d.xpi' % (addon, i), now,
+                          int(rand.random() < .1), now, now))
+            for app in rand.sample(app_ids, rand.randint(1, 2)):
+                ids = app_versions[app]
+                low = rand.randint(0, len(ids) - 1)
+                compat.append((app, version, ids[low],
+                               ids[rand.randint(low, len(ids) - 1)], now,
+                               now))
+        for i in xrange(rand.randint(0, 3)):
+            user = len(installs) + 1
+            installs.append((user, addon, user, premium,
+                             '%032x' % rand.getrandbits(128), now, now))
+            if premium:
+                purchases.append((addon, user, CONTRIB_PURCHASE, now, now))
+    insert('addons', ['id', 'guid', 'status', 'addontype_id',
+                      'premium_type', 'created', 'modified'], addons)
+    insert('versions', ['id', 'addon_id', 'version', 'created', 'modified'],
+           versions)
+    insert('files', ['id', 'version_id', 'platform_id', 'status', 'hash',
+                     'filename', 'datestatuschanged', 'strict_compatibility',
+                     'created', 'modified'], files)
+    insert('applications_versions', ['application_id', 'version_id', 'min',
+                                     'max', 'created', 'modified'], compat)
+    insert('users_install', ['id', 'addon_id', 'user_id', 'premium_type',
+                             'uuid', 'created', 'modified'], installs)
+    insert('addon_purchase', ['addon_id', 'user_id', 'type', 'created',
+                              'modified'], purchases)
+    conn.commit()
+    conn.close()
+    print >>sys.stderr, ('Seeded %s with %s add-ons, %s versions and %s '
+                         'installs.' % (name, number, len(versions),
+                                        len(installs)))
+
+
+def use_db(name):
+    """Points the apps, and the requests we generate, at schema `name`."""
+    settings.SERVICES_DATABASE = dict(settings.SERVICES_DATABASE, NAME=name)
+    if settings.SERVICES_DATABASE_SLAVE:
+        # The slave won't have a scratch schema, send everything to master.
+        settings.SERVICES_DATABASE_SLAVE = {}
+
+
+def get_app(name):
+    # Only import what's being run, verify needs the receipt libraries.
+    if name in ('update', 'update_batch'):
+        import update
+        if name == 'update':
+            return update.application
+        return update.batch_application
+    elif name == 'verify':
+        import verify
+        return verify.application
+    elif name == 'pfs':
+        import pfs
+        return pfs.application
+
+
+def fetch(sql, params=None):
+    conn = utils.getconn()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+    finally:
+        conn.close()
+
+
+def generate_update(number):
+    addons = fetch("""SELECT a.guid, v.version FROM addons a
+                      INNER JOIN versions v ON v.addon_id = a.id
+                      WHERE a.status = %s AND a.inactive = 0
+                      AND a.guid IS NOT NULL
+                      ORDER BY RAND(%s) LIMIT %s""",
+                   (STATUS_PUBLIC, random.getrandbits(31), number))
+    app_id = dict((v, k) for k, v in APP_GUIDS.items())
+    app_versions = fetch("""SELECT application_id, version FROM appversions
+                            WHERE application_id IN (%s)""" %
+                         ','.join(map(str, app_id)))
+    if not addons or not app_versions:
+        return []
+    requests = []
+    for i in xrange(number):
+        guid, version = random.choice(addons)
+        app, app_version = random.choice(app_versions)
+        query = {'reqVersion': 2, 'id': guid, 'version': version,
+                 'appID': app_id[app], 'appVersion': app_version,
+                 'appOS': random.choice(OSES),
+                 'compatMode': random.choice(COMPAT_MODES)}
+        requests.append({'app': 'update', 'path': '/update/VersionCheck.php',
+                         'query': urllib.urlencode(query)})
+    return requests
+
+
+def generate_update_batch(number, size=20):
+    requests = []
+    singles = generate_update(number * size)
+    for i in xrange(0, len(singles), size):
+        chunk = [dict(parse_qsl(r['query'])) for r in singles[i:i + size]]
+        query = [(k, chunk[0][k]) for k in ('reqVersion', 'appID',
+                                             'appVersion', 'appOS',
+                                             'compatMode')]
+        for item in chunk:
+            query += [('id', item['id']), ('version', item['version'])]
+        requests.append({'app': 'update_batch',
+                         'path': '/update/VersionCheckBatch.php',
+                         'query': '', 'body': urllib.urlencode(query)})
+    return requests
+
+
+def generate_verify(number):
+    if settings.SIGNING_SERVER_ACTIVE:
+        # Receipts from a signing server need its certificate, which we
+        # can't make up, so there is nothing to verify.
+        return []
+    import jwt
+    import verify
+    installs = fetch("""SELECT addon_id, uuid FROM users_install
+                        ORDER BY RAND(%s) LIMIT %s""",
+                     (random.getrandbits(31), number))
+    key = verify.keys.get_key()
+    requests = []
+    for addon_id, uuid in installs:
+        receipt = {'typ': 'purchase-receipt', 'iat': int(time.time()),
+                   'exp': int(time.time()) + 60 * 60 * 24,
+                   'product': {'storedata': 'id=%s' % addon_id},
+                   'user': {'type': 'directed-identifier', 'value': uuid}}
+        requests.append({'app': 'verify', 'path': '/verify/%s' % addon_id,
+                         'query': '',
+                         'body': jwt.encode(receipt, key, u'RS512')})
+    if not requests:
+        return []
+    return [random.choice(requests) for i in xrange(number)]
+
+
+def generate_pfs(number):
+    import pfs
+    mimetypes = pfs.rules_file.get().exact.keys() + [
+        'application/x-java-vm', 'video/quicktime', 'video/x-ms-wmv',
+        'application/x-unknown']
+    requests = []
+    for i in xrange(number):
+        query = {'mimetype': random.choice(mimetypes),
+                 'appID': random.choice(APP_GUIDS.keys()),
+                 'appVersion': '20120101010101',
+                 'clientOS': random.choice(CLIENT_OSES),
+                 'chromeLocale': random.choice(LOCALES)}
+        requests.append({'app': 'pfs', 'path': '/services/pfs.php',
+                         'query': urllib.urlencode(query)})
+    return requests
+
+
+def generate(apps, number):
+    total = sum(WEIGHTS[a] for a in apps)
+    requests = []
+    for app in apps:
+        share = max(number * WEIGHTS[app] / total, 1)
+        made = globals()['generate_%s' % app](share)
+        if not made:
+            print >>sys.stderr, 'No %s requests, skipping it.' % app
+        requests.extend(made)
+    random.shuffle(requests)
+    return requests
+
+
+def environ(request):
+    # Requests read back from a --mix file are unicode.
+    body = request.get('body', '').encode('utf8')
+    return {'REQUEST_METHOD': 'POST' if body else 'GET',
+            'PATH_INFO': request['path'].encode('utf8'),
+            'QUERY_STRING': request.get('query', '').encode('utf8'),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': StringIO(body),
+            'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+            'REMOTE_ADDR': '127.0.0.1', 'HTTP_USER_AGENT': 'bench'}
+
+
+def replay(args):
+    """
+    Runs `requests` through the apps, the first `warmup` of them without
+    counting. Returns (app, seconds, queries, ok) for each of the rest,
+    and how long they took altogether.
+    """
+    requests, warmup = args
+    # Pools are made on first use, so every worker gets its own.
+    utils.getconn = getconn
+    apps = dict((a, get_app(a)) for a in set(r['app'] for r in requests))
+    results, started = [], time.time()
+    for i, request in enumerate(requests):
+        if i == warmup:
+            started = time.time()
+        statuses = []
+        start_response = lambda status, headers: statuses.append(status)
+        counts.queries = 0
+        start = time.time()
+        try:
+            ''.join(apps[request['app']](environ(request), start_response))
+        except Exception:
+            statuses.append('500')
+        elapsed = time.time() - start
+        if i >= warmup:
+            results.append((request['app'], elapsed, counts.queries,
+                            bool(statuses) and statuses[0][0] in '23'))
+    return results, time.time() - started
+
+
+def percentile(times, p):
+    return times[min(int(len(times) * p), len(times) - 1)]
+
+
+def summarize(replayed):
+    results = sum([r for r, _ in replayed], [])
+    apps = {}
+    for app in set(r[0] for r in results):
+        rows = [r for r in results if r[0] == app]
+        times = sorted(r[1] for r in rows)
+        apps[app] = {
+            'requests': len(rows),
+            'errors': len([r for r in rows if not r[3]]),
+            'mean_ms': sum(times) / len(times) * 1000,
+            'p50_ms': percentile(times, .5) * 1000,
+            'p95_ms': percentile(times, .95) * 1000,
+            'p99_ms': percentile(times, .99) * 1000,
+            'queries_per_request': float(sum(r[2] for r in rows)) / len(rows),
+        }
+    # The workers ran side by side, so their rates add up.
+    return {'requests': len(results),
+            'errors': len([r for r in results if not r[3]]),
+            'rps': sum(len(r) / seconds for r, seconds in replayed
+                       if seconds),
+            'apps': apps}
+
+
+def git_revision():
+    try:
+        p = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return p.communicate()[0].strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.strip().split('\n')[-1])
+    parser.add_option('--requests', type='int', default=2000,
+                      help='Requests to generate, default: %default')
+    parser.add_option('--apps', default=','.join(APPS),
+                      help='The apps to generate requests for, default: '
+                           '%default')
+    parser.add_option('--workers', type='int', default=1,
+                      help='Worker processes, default: %default')
+    parser.add_option('--warmup', type='int', default=100,
+                      help='Requests per worker before timing starts, '
+                           'default: %default')
+    parser.add_option('--mix', help='Replay the requests in this file.')
+    parser.add_option('--save', help='Save the requests to this file.')
+    parser.add_option('--output', help='Write the results here, not stdout.')
+    parser.add_option('--random-seed', type='int',
+                      help='Seed for generating --requests.')
+    parser.add_option('--seed', type='int',
+                      help='Fill --db with this many synthetic add-ons '
+                           'first.')
+    parser.add_option('--db',
+                      help='Run against this schema, default with --seed: '
+                           'the SERVICES_DATABASE name plus _bench.')
+    options, args = parser.parse_args()
+
+    db = options.db
+    if options.seed and not db:
+        db = '%s_bench' % settings.SERVICES_DATABASE['NAME']
+    if options.seed:
+        seed(options.seed, db)
+    if db:
+        use_db(db)
+
+    if options.mix:
+        requests = [json.loads(line) for line in open(options.mix) if line]
+    else:
+        random.seed(options.random_seed)
+        apps = [a for a in options.apps.split(',') if a]
+        for app in apps:
+            if app not in APPS:
+                parser.error('Unknown app: %s' % app)
+        requests = generate(apps, options.requests)
+    if not requests:
+        parser.error('No requests to replay.')
+    if options.save:
+        out = open(options.save, 'w')
+        for request in requests:
+            out.write(json.dumps(request) + '\n')
+        out.close()
+
+    workers = max(options.workers, 1)
+    # Every worker replays the whole warmup, then its share of the rest.
+    warmup = requests[:options.warmup]
+    rest = requests[options.warmup:] or requests
+    jobs = [(warmup + rest[i::workers], len(warmup))
+            for i in xrange(workers)]
+    if workers == 1:
+        replayed = [replay(jobs[0])]
+    else:
+        pool = multiprocessing.Pool(workers)
+        replayed = pool.map(replay, jobs)
+        pool.close()
+
+    report = summarize(replayed)
+    report.update(revision=git_revision(), workers=workers,
+                  time=int(time.time()))
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        open(options.output, 'w').write(output + '\n')
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
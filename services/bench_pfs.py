@@ -0,0 +1,278 @@
+"""
+Checks the rules in pfs.json give the same responses as the if/elif chain
+they replaced, over every mimetype, OS and locale the rules care about,
+and times both.
+
+    python bench_pfs.py [requests]
+"""
+from collections import defaultdict
+import re
+import sys
+from string import Template
+from time import time
+
+import jinja2
+
+import pfs
+from pfs import xml_template
+
+# The if/elif chain the rules replaced.
+flash_re = re.compile(r'^(Win|(PPC|Intel) Mac OS X|Linux.+i\d86)|SunOs', re.IGNORECASE)
+quicktime_re = re.compile(r'^(application/(sdp|x-(mpeg|rtsp|sdp))|audio/(3gpp(2)?|AMR|aiff|basic|mid(i)?|mp4|mpeg|vnd\.qcelp|wav|x-(aiff|m4(a|b|p)|midi|mpeg|wav))|image/(pict|png|tiff|x-(macpaint|pict|png|quicktime|sgi|targa|tiff))|video/(3gpp(2)?|flc|mp4|mpeg|quicktime|sd-video|x-mpeg))$')
+java_re = re.compile(r'^application/x-java-((applet|bean)(;jpi-version=1\.5|;version=(1\.(1(\.[1-3])?|(2|4)(\.[1-2])?|3(\.1)?|5)))?|vm)$')
+wmp_re = re.compile(r'^(application/(asx|x-(mplayer2|ms-wmp))|video/x-ms-(asf(-plugin)?|wm(p|v|x)?|wvx)|audio/x-ms-w(ax|ma))$')
+
+
+def legacy_output(data):
+    g = defaultdict(str, [(k, jinja2.escape(v)) for k, v in data.iteritems()])
+
+    required = ['mimetype', 'appID', 'appVersion', 'clientOS', 'chromeLocale']
+
+    plugin = dict(mimetype='-1', name='-1', guid='-1', version='',
+                  iconUrl='', XPILocation='', InstallerLocation='',
+                  InstallerHash='', InstallerShowsUI='',
+                  manualInstallationURL='', licenseURL='',
+                  needsRestart='true')
+
+    plugin['mimetype'] = g['mimetype'] or '-1'
+
+    output = Template(xml_template)
+
+    for s in required:
+        if s not in data:
+            return output.substitute(plugin)
+
+    if (g['mimetype'] in ['application/x-shockwave-flash',
+                          'application/futuresplash'] and
+        re.match(flash_re, g['clientOS'])):
+
+        plugin.update(
+            name='Adobe Flash Player',
+            manualInstallationURL='http://www.adobe.com/go/getflashplayer')
+
+        if g['clientOS'].startswith('Win'):
+            plugin.update(
+                guid='{4cfaef8a-a6c9-41a0-8e6f-967eb8f49143}',
+                XPILocation='',
+                iconUrl='http://fpdownload2.macromedia.com/pub/flashplayer/current/fp_win_installer.ico',
+                needsRestart='false',
+                InstallerShowsUI='true',
+                version='11.3.300.262',
+                InstallerHash='sha256:295e3484a53712d760d0ebfce5719b984f2fc08d393ddca0f9e3a0018ba42c8f',
+                InstallerLocation='http://download.macromedia.com/pub/flashplayer/pdc/11.3.300.262/fp_pl_pfs_installer.exe')
+
+    elif (g['mimetype'] == 'application/x-director' and
+          g['clientOS'].startswith('Win')):
+        plugin.update(
+            name='Adobe Shockwave Player',
+            manualInstallationURL='http://get.adobe.com/shockwave/')
+
+        if g['chromeLocale'] != 'ja-JP':
+            plugin.update(
+                licenseURL='http://www.adobe.com/go/eula_shockwaveplayer')
+        else:
+            plugin.update(
+                licenseURL='http://www.adobe.com/go/eula_shockwaveplayer_jp')
+        plugin.update(
+            guid='{45f2a22c-4029-4209-8b3d-1421b989633f}',
+            XPILocation='',
+            version='11.6.5.635',
+            InstallerHash='sha256:06e68ef5308c64f1a4334be93cdea473c1ef04c6afc4fadc03f90a1447e709d0',
+            InstallerLocation='http://fpdownload.macromedia.com/pub/shockwave/default/english/win95nt/latest/Shockwave_Installer_FF.exe',
+            needsRestart='false',
+            InstallerShowsUI='false')
+
+    elif (g['mimetype'] in ['audio/x-pn-realaudio-plugin',
+                            'audio/x-pn-realaudio'] and
+          re.match(r'^(Win|Linux|PPC Mac OS X)', g['clientOS'])):
+        plugin.update(
+            name='Real Player',
+            version='10.5',
+            manualInstallationURL='http://www.real.com')
+
+        if g['clientOS'].startswith('Win'):
+            plugin.update(
+                XPILocation='http://forms.real.com/real/player/download.html?type=firefox',
+                guid='{d586351c-cb55-41a7-8e7b-4aaac5172d39}')
+        else:
+            plugin.update(
+                guid='{269eb771-59de-4702-9209-ca97ce522f6d}')
+
+    elif (re.match(quicktime_re, g['mimetype']) and
+          re.match(r'^(Win|PPC Mac OS X)', g['clientOS'])):
+
+        plugin.update(
+            name='Apple Quicktime',
+            guid='{a42bb825-7eee-420f-8ee7-834062b6fefd}',
+            InstallerShowsUI='true',
+            manualInstallationURL='http://www.apple.com/quicktime/download/')
+
+    elif (re.match(java_re, g['mimetype']) and
+          re.match(r'^(Win|Linux|PPC Mac OS X)', g['clientOS'])):
+
+        plugin.update(
+            name='Java Runtime Environment',
+            version='1.7 u4',
+            manualInstallationURL='http://java.com/downloads',
+            InstallerShowsUI='false',
+            needsRestart='false')
+
+        if g['clientOS'].startswith('Windows NT 6.0'):
+            plugin.update(
+                guid='{fbe640ef-4375-4f45-8d79-767d60bf75b8}',
+                InstallerLocation='http://java.com/firefoxjre_exe',
+                InstallerHash='sha1:fd67d63faa58945d875ec2f7666a43d79dedc3b1')
+        elif g['clientOS'].startswith('Win'):
+            plugin.update(
+                guid='{92a550f2-dfd2-4d2f-a35d-a98cfda73595}',
+                InstallerLocation='http://java.com/firefoxjre_exe',
+                InstallerHash='sha1:fd67d63faa58945d875ec2f7666a43d79dedc3b1',
+                XPILocation='http://java.com/jre-install.xpi')
+        else:
+            plugin.update(
+                guid='{fbe640ef-4375-4f45-8d79-767d60bf75b8}')
+
+    elif (g['mimetype'] in ['application/pdf', 'application/vnd.fdf',
+                            'application/vnd.adobe.xfdf',
+                            'application/vnd.adobe.xdp+xml',
+                            'application/vnd.adobe.xfd+xml'] and
+          re.match(r'^(Win|PPC Mac OS X|Linux(?! x86_64))', g['clientOS'])):
+        plugin.update(
+            name='Adobe Acrobat Plug-In',
+            guid='{d87cd824-67cb-4547-8587-616c70318095}',
+            manualInstallationURL='http://www.adobe.com/products/acrobat/readstep.html')
+
+    elif (g['mimetype'] == 'application/x-mtx' and
+          re.match(r'^(Win|PPC Mac OS X)', g['clientOS'])):
+        plugin.update(
+            name='Viewpoint Media Player',
+            guid='{03f998b2-0e00-11d3-a498-00104b6eb52e}',
+            manualInstallationURL='http://www.viewpoint.com/pub/products/vmp.html')
+
+    elif re.match(wmp_re, g['mimetype']):
+        if g['clientOS'].startswith('Win'):
+            plugin.update(
+                name='Windows Media Player',
+                version='11',
+                guid='{cff1240a-fd24-4b9f-8183-ccd96e5300d0}',
+                manualInstallationURL='http://port25.technet.com/pages/windows-media-player-firefox-plugin-download.aspx')
+
+        elif re.match(r'^(PPC|Intel) Mac OS X', g['clientOS']):
+            plugin.update(
+                name='Flip4Mac',
+                version='2.1',
+                guid='{cff0240a-fd24-4b9f-8183-ccd96e5300d0}',
+                manualInstallationURL='http://www.flip4mac.com/wmv_download.htm')
+
+    elif (g['mimetype'] == 'application/x-xstandard' and
+          re.match(r'^(Win|PPC Mac OS X)', g['clientOS'])):
+        plugin.update(
+            name='XStandard XHTML WYSIWYG Editor',
+            guid='{3563d917-2f44-4e05-8769-47e655e92361}',
+            iconUrl='http://xstandard.com/images/xicon32x32.gif',
+            XPILocation='http://xstandard.com/download/xstandard.xpi',
+            InstallerShowsUI='false',
+            manualInstallationURL='http://xstandard.com/download/',
+            licenseURL='http://xstandard.com/license/')
+
+    elif (g['mimetype'] == 'application/x-dnl' and
+          g['clientOS'].startswith('Win')):
+        plugin.update(
+            name='DNL Reader',
+            guid='{ce9317a3-e2f8-49b9-9b3b-a7fb5ec55161}',
+            version='5.5',
+            iconUrl='http://digitalwebbooks.com/reader/dwb16.gif',
+            XPILocation='http://digitalwebbooks.com/reader/xpinst.xpi',
+            InstallerShowsUI='false',
+            manualInstallationURL='http://digitalwebbooks.com/reader/')
+
+    elif (g['mimetype'] == 'application/x-videoegg-loader' and
+          g['clientOS'].startswith('Win')):
+        plugin.update(
+            name='VideoEgg Publisher',
+            guid='{b8b881f0-2e07-11db-a98b-0800200c9a66}',
+            iconUrl='http://videoegg.com/favicon.ico',
+            XPILocation='http://update.videoegg.com/Install/Windows/Initial/VideoEggPublisher.xpi',
+            InstallerShowsUI='true',
+            manualInstallationURL='http://www.videoegg.com/')
+
+    elif (g['mimetype'] == 'video/divx' and
+          g['clientOS'].startswith('Win')):
+        plugin.update(
+            name='DivX Web Player',
+            guid='{a8b771f0-2e07-11db-a98b-0800200c9a66}',
+            iconUrl='http://images.divx.com/divx/player/webplayer.png',
+            XPILocation='http://download.divx.com/player/DivXWebPlayer.xpi',
+            InstallerShowsUI='false',
+            licenseURL='http://go.divx.com/plugin/license/',
+            manualInstallationURL='http://go.divx.com/plugin/download/')
+
+    elif (g['mimetype'] == 'video/divx' and
+          re.match(r'^(PPC|Intel) Mac OS X', g['clientOS'])):
+        plugin.update(
+            name='DivX Web Player',
+            guid='{a8b771f0-2e07-11db-a98b-0800200c9a66}',
+            iconUrl='http://images.divx.com/divx/player/webplayer.png',
+            XPILocation='http://download.divx.com/player/DivXWebPlayerMac.xpi',
+            InstallerShowsUI='false',
+            licenseURL='http://go.divx.com/plugin/license/',
+            manualInstallationURL='http://go.divx.com/plugin/download/')
+
+    return output.substitute(plugin)
+
+
+MIMETYPES = [
+    'application/x-shockwave-flash', 'application/futuresplash',
+    'application/x-director', 'audio/x-pn-realaudio-plugin',
+    'audio/x-pn-realaudio', 'audio/mpeg', 'video/quicktime', 'image/png',
+    'application/x-java-vm', 'application/x-java-applet;version=1.4.2',
+    'application/x-java-bean;jpi-version=1.5', 'application/pdf',
+    'application/vnd.adobe.xdp+xml', 'application/x-mtx',
+    'application/x-mplayer2', 'video/x-ms-wmv', 'audio/x-ms-wma',
+    'application/x-xstandard', 'application/x-dnl',
+    'application/x-videoegg-loader', 'video/divx', 'application/x-unknown',
+    'text/html', '<script>', '',
+]
+OSES = ['Windows NT 5.1', 'Windows NT 6.0', 'Windows NT 6.1', 'WINNT',
+        'PPC Mac OS X 10.4', 'Intel Mac OS X 10.6', 'Linux i686',
+        'Linux x86_64', 'SunOS 5.10', 'SunOs', 'FreeBSD amd64', '']
+LOCALES = ['en-US', 'ja-JP', 'de']
+
+
+def queries():
+    for mimetype in MIMETYPES:
+        for client_os in OSES:
+            for locale in LOCALES:
+                yield {'mimetype': mimetype, 'appID': '{ec8030f7}',
+                       'appVersion': '2012061600', 'clientOS': client_os,
+                       'chromeLocale': locale}
+    # Missing parameters.
+    yield {'mimetype': 'video/divx'}
+    yield {}
+
+
+def timed(get_output, data, number):
+    start = time()
+    for i in xrange(number):
+        get_output(data[i % len(data)])
+    return number / (time() - start)
+
+
+def main(number):
+    data = list(queries())
+    for query in data:
+        old = legacy_output(query).encode('utf-8')
+        new = pfs.get_output(query)
+        if old != new:
+            print 'Different output for %s' % query
+            sys.exit(1)
+    print 'Same output for %s queries.' % len(data)
+
+    before = timed(legacy_output, data, number)
+    after = timed(pfs.get_output, data, number)
+    print 'if/elif chain: %.0f requests/s' % before
+    print 'rules: %.0f requests/s (%.1fx)' % (after, after / before)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
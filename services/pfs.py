@@ -1,20 +1,17 @@
 from collections import defaultdict
 from email.Utils import formatdate
+import json
+import os
 import re
 from string import Template
 import sys
 from time import time
 from urlparse import parse_qsl
 
-from django.core.management import setup_environ
-
 import commonware.log
 import jinja2
 
-from utils import log_configure
-
-import settings_local as settings
-setup_environ(settings)
+from utils import log_configure, settings
 
 # This has to be imported after the settings so statsd knows where to log to.
 from statsd import statsd
@@ -58,298 +55,170 @@ xml_template = """\
 </RDF:RDF>
 """
 
-flash_re = re.compile(r'^(Win|(PPC|Intel) Mac OS X|Linux.+i\d86)|SunOs', re.IGNORECASE)
-quicktime_re = re.compile(r'^(application/(sdp|x-(mpeg|rtsp|sdp))|audio/(3gpp(2)?|AMR|aiff|basic|mid(i)?|mp4|mpeg|vnd\.qcelp|wav|x-(aiff|m4(a|b|p)|midi|mpeg|wav))|image/(pict|png|tiff|x-(macpaint|pict|png|quicktime|sgi|targa|tiff))|video/(3gpp(2)?|flc|mp4|mpeg|quicktime|sd-video|x-mpeg))$')
-java_re = re.compile(r'^application/x-java-((applet|bean)(;jpi-version=1\.5|;version=(1\.(1(\.[1-3])?|(2|4)(\.[1-2])?|3(\.1)?|5)))?|vm)$')
-wmp_re = re.compile(r'^(application/(asx|x-(mplayer2|ms-wmp))|video/x-ms-(asf(-plugin)?|wm(p|v|x)?|wvx)|audio/x-ms-w(ax|ma))$')
+# The plugins we know about live in settings.PFS_RULES, an ordered list of
+# rules where the first one to match the mimetype and the clientOS wins.
+# Each rule has either a list of `mimetypes` or a `mimetype_re`, an
+# optional `os` regex (case insensitive with `ignorecase`), the `plugin`
+# fields to fill in and a list of `variants`. The first variant whose `os`
+# regex and `locale` match (or that has neither) adds its own `plugin`
+# fields on top.
+PLUGIN_DEFAULTS = dict(name='-1', guid='-1', version='', iconUrl='',
+                       XPILocation='', InstallerLocation='', InstallerHash='',
+                       InstallerShowsUI='', manualInstallationURL='',
+                       licenseURL='', needsRestart='true')
+
+REQUIRED = ['mimetype', 'appID', 'appVersion', 'clientOS', 'chromeLocale']
+
+# How often to look for a new rules file, in seconds.
+RELOAD_INTERVAL = 5
+
+# How many rendered bodies and mimetype lookups to hold on to.
+CACHE_SIZE = 2000
+
+
+def render(plugin):
+    """
+    The xml for `plugin` split around $mimetype, which is the only part
+    that comes from the request.
+    """
+    fields = dict(PLUGIN_DEFAULTS, **plugin)
+    xml = Template(xml_template).safe_substitute(fields)
+    return xml.split('$mimetype')
+
+
+class Rules(object):
+    """The rules compiled into lookups and pre-rendered bodies."""
+
+    def __init__(self, rules):
+        self.rules = []
+        self.exact = defaultdict(list)
+        self.patterns = []
+        for index, rule in enumerate(rules):
+            flags = re.IGNORECASE if rule.get('ignorecase') else 0
+            compiled = {'os': self.compile(rule.get('os'), flags),
+                        'variants': []}
+            for variant in rule.get('variants', []):
+                compiled['variants'].append(
+                    (self.compile(variant.get('os')),
+                     variant.get('locale'),
+                     render(dict(rule.get('plugin', {}),
+                                 **variant['plugin']))))
+            compiled['body'] = render(rule.get('plugin', {}))
+            self.rules.append(compiled)
+            for mimetype in rule.get('mimetypes', []):
+                self.exact[mimetype].append(index)
+            if 'mimetype_re' in rule:
+                self.patterns.append((index, re.compile(rule['mimetype_re'])))
+        # One pass over all the regexes to rule out most mimetypes.
+        self.combined = re.compile('|'.join('(?:%s)' % p.pattern
+                                            for _, p in self.patterns))
+        self.default = render({})
+        self.matches = {}
+        self.bodies = {}
+        # Warm up the bodies for the mimetypes we know by name.
+        for mimetype in self.exact:
+            for index in self.exact[mimetype]:
+                for variant in range(len(self.rules[index]['variants'])):
+                    self.body(mimetype, index, variant)
+                self.body(mimetype, index, None)
+            self.body(mimetype, None, None)
+
+    def compile(self, pattern, flags=0):
+        return re.compile(pattern, flags) if pattern else None
+
+    def candidates(self, mimetype):
+        """The indexes of the rules for `mimetype`, in order."""
+        rv = self.matches.get(mimetype)
+        if rv is None:
+            rv = list(self.exact.get(mimetype, []))
+            if self.patterns and self.combined.match(mimetype):
+                rv.extend(index for index, pattern in self.patterns
+                          if pattern.match(mimetype))
+                rv.sort()
+            if len(self.matches) >= CACHE_SIZE:
+                self.matches.clear()
+            self.matches[mimetype] = rv
+        return rv
+
+    def resolve(self, mimetype, client_os, locale):
+        """The (rule, variant) indexes to use, or (None, None)."""
+        for index in self.candidates(mimetype):
+            rule = self.rules[index]
+            if rule['os'] and not rule['os'].match(client_os):
+                continue
+            for variant, (os_re, lang, _) in enumerate(rule['variants']):
+                if ((not os_re or os_re.match(client_os)) and
+                    (not lang or lang == locale)):
+                    return index, variant
+            return index, None
+        return None, None
+
+    def body(self, mimetype, index, variant):
+        """The utf-8 response for `mimetype` out of rule `index`."""
+        key = mimetype, index, variant
+        rv = self.bodies.get(key)
+        if rv is None:
+            if index is None:
+                parts = self.default
+            elif variant is None:
+                parts = self.rules[index]['body']
+            else:
+                parts = self.rules[index]['variants'][variant][2]
+            rv = unicode(mimetype or '-1').join(parts).encode('utf-8')
+            if len(self.bodies) >= CACHE_SIZE:
+                self.bodies.clear()
+            self.bodies[key] = rv
+        return rv
+
+
+class RulesFile(object):
+    """
+    Loads the rules and picks up changes to the file, so updating a plugin
+    doesn't need a deploy. A broken file is logged and the last good rules
+    stay in use.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.rules = None
+        self.mtime = None
+        self.checked = 0
+
+    def get(self):
+        now = time()
+        if self.rules is None or now - self.checked > RELOAD_INTERVAL:
+            self.checked = now
+            try:
+                mtime = os.stat(self.path).st_mtime
+                if mtime != self.mtime:
+                    with open(self.path) as fp:
+                        self.rules = Rules(json.load(fp))
+                    self.mtime = mtime
+                    statsd.incr('services.pfs.reload')
+            except (IOError, OSError, ValueError, re.error):
+                if self.rules is None:
+                    raise
+                error_log.error(u'Could not reload %s, keeping the old '
+                                u'rules.' % self.path, exc_info=True)
+        return self.rules
+
+
+rules_file = RulesFile(settings.PFS_RULES)
 
 
 def get_output(data):
-    g = defaultdict(str, [(k, jinja2.escape(v)) for k, v in data.iteritems()])
-
-    required = ['mimetype', 'appID', 'appVersion', 'clientOS', 'chromeLocale']
-
-    # Some defaults we override depending on what we find below.
-    plugin = dict(mimetype='-1', name='-1', guid='-1', version='',
-                  iconUrl='', XPILocation='', InstallerLocation='',
-                  InstallerHash='', InstallerShowsUI='',
-                  manualInstallationURL='', licenseURL='',
-                  needsRestart='true')
+    g = dict((k, jinja2.escape(v)) for k, v in data.iteritems())
+    rules = rules_file.get()
+    mimetype = g.get('mimetype', '')
 
-    # Special case for mimetype if they are provided.
-    plugin['mimetype'] = g['mimetype'] or '-1'
-
-    output = Template(xml_template)
-
-    for s in required:
+    for s in REQUIRED:
         if s not in data:
             # A sort of 404, matching what was returned in the original PHP.
-            return output.substitute(plugin)
-
-    # Figure out what plugins we've got, and what plugins we know where
-    # to get.
-
-    # Begin our huge and embarrassing if-else statement.
-    if (g['mimetype'] in ['application/x-shockwave-flash',
-                          'application/futuresplash'] and
-        re.match(flash_re, g['clientOS'])):
-
-        # We really want the regexp for Linux to be /Linux(?! x86_64)/ but
-        # for now we can't tell 32-bit linux appart from 64-bit linux, so
-        # feed all x86_64 users the flash player, even if it's a 32-bit
-        # plugin.
-
-        # We've got flash plugin installers for Win and Linux (x86),
-        # present those to the user, and for Mac users, tell them where
-        # they can go to get the installer.
-
-        plugin.update(
-            name='Adobe Flash Player',
-            manualInstallationURL='http://www.adobe.com/go/getflashplayer')
-
-        # Don't use a https URL for the license here, per request from
-        # Macromedia.
-
-        if g['clientOS'].startswith('Win'):
-            plugin.update(
-                guid='{4cfaef8a-a6c9-41a0-8e6f-967eb8f49143}',
-                XPILocation='',
-                iconUrl='http://fpdownload2.macromedia.com/pub/flashplayer/current/fp_win_installer.ico',
-                needsRestart='false',
-                InstallerShowsUI='true',
-                version='11.3.300.262',
-                InstallerHash='sha256:295e3484a53712d760d0ebfce5719b984f2fc08d393ddca0f9e3a0018ba42c8f',
-                InstallerLocation='http://download.macromedia.com/pub/flashplayer/pdc/11.3.300.262/fp_pl_pfs_installer.exe')
-
-
-    elif (g['mimetype'] == 'application/x-director' and
-          g['clientOS'].startswith('Win')):
-        plugin.update(
-            name='Adobe Shockwave Player',
-            manualInstallationURL='http://get.adobe.com/shockwave/')
-
-        # Even though the shockwave installer is not a silent installer, we
-        # need to show its EULA here since we've got a slimmed down
-        # installer that doesn't do that itself.
-        if g['chromeLocale'] != 'ja-JP':
-            plugin.update(
-                licenseURL='http://www.adobe.com/go/eula_shockwaveplayer')
-        else:
-            plugin.update(
-                licenseURL='http://www.adobe.com/go/eula_shockwaveplayer_jp')
-        plugin.update(
-            guid='{45f2a22c-4029-4209-8b3d-1421b989633f}',
-            XPILocation='',
-            version='11.6.5.635',
-            InstallerHash='sha256:06e68ef5308c64f1a4334be93cdea473c1ef04c6afc4fadc03f90a1447e709d0',
-            InstallerLocation='http://fpdownload.macromedia.com/pub/shockwave/default/english/win95nt/latest/Shockwave_Installer_FF.exe',
-            needsRestart='false',
-            InstallerShowsUI='false')
-
-    elif (g['mimetype'] in ['audio/x-pn-realaudio-plugin',
-                            'audio/x-pn-realaudio'] and
-          re.match(r'^(Win|Linux|PPC Mac OS X)', g['clientOS'])):
-        plugin.update(
-            name='Real Player',
-            version='10.5',
-            manualInstallationURL='http://www.real.com')
-
-        if g['clientOS'].startswith('Win'):
-            plugin.update(
-                XPILocation='http://forms.real.com/real/player/download.html?type=firefox',
-                guid='{d586351c-cb55-41a7-8e7b-4aaac5172d39}')
-        else:
-            plugin.update(
-                guid='{269eb771-59de-4702-9209-ca97ce522f6d}')
-
-    elif (re.match(quicktime_re, g['mimetype']) and
-          re.match(r'^(Win|PPC Mac OS X)', g['clientOS'])):
-
-        # Well, we don't have a plugin that can handle any of those
-        # mimetypes, but the Apple Quicktime plugin can. Point the user to
-        # the Quicktime download page.
-
-        plugin.update(
-            name='Apple Quicktime',
-            guid='{a42bb825-7eee-420f-8ee7-834062b6fefd}',
-            InstallerShowsUI='true',
-            manualInstallationURL='http://www.apple.com/quicktime/download/')
-
-    elif (re.match(java_re, g['mimetype']) and
-          re.match(r'^(Win|Linux|PPC Mac OS X)', g['clientOS'])):
-
-        # We serve up the Java plugin for the following mimetypes:
-        #
-        # application/x-java-vm
-        # application/x-java-applet;jpi-version=1.5
-        # application/x-java-bean;jpi-version=1.5
-        # application/x-java-applet;version=1.3
-        # application/x-java-bean;version=1.3
-        # application/x-java-applet;version=1.2.2
-        # application/x-java-bean;version=1.2.2
-        # application/x-java-applet;version=1.2.1
-        # application/x-java-bean;version=1.2.1
-        # application/x-java-applet;version=1.4.2
-        # application/x-java-bean;version=1.4.2
-        # application/x-java-applet;version=1.5
-        # application/x-java-bean;version=1.5
-        # application/x-java-applet;version=1.3.1
-        # application/x-java-bean;version=1.3.1
-        # application/x-java-applet;version=1.4
-        # application/x-java-bean;version=1.4
-        # application/x-java-applet;version=1.4.1
-        # application/x-java-bean;version=1.4.1
-        # application/x-java-applet;version=1.2
-        # application/x-java-bean;version=1.2
-        # application/x-java-applet;version=1.1.3
-        # application/x-java-bean;version=1.1.3
-        # application/x-java-applet;version=1.1.2
-        # application/x-java-bean;version=1.1.2
-        # application/x-java-applet;version=1.1.1
-        # application/x-java-bean;version=1.1.1
-        # application/x-java-applet;version=1.1
-        # application/x-java-bean;version=1.1
-        # application/x-java-applet
-        # application/x-java-bean
-        #
-        #
-        # We don't have a Java plugin to offer here, but Sun's got one for
-        # Windows. For other platforms we know where to get one, point the
-        # user to the JRE download page.
-
-        plugin.update(
-            name='Java Runtime Environment',
-            version='1.7 u4',
-            manualInstallationURL='http://java.com/downloads',
-            InstallerShowsUI='false',
-            needsRestart='false')
-
-        # For now, send Vista users to a manual download page.
-        #
-        # This is a temp fix for bug 366129 until vista has a non-manual
-        # solution.
-        if g['clientOS'].startswith('Windows NT 6.0'):
-            plugin.update(
-                guid='{fbe640ef-4375-4f45-8d79-767d60bf75b8}',
-                InstallerLocation='http://java.com/firefoxjre_exe',
-                InstallerHash='sha1:fd67d63faa58945d875ec2f7666a43d79dedc3b1')
-        elif g['clientOS'].startswith('Win'):
-            plugin.update(
-                guid='{92a550f2-dfd2-4d2f-a35d-a98cfda73595}',
-                InstallerLocation='http://java.com/firefoxjre_exe',
-                InstallerHash='sha1:fd67d63faa58945d875ec2f7666a43d79dedc3b1',
-                XPILocation='http://java.com/jre-install.xpi')
-        else:
-            plugin.update(
-                guid='{fbe640ef-4375-4f45-8d79-767d60bf75b8}')
-
-    elif (g['mimetype'] in ['application/pdf', 'application/vnd.fdf',
-                            'application/vnd.adobe.xfdf',
-                            'application/vnd.adobe.xdp+xml',
-                            'application/vnd.adobe.xfd+xml'] and
-          re.match(r'^(Win|PPC Mac OS X|Linux(?! x86_64))', g['clientOS'])):
-        plugin.update(
-            name='Adobe Acrobat Plug-In',
-            guid='{d87cd824-67cb-4547-8587-616c70318095}',
-            manualInstallationURL='http://www.adobe.com/products/acrobat/readstep.html')
-
-    elif (g['mimetype'] == 'application/x-mtx' and
-          re.match(r'^(Win|PPC Mac OS X)', g['clientOS'])):
-        plugin.update(
-            name='Viewpoint Media Player',
-            guid='{03f998b2-0e00-11d3-a498-00104b6eb52e}',
-            manualInstallationURL='http://www.viewpoint.com/pub/products/vmp.html')
-
-    elif re.match(wmp_re, g['mimetype']):
-        # We serve up the Windows Media Player plugin for the following
-        # mimetypes:
-        #
-        # application/asx
-        # application/x-mplayer2
-        # audio/x-ms-wax
-        # audio/x-ms-wma
-        # video/x-ms-asf
-        # video/x-ms-asf-plugin
-        # video/x-ms-wm
-        # video/x-ms-wmp
-        # video/x-ms-wmv
-        # video/x-ms-wmx
-        # video/x-ms-wvx
-        #
-        # For all windows users who don't have the WMP 11 plugin, give them
-        # a link for it.
-        if g['clientOS'].startswith('Win'):
-            plugin.update(
-                name='Windows Media Player',
-                version='11',
-                guid='{cff1240a-fd24-4b9f-8183-ccd96e5300d0}',
-                manualInstallationURL='http://port25.technet.com/pages/windows-media-player-firefox-plugin-download.aspx')
-
-        # For OSX users -- added Intel to this since flip4mac is a UB.
-        # Contact at MS was okay w/ this, plus MS points to this anyway.
-        elif re.match(r'^(PPC|Intel) Mac OS X', g['clientOS']):
-            plugin.update(
-                name='Flip4Mac',
-                version='2.1',
-                guid='{cff0240a-fd24-4b9f-8183-ccd96e5300d0}',
-                manualInstallationURL='http://www.flip4mac.com/wmv_download.htm')
-
-    elif (g['mimetype'] == 'application/x-xstandard' and
-          re.match(r'^(Win|PPC Mac OS X)', g['clientOS'])):
-        plugin.update(
-            name='XStandard XHTML WYSIWYG Editor',
-            guid='{3563d917-2f44-4e05-8769-47e655e92361}',
-            iconUrl='http://xstandard.com/images/xicon32x32.gif',
-            XPILocation='http://xstandard.com/download/xstandard.xpi',
-            InstallerShowsUI='false',
-            manualInstallationURL='http://xstandard.com/download/',
-            licenseURL='http://xstandard.com/license/')
-
-    elif (g['mimetype'] == 'application/x-dnl' and
-          g['clientOS'].startswith('Win')):
-        plugin.update(
-            name='DNL Reader',
-            guid='{ce9317a3-e2f8-49b9-9b3b-a7fb5ec55161}',
-            version='5.5',
-            iconUrl='http://digitalwebbooks.com/reader/dwb16.gif',
-            XPILocation='http://digitalwebbooks.com/reader/xpinst.xpi',
-            InstallerShowsUI='false',
-            manualInstallationURL='http://digitalwebbooks.com/reader/')
-
-    elif (g['mimetype'] == 'application/x-videoegg-loader' and
-          g['clientOS'].startswith('Win')):
-        plugin.update(
-            name='VideoEgg Publisher',
-            guid='{b8b881f0-2e07-11db-a98b-0800200c9a66}',
-            iconUrl='http://videoegg.com/favicon.ico',
-            XPILocation='http://update.videoegg.com/Install/Windows/Initial/VideoEggPublisher.xpi',
-            InstallerShowsUI='true',
-            manualInstallationURL='http://www.videoegg.com/')
-
-    elif (g['mimetype'] == 'video/divx' and
-          g['clientOS'].startswith('Win')):
-        plugin.update(
-            name='DivX Web Player',
-            guid='{a8b771f0-2e07-11db-a98b-0800200c9a66}',
-            iconUrl='http://images.divx.com/divx/player/webplayer.png',
-            XPILocation='http://download.divx.com/player/DivXWebPlayer.xpi',
-            InstallerShowsUI='false',
-            licenseURL='http://go.divx.com/plugin/license/',
-            manualInstallationURL='http://go.divx.com/plugin/download/')
-
-    elif (g['mimetype'] == 'video/divx' and
-          re.match(r'^(PPC|Intel) Mac OS X', g['clientOS'])):
-        plugin.update(
-            name='DivX Web Player',
-            guid='{a8b771f0-2e07-11db-a98b-0800200c9a66}',
-            iconUrl='http://images.divx.com/divx/player/webplayer.png',
-            XPILocation='http://download.divx.com/player/DivXWebPlayerMac.xpi',
-            InstallerShowsUI='false',
-            licenseURL='http://go.divx.com/plugin/license/',
-            manualInstallationURL='http://go.divx.com/plugin/download/')
-
-    # End ridiculously huge and embarrassing if-else block.
-    return output.substitute(plugin)
+            return rules.body(mimetype, None, None)
+
+    index, variant = rules.resolve(mimetype, g['clientOS'],
+                                   g['chromeLocale'])
+    return rules.body(mimetype, index, variant)
 
 
 def format_date(secs):
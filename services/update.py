@@ -1,20 +1,17 @@
+from datetime import datetime, timedelta
 from email.Utils import formatdate
-from email.mime.text import MIMEText
-import smtplib
+import json
+import random
 import sys
+import threading
 from time import time
 import traceback
 from urlparse import parse_qsl
 
-import MySQLdb as mysql
-import sqlalchemy.pool as pool
-
 import commonware.log
-from django.core.management import setup_environ
 from django.utils.http import urlencode
 
-import settings_local as settings
-setup_environ(settings)
+from utils import settings
 # This has to be imported after the settings so statsd knows where to log to.
 from statsd import statsd
 
@@ -24,15 +21,22 @@ except ImportError:
     from apps.versions.compare import version_int
 
 from constants import applications, base
-from utils import (get_mirror, log_configure, APP_GUIDS, PLATFORMS,
-                   STATUSES_PUBLIC)
+from update_cache import UpdateCache
+from update_index import status_check, version_key, UpdateIndex
+from utils import (get_mirror, get_pool, log_configure, APP_GUIDS,
+                   PLATFORMS, STATUSES_PUBLIC)
 
 # Go configure the log.
 log_configure()
 
-good_rdf = """<?xml version="1.0"?>
+rdf_start = """<?xml version="1.0"?>
 <RDF:RDF xmlns:RDF="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
          xmlns:em="http://www.mozilla.org/2004/em-rdf#">
+"""
+
+rdf_end = """</RDF:RDF>"""
+
+good_description = """\
     <RDF:Description about="urn:mozilla:%(type)s:%(guid)s">
         <em:updates>
             <RDF:Seq>
@@ -54,43 +58,167 @@ good_rdf = """<?xml version="1.0"?>
             </RDF:Description>
         </em:targetApplication>
     </RDF:Description>
-</RDF:RDF>"""
-
-
-bad_rdf = """<?xml version="1.0"?>
-<RDF:RDF xmlns:RDF="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
-         xmlns:em="http://www.mozilla.org/2004/em-rdf#">
-</RDF:RDF>"""
-
+"""
 
-no_updates_rdf = """<?xml version="1.0"?>
-<RDF:RDF xmlns:RDF="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
-         xmlns:em="http://www.mozilla.org/2004/em-rdf#">
+no_updates_description = """\
     <RDF:Description about="urn:mozilla:%(type)s:%(guid)s">
         <em:updates>
             <RDF:Seq>
             </RDF:Seq>
         </em:updates>
     </RDF:Description>
-</RDF:RDF>"""
+"""
+
+good_rdf = rdf_start + good_description + rdf_end
+
+
+bad_rdf = rdf_start + rdf_end
+
+
+no_updates_rdf = rdf_start + no_updates_description + rdf_end
+
+
+update_select = """
+            SELECT
+                addons.guid as guid, addons.addontype_id as type,
+                addons.inactive as disabled_by_user,
+                applications.guid as appguid, appmin.version as min,
+                appmax.version as max, files.id as file_id,
+                files.status as file_status, files.hash,
+                files.filename, versions.id as version_id,
+                files.datestatuschanged as datestatuschanged,
+                files.strict_compatibility as strict_compat,
+                versions.releasenotes, versions.version as version,
+                addons.premium_type
+            FROM versions
+            INNER JOIN addons
+                ON addons.id = versions.addon_id AND {addons}
+            INNER JOIN applications_versions
+                ON applications_versions.version_id = versions.id
+            INNER JOIN applications
+                ON applications_versions.application_id = applications.id
+                AND applications.id = %(app_id)s
+            INNER JOIN appversions appmin
+                ON appmin.id = applications_versions.min
+            INNER JOIN appversions appmax
+                ON appmax.id = applications_versions.max
+            INNER JOIN files
+                ON files.version_id = versions.id AND (files.platform_id = 1
+            """
+
+update_columns = [
+    'guid', 'type', 'disabled_by_user', 'appguid', 'min', 'max', 'file_id',
+    'file_status', 'hash', 'filename', 'version_id', 'datestatuschanged',
+    'strict_compat', 'releasenotes', 'version', 'premium_type']
+
+
+def compat_sql(compat_mode, data):
+    """
+    The app version part of the update query for the given compat mode,
+    shared by `Update` and `BatchUpdate`.
+    """
+    sql = ['AND appmin.version_int <= %(version_int)s ']
+
+    if compat_mode == 'ignore':
+        pass  # no further SQL modification required.
+
+    elif compat_mode == 'normal':
+        # When file has strict_compatibility enabled, or file has binary
+        # components, default to compatible is disabled.
+        sql.append("""AND
+            CASE WHEN files.strict_compatibility = 1 OR
+                      files.binary_components = 1
+            THEN appmax.version_int >= %(version_int)s ELSE 1 END
+        """)
+        # Filter out versions that don't have the minimum maxVersion
+        # requirement to qualify for default-to-compatible.
+        d2c_max = applications.D2C_MAX_VERSIONS.get(data['app_id'])
+        if d2c_max:
+            data['d2c_max_version'] = version_int(d2c_max)
+            sql.append("AND appmax.version_int >= %(d2c_max_version)s ")
+
+        # Filter out versions found in compat overrides
+        sql.append("""AND
+            NOT versions.id IN (
+            SELECT version_id FROM incompatible_versions
+            WHERE app_id=%(app_id)s AND
+              (min_app_version='0' AND
+                   max_app_version_int >= %(version_int)s) OR
+              (min_app_version_int <= %(version_int)s AND
+                   max_app_version='*') OR
+              (min_app_version_int <= %(version_int)s AND
+                   max_app_version_int >= %(version_int)s)) """)
+
+    else:  # Not defined or 'strict'.
+        sql.append('AND appmax.version_int >= %(version_int)s ')
+
+    return sql
 
 
 timing_log = commonware.log.getLogger('z.timer')
 error_log = commonware.log.getLogger('z.services')
 
 
-def getconn():
-    db = settings.SERVICES_DATABASE
-    return mysql.connect(host=db['HOST'], user=db['USER'],
-                         passwd=db['PASSWORD'], db=db['NAME'])
+update_index = None
+update_cache = None
+
+
+def get_index():
+    """
+    Returns the update index for this worker, or None if it is switched off
+    or hasn't loaded yet. Refreshes happen in the background so that no
+    request ever waits on them.
+    """
+    global update_index
+    if not settings.SERVICES_UPDATE_INDEX:
+        return None
+
+    if update_index is None:
+        update_index = UpdateIndex(
+            refresh=settings.SERVICES_UPDATE_INDEX_REFRESH,
+            rebuild=settings.SERVICES_UPDATE_INDEX_REBUILD,
+            check=settings.SERVICES_UPDATE_INDEX_CHECK)
+
+    if update_index.stale() and not update_index.lock.locked():
+        thread = threading.Thread(target=refresh_index, args=(update_index,))
+        thread.daemon = True
+        thread.start()
+
+    return update_index if update_index.ready else None
 
 
-mypool = pool.QueuePool(getconn, max_overflow=10, pool_size=5, recycle=300)
+def get_cache():
+    """Returns the rdf cache for this worker, or None if it's switched off."""
+    global update_cache
+    if not settings.SERVICES_UPDATE_CACHE:
+        return None
+
+    if update_cache is None:
+        update_cache = UpdateCache(
+            size=settings.SERVICES_UPDATE_CACHE_SIZE,
+            timeout=settings.SERVICES_UPDATE_CACHE_TIMEOUT)
+    return update_cache
+
+
+def refresh_index(index):
+    # The index picks up changes by their modified date, so it reads from
+    # the master where rows can't show up late.
+    conn = get_pool('index').connect()
+    try:
+        with statsd.timer('services.update.index.refresh'):
+            count = index.refresh(conn.cursor())
+        if count is not None:
+            timing_log.info('Update index refreshed: %s add-ons' % count)
+    except:
+        log_exception('update index refresh')
+    finally:
+        conn.close()
 
 
 class Update(object):
 
-    def __init__(self, data, compat_mode='strict'):
+    def __init__(self, data, compat_mode='strict', index=None,
+                 rdf_cache=None):
         self.conn, self.cursor = None, None
         self.data = data.copy()
         self.data['row'] = {}
@@ -98,13 +226,23 @@ class Update(object):
         self.is_beta_version = False
         self.version_int = 0
         self.compat_mode = compat_mode
+        # When set, add-ons found in the index are answered from memory and
+        # everything else falls back to the db.
+        self.index = index
+        self.use_index = False
+        self.rdf_cache = rdf_cache
 
-    def is_valid(self):
+    def connect(self):
         # If you accessing this from unit tests, then before calling
         # is valid, you can assign your own cursor.
         if not self.cursor:
-            self.conn = mypool.connect()
+            self.conn = get_pool('update', readonly=True).connect()
             self.cursor = self.conn.cursor()
+        return self.cursor
+
+    def is_valid(self):
+        if self.index is None:
+            self.connect()
 
         data = self.data
         # Version can be blank.
@@ -117,27 +255,31 @@ class Update(object):
         if not data['app_id']:
             return False
 
-        sql = """SELECT id, status, addontype_id, guid FROM addons
-                 WHERE guid = %(guid)s AND
-                       inactive = 0 AND
-                       status != %(STATUS_DELETED)s
-                 LIMIT 1;"""
-        self.cursor.execute(sql, {'guid': self.data['id'],
-                                  'STATUS_DELETED': base.STATUS_DELETED})
-        result = self.cursor.fetchone()
+        result = None
+        if self.index is not None:
+            addon = self.index.get_addon(data['id'])
+            if addon:
+                self.use_index = True
+                result = addon[:4]
+
         if result is None:
-            return False
+            sql = """SELECT id, status, addontype_id, guid FROM addons
+                     WHERE guid = %(guid)s AND
+                           inactive = 0 AND
+                           status != %(STATUS_DELETED)s
+                     LIMIT 1;"""
+            self.connect().execute(sql, {
+                'guid': self.data['id'],
+                'STATUS_DELETED': base.STATUS_DELETED})
+            result = self.cursor.fetchone()
+            if result is None:
+                return False
 
         data['id'], data['addon_status'], data['type'], data['guid'] = result
         data['version_int'] = version_int(data['appVersion'])
 
         if 'appOS' in data:
-            for k, v in PLATFORMS.items():
-                if k in data['appOS']:
-                    data['appOS'] = v
-                    break
-            else:
-                data['appOS'] = None
+            data['appOS'] = get_platform(data['appOS'])
 
         self.is_beta_version = base.VERSION_BETA.search(data['version'])
         return True
@@ -150,17 +292,9 @@ class Update(object):
             # Beta channel looks at the addon name to see if it's beta.
             if self.is_beta_version:
                 # For beta look at the status of the existing files.
-                sql = """
-                    SELECT versions.id, status
-                    FROM files INNER JOIN versions
-                    ON files.version_id = versions.id
-                    WHERE versions.addon_id = %(id)s
-                          AND versions.version = %(version)s LIMIT 1;"""
-                self.cursor.execute(sql, data)
-                result = self.cursor.fetchone()
+                status = self.get_beta_status()
                 # Only change the status if there are files.
-                if result is not None:
-                    status = result[1]
+                if status is not None:
                     # If it's in Beta or Public, then we should be looking
                     # for similar. If not, find something public.
                     if status in (base.STATUS_BETA, base.STATUS_PUBLIC):
@@ -177,37 +311,71 @@ class Update(object):
             data['status'] = base.STATUS_NULL
             self.flags['use_version'] = True
 
+    def get_beta_status(self):
+        """The status of the files for a beta version, None if there are
+        no files."""
+        data = self.data
+        if self.use_index:
+            return self.index.get_beta_status(data['id'], data['version'])
+
+        sql = """
+            SELECT versions.id, status
+            FROM files INNER JOIN versions
+            ON files.version_id = versions.id
+            WHERE versions.addon_id = %(id)s
+                  AND versions.version = %(version)s LIMIT 1;"""
+        self.cursor.execute(sql, data)
+        result = self.cursor.fetchone()
+        return result[1] if result is not None else None
+
     def get_update(self):
         self.get_beta()
         data = self.data
 
-        sql = ["""
-            SELECT
-                addons.guid as guid, addons.addontype_id as type,
-                addons.inactive as disabled_by_user,
-                applications.guid as appguid, appmin.version as min,
-                appmax.version as max, files.id as file_id,
-                files.status as file_status, files.hash,
-                files.filename, versions.id as version_id,
-                files.datestatuschanged as datestatuschanged,
-                files.strict_compatibility as strict_compat,
-                versions.releasenotes, versions.version as version,
-                addons.premium_type
-            FROM versions
-            INNER JOIN addons
-                ON addons.id = versions.addon_id AND addons.id = %(id)s
-            INNER JOIN applications_versions
-                ON applications_versions.version_id = versions.id
-            INNER JOIN applications
-                ON applications_versions.application_id = applications.id
-                AND applications.id = %(app_id)s
-            INNER JOIN appversions appmin
-                ON appmin.id = applications_versions.min
-            INNER JOIN appversions appmax
-                ON appmax.id = applications_versions.max
-            INNER JOIN files
-                ON files.version_id = versions.id AND (files.platform_id = 1
-            """]
+        if self.use_index:
+            row = self.index.get_update(data, self.flags, self.compat_mode)
+            if self.index.check and random.random() < self.index.check:
+                row = self.check_index(row)
+        else:
+            row = self.get_update_row()
+
+        if row:
+            row['type'] = base.ADDON_SLUGS_UPDATE[row['type']]
+            if row['premium_type'] in base.ADDON_PREMIUMS:
+                qs = urlencode(dict((k, data.get(k, ''))
+                               for k in base.WATERMARK_KEYS))
+                row['url'] = (u'%s/downloads/watermarked/%s?%s' %
+                              (settings.SITE_URL, row['file_id'], qs))
+            else:
+                row['url'] = get_mirror(self.data['addon_status'],
+                                        self.data['id'], row)
+            data['row'] = row
+            return True
+
+        return False
+
+    def check_index(self, row):
+        """
+        Runs the update query for an answer that came from the index and
+        returns the query's answer, counting and logging any difference.
+        """
+        self.connect()
+        expected = self.get_update_row()
+        got = row and row['version_id']
+        wanted = expected and expected['version_id']
+        if got != wanted:
+            statsd.incr('services.update.index.mismatch')
+            error_log.error(u'Update index gave %s, expected %s. Data: %s' %
+                            (got, wanted, self.data))
+        else:
+            statsd.incr('services.update.index.match')
+        return expected
+
+    def get_update_row(self):
+        """Runs the update query, returning the best row as a dict."""
+        data = self.data
+
+        sql = [update_select.format(addons='addons.id = %(id)s')]
         if data.get('appOS'):
             sql.append(' OR files.platform_id = %(appOS)s')
 
@@ -223,88 +391,85 @@ class Update(object):
             else:
                 sql.append(') WHERE files.status = %(status)s ')
 
-        sql.append('AND appmin.version_int <= %(version_int)s ')
-
-        if self.compat_mode == 'ignore':
-            pass  # no further SQL modification required.
-
-        elif self.compat_mode == 'normal':
-            # When file has strict_compatibility enabled, or file has binary
-            # components, default to compatible is disabled.
-            sql.append("""AND
-                CASE WHEN files.strict_compatibility = 1 OR
-                          files.binary_components = 1
-                THEN appmax.version_int >= %(version_int)s ELSE 1 END
-            """)
-            # Filter out versions that don't have the minimum maxVersion
-            # requirement to qualify for default-to-compatible.
-            d2c_max = applications.D2C_MAX_VERSIONS.get(data['app_id'])
-            if d2c_max:
-                data['d2c_max_version'] = version_int(d2c_max)
-                sql.append("AND appmax.version_int >= %(d2c_max_version)s ")
-
-            # Filter out versions found in compat overrides
-            sql.append("""AND
-                NOT versions.id IN (
-                SELECT version_id FROM incompatible_versions
-                WHERE app_id=%(app_id)s AND
-                  (min_app_version='0' AND
-                       max_app_version_int >= %(version_int)s) OR
-                  (min_app_version_int <= %(version_int)s AND
-                       max_app_version='*') OR
-                  (min_app_version_int <= %(version_int)s AND
-                       max_app_version_int >= %(version_int)s)) """)
-
-        else:  # Not defined or 'strict'.
-            sql.append('AND appmax.version_int >= %(version_int)s ')
-
+        sql.extend(compat_sql(self.compat_mode, data))
         sql.append('ORDER BY versions.id DESC LIMIT 1;')
 
         self.cursor.execute(''.join(sql), data)
         result = self.cursor.fetchone()
 
         if result:
-            row = dict(zip([
-                'guid', 'type', 'disabled_by_user', 'appguid', 'min', 'max',
-                'file_id', 'file_status', 'hash', 'filename', 'version_id',
-                'datestatuschanged', 'strict_compat', 'releasenotes',
-                'version', 'premium_type'],
-                list(result)))
-            row['type'] = base.ADDON_SLUGS_UPDATE[row['type']]
-            if row['premium_type'] in base.ADDON_PREMIUMS:
-                qs = urlencode(dict((k, data.get(k, ''))
-                               for k in base.WATERMARK_KEYS))
-                row['url'] = (u'%s/downloads/watermarked/%s?%s' %
-                              (settings.SITE_URL, row['file_id'], qs))
-            else:
-                row['url'] = get_mirror(self.data['addon_status'],
-                                        self.data['id'], row)
-            data['row'] = row
-            return True
-
-        return False
+            return dict(zip(update_columns, list(result)))
+        return None
 
     def get_bad_rdf(self):
         return bad_rdf
 
     def get_rdf(self):
+        request, key = self.data.copy(), None
+        if self.rdf_cache is not None and self.is_cacheable_request():
+            addon_id = self.rdf_cache.get_addon_id(request['id'])
+            if addon_id:
+                key = self.rdf_cache.key(addon_id, request, self.compat_mode)
+                rdf = self.rdf_cache.get(key)
+                if rdf is not None:
+                    statsd.incr('services.update.cache.hit')
+                    return rdf
+            statsd.incr('services.update.cache.miss')
+
         if self.is_valid():
             if self.get_update():
                 rdf = self.get_good_rdf()
             else:
                 rdf = self.get_no_updates_rdf()
+
+            if self.rdf_cache is not None and self.is_cacheable_request():
+                if not key:
+                    self.rdf_cache.set_addon_id(request['id'],
+                                                self.data['id'])
+                    key = self.rdf_cache.key(self.data['id'], request,
+                                             self.compat_mode)
+                if self.is_cacheable_response():
+                    self.rdf_cache.set(key, rdf)
         else:
             rdf = self.get_bad_rdf()
-        self.cursor.close()
+        self.close()
+        return rdf
+
+    def close(self):
+        if self.cursor:
+            self.cursor.close()
         if self.conn:
             self.conn.close()
-        return rdf
+
+    def is_cacheable_request(self):
+        # Watermarked downloads are personal, they never go in the cache.
+        return ('id' in self.data and
+                not any(k in self.data for k in base.WATERMARK_KEYS))
+
+    def is_cacheable_response(self):
+        row = self.data['row']
+        if not row:
+            return True
+        if row['premium_type'] in base.ADDON_PREMIUMS:
+            return False
+        # Files that changed recently are served locally until they've had
+        # time to get out to the mirrors, don't hang on to that url.
+        changed = row['datestatuschanged']
+        return (not changed or datetime.now() - changed >
+                timedelta(minutes=settings.MIRROR_DELAY))
 
     def get_no_updates_rdf(self):
+        return rdf_start + self.get_no_updates_description() + rdf_end
+
+    def get_no_updates_description(self):
         name = base.ADDON_SLUGS_UPDATE[self.data['type']]
-        return no_updates_rdf % ({'guid': self.data['guid'], 'type': name})
+        return no_updates_description % ({'guid': self.data['guid'],
+                                          'type': name})
 
     def get_good_rdf(self):
+        return rdf_start + self.get_good_description() + rdf_end
+
+    def get_good_description(self):
         data = self.data['row']
         data['if_hash'] = ''
         if data['hash']:
@@ -313,12 +478,10 @@ class Update(object):
 
         data['if_update'] = ''
         if data['releasenotes']:
-            data['if_update'] = ('<em:updateInfoURL>%s%s%s/%%APP_LOCALE%%/'
-                                 '</em:updateInfoURL>' %
-                                 (settings.SITE_URL, '/versions/updateInfo/',
-                                  data['version_id']))
+            data['if_update'] = ('<em:updateInfoURL>%s</em:updateInfoURL>' %
+                                 get_update_info_url(data['version_id']))
 
-        return good_rdf % data
+        return good_description % data
 
     def format_date(self, secs):
         return '%s GMT' % formatdate(time() + secs)[:25]
@@ -331,10 +494,224 @@ class Update(object):
                 ('Content-Length', str(length))]
 
 
+class BatchItem(Update):
+    """
+    One add-on of a `BatchUpdate`, answered from the rows the batch has
+    already fetched instead of the db.
+    """
+
+    def __init__(self, data, compat_mode, addon, beta_status, rows):
+        super(BatchItem, self).__init__(data, compat_mode)
+        (self.data['id'], self.data['addon_status'], self.data['type'],
+         self.data['guid']) = addon
+        self.is_beta_version = base.VERSION_BETA.search(self.data['version'])
+        self.beta_status = beta_status
+        self.rows = rows
+
+    def get_beta_status(self):
+        return self.beta_status
+
+    def get_update_row(self):
+        # The batch query has done everything but the file status filter,
+        # which differs per add-on.
+        status_ok = status_check(self.data, self.flags)
+        for key, row in self.rows:
+            if status_ok(row['file_status'], key):
+                return dict(row)
+        return None
+
+    def get_manifest(self):
+        """The JSON equivalent of the rdf for this add-on."""
+        row = self.data['row']
+        if not row:
+            return {'updates': []}
+        update = {'version': row['version'],
+                  'update_link': row['url'],
+                  'applications': {row['appguid']: {
+                      'min_version': row['min'],
+                      'max_version': row['max']}}}
+        if row['hash']:
+            update['update_hash'] = row['hash']
+        if row['releasenotes']:
+            update['update_info_url'] = get_update_info_url(
+                row['version_id'])
+        return {'updates': [update]}
+
+
+class BatchUpdate(Update):
+    """
+    Answers the update check for many (guid, version) pairs for the same
+    application at once. However many add-ons are asked about this takes one
+    query for the add-ons, one for the beta versions (if there are any) and
+    one for the update candidates, with the same compat mode filtering as a
+    single `Update`.
+    """
+
+    def __init__(self, data, items, compat_mode='strict', format='rdf'):
+        super(BatchUpdate, self).__init__(data, compat_mode)
+        self.items = items
+        self.format = format
+
+    def is_valid(self):
+        self.connect()
+
+        data = self.data
+        for field in ['reqVersion', 'appID', 'appVersion']:
+            if field not in data:
+                return False
+
+        if (not self.items or
+            len(self.items) > settings.SERVICES_UPDATE_BATCH_SIZE):
+            return False
+
+        data['app_id'] = APP_GUIDS.get(data['appID'])
+        if not data['app_id']:
+            return False
+
+        data['version_int'] = version_int(data['appVersion'])
+        data['appOS'] = get_platform(data.get('appOS', ''))
+        return True
+
+    def get_updates(self):
+        """
+        Returns a `BatchItem` for each add-on we know about, in the order
+        they were asked for, with the update looked up.
+        """
+        data = self.data
+
+        # Guids are matched case insensitively by MySQL, so do the same when
+        # matching the results up to what we were asked.
+        items, seen = [], set()
+        for guid, version in self.items:
+            if guid.lower() not in seen:
+                seen.add(guid.lower())
+                items.append((guid, version or ''))
+
+        params = dict(('guid_%s' % i, guid)
+                      for i, (guid, version) in enumerate(items))
+        params['STATUS_DELETED'] = base.STATUS_DELETED
+        sql = """SELECT id, status, addontype_id, guid FROM addons
+                 WHERE guid IN (%s) AND
+                       inactive = 0 AND
+                       status != %%(STATUS_DELETED)s;""" % (
+            ', '.join('%%(guid_%s)s' % i for i in range(len(items))))
+        self.cursor.execute(sql, params)
+        addons = dict((row[3].lower(), row) for row in self.cursor.fetchall())
+        if not addons:
+            return []
+
+        # Only public add-ons look at the status of their beta versions.
+        betas = [(addons[g.lower()][0], v) for g, v in items
+                 if g.lower() in addons and base.VERSION_BETA.search(v) and
+                    addons[g.lower()][1] == base.STATUS_PUBLIC]
+        beta_status = {}
+        if betas:
+            params = dict(('id_%s' % i, id) for i, (id, v) in enumerate(betas))
+            params.update(('version_%s' % i, v)
+                          for i, (id, v) in enumerate(betas))
+            sql = """
+                SELECT versions.addon_id, versions.version, files.status
+                FROM files INNER JOIN versions
+                ON files.version_id = versions.id
+                WHERE versions.addon_id IN (%s)
+                      AND versions.version IN (%s)
+                ORDER BY files.id;""" % (
+                ', '.join('%%(id_%s)s' % i for i in range(len(betas))),
+                ', '.join('%%(version_%s)s' % i for i in range(len(betas))))
+            self.cursor.execute(sql, params)
+            for addon_id, version, status in self.cursor.fetchall():
+                beta_status.setdefault((addon_id, version_key(version)),
+                                       status)
+
+        ids = sorted(set(a[0] for a in addons.values()))
+        params = dict(data, **dict(('id_%s' % i, id)
+                                   for i, id in enumerate(ids)))
+        params['STATUS_NULL'] = base.STATUS_NULL
+        sql = [update_select.format(addons='addons.id IN (%s)' % ', '.join(
+            '%%(id_%s)s' % i for i in range(len(ids))))]
+        if data.get('appOS'):
+            sql.append(' OR files.platform_id = %(appOS)s')
+        # Every status the single query looks for is above STATUS_NULL, the
+        # exact status is picked per add-on by `BatchItem`.
+        sql.append(') WHERE files.status > %(STATUS_NULL)s ')
+        sql.extend(compat_sql(self.compat_mode, params))
+        sql.append('ORDER BY versions.id DESC;')
+        self.cursor.execute(''.join(sql), params)
+
+        rows = {}
+        for result in self.cursor.fetchall():
+            row = dict(zip(update_columns, list(result)))
+            rows.setdefault(row['guid'].lower(), []).append(
+                (version_key(row['version']), row))
+
+        updates = []
+        for guid, version in items:
+            addon = addons.get(guid.lower())
+            if not addon:
+                continue
+            item = BatchItem(
+                dict(data, version=version), self.compat_mode, addon,
+                beta_status.get((addon[0], version_key(version))),
+                rows.get(guid.lower(), []))
+            item.get_update()
+            updates.append(item)
+        return updates
+
+    def get_rdf(self):
+        if self.is_valid():
+            descriptions = []
+            for item in self.get_updates():
+                if item.data['row']:
+                    descriptions.append(item.get_good_description())
+                else:
+                    descriptions.append(item.get_no_updates_description())
+            rdf = rdf_start + ''.join(descriptions) + rdf_end
+        else:
+            rdf = self.get_bad_rdf()
+        self.close()
+        return rdf
+
+    def get_json(self):
+        addons = {}
+        if self.is_valid():
+            for item in self.get_updates():
+                addons[item.data['guid']] = item.get_manifest()
+        self.close()
+        return json.dumps({'addons': addons})
+
+    def get_output(self):
+        if self.format == 'json':
+            return self.get_json()
+        return self.get_rdf()
+
+    def get_headers(self, length):
+        headers = super(BatchUpdate, self).get_headers(length)
+        if self.format == 'json':
+            headers[0] = ('Content-Type', 'application/json')
+        return headers
+
+
+def get_platform(app_os):
+    """The platform id for the appOS the client sent, or None."""
+    for k, v in PLATFORMS.items():
+        if k in app_os:
+            return v
+    return None
+
+
+def get_update_info_url(version_id):
+    return '%s%s%s/%%APP_LOCALE%%/' % (settings.SITE_URL,
+                                       '/versions/updateInfo/', version_id)
+
+
 def mail_exception(data):
     if settings.EMAIL_BACKEND != 'django.core.mail.backends.smtp.EmailBackend':
         return
 
+    # Hardly ever needed, so don't make every worker import these.
+    from email.mime.text import MIMEText
+    import smtplib
+
     msg = MIMEText('%s\n\n%s' % (
         '\n'.join(traceback.format_exception(*sys.exc_info())), data))
     msg['Subject'] = '[Update] ERROR at /services/update'
@@ -358,7 +735,8 @@ def application(environ, start_response):
         data = dict(parse_qsl(environ['QUERY_STRING']))
         compat_mode = data.pop('compatMode', 'strict')
         try:
-            update = Update(data, compat_mode)
+            update = Update(data, compat_mode, index=get_index(),
+                            rdf_cache=get_cache())
             output = update.get_rdf()
             start_response(status, update.get_headers(len(output)))
         except:
@@ -366,3 +744,34 @@ def application(environ, start_response):
             log_exception(data)
             raise
     return [output]
+
+
+def batch_application(environ, start_response):
+    """
+    Update checks for many add-ons at once. Takes the usual appID,
+    appVersion, appOS, reqVersion and compatMode once, and the add-ons as
+    repeated id and version pairs, in the query string or a POST body. Add
+    format=json to get JSON back instead of rdf.
+    """
+    status = '200 OK'
+    with statsd.timer('services.update.batch'):
+        qs = environ['QUERY_STRING']
+        if environ.get('REQUEST_METHOD') == 'POST':
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            qs = environ['wsgi.input'].read(length)
+        query = parse_qsl(qs, keep_blank_values=True)
+
+        data = dict((k, v) for k, v in query if k not in ('id', 'version'))
+        ids = [v for k, v in query if k == 'id']
+        versions = [v for k, v in query if k == 'version']
+        compat_mode = data.pop('compatMode', 'strict')
+        format = data.pop('format', 'rdf')
+        items = zip(ids, versions) if len(ids) == len(versions) else []
+        try:
+            update = BatchUpdate(data, items, compat_mode, format=format)
+            output = update.get_output()
+            start_response(status, update.get_headers(len(output)))
+        except:
+            log_exception(data)
+            raise
+    return [output]
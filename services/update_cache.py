@@ -0,0 +1,140 @@
+"""
+A response cache for services/update.py.
+
+Millions of update pings ask the exact same question, so the rendered rdf is
+kept in a per-process LRU in front of memcached. Entries are keyed on the
+add-on's `d2c-versions` namespace, which is bumped by
+`Addon.invalidate_d2c_versions()` whenever something that changes the answer
+is saved.
+"""
+import hashlib
+import threading
+from time import time
+
+# The parts of the query string that go into the response.
+KEY_FIELDS = ('id', 'version', 'appID', 'appVersion', 'appOS')
+
+
+def cache_ns_key(namespace):
+    """
+    Same as `amo.utils.cache_ns_key()`, without pulling in the rest of
+    zamboni.
+    """
+    from django.core.cache import cache
+    ns_key = 'ns:%s' % namespace
+    ns_val = cache.get(ns_key)
+    if ns_val is None:
+        ns_val = int(time())
+        cache.set(ns_key, ns_val, 0)
+    return '%s:%s' % (ns_val, ns_key)
+
+
+class LRU(object):
+    """
+    A small thread safe LRU with a timeout on each entry. The entries are
+    kept in a circular doubly linked list of [prev, next, key, expires,
+    value], most recently used last, since we're on Python 2.6 and don't
+    have OrderedDict.
+    """
+
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+    def _unlink(self, link):
+        prev, nxt = link[0], link[1]
+        prev[1], nxt[0] = nxt, prev
+
+    def _append(self, link):
+        last = self.root[0]
+        link[0], link[1] = last, self.root
+        last[1] = self.root[0] = link
+
+    def get(self, key):
+        with self.lock:
+            link = self.data.get(key)
+            if link is None:
+                return None
+            if link[3] < time():
+                self._unlink(link)
+                del self.data[key]
+                return None
+            self._unlink(link)
+            self._append(link)
+            return link[4]
+
+    def set(self, key, value):
+        with self.lock:
+            link = self.data.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+            link = self.data[key] = [None, None, key, time() + self.timeout,
+                                     value]
+            self._append(link)
+            while len(self.data) > self.size:
+                oldest = self.root[1]
+                self._unlink(oldest)
+                del self.data[oldest[2]]
+
+    def clear(self):
+        with self.lock:
+            self.data = {}
+            self.root = []
+            self.root[:] = [self.root, self.root, None, None, None]
+
+
+class UpdateCache(object):
+
+    def __init__(self, size=10000, timeout=3600):
+        # Django's cache is only loaded by the update service; verify just
+        # wants the LRU from this module.
+        from django.core.cache import cache
+        from django.utils.encoding import smart_str
+        self.cache = cache
+        self.smart_str = smart_str
+        self.timeout = timeout
+        self.local = LRU(size, timeout)
+
+    def guid_key(self, guid):
+        guid = self.smart_str(guid)
+        return 'update-guid:%s' % hashlib.md5(guid).hexdigest()
+
+    def get_addon_id(self, guid):
+        """The add-on id for a guid, so we know which namespace to look in
+        before going to the db."""
+        key = self.guid_key(guid)
+        addon_id = self.local.get(key)
+        if addon_id is None:
+            addon_id = self.cache.get(key)
+            if addon_id is not None:
+                self.local.set(key, addon_id)
+        return addon_id
+
+    def set_addon_id(self, guid, addon_id):
+        key = self.guid_key(guid)
+        self.local.set(key, addon_id)
+        self.cache.set(key, addon_id, self.timeout)
+
+    def key(self, addon_id, data, compat_mode):
+        parts = [self.smart_str(data.get(k, '')) for k in KEY_FIELDS]
+        parts.append(compat_mode)
+        return 'update-rdf:%s:%s' % (
+            cache_ns_key('d2c-versions:%s' % addon_id),
+            hashlib.md5('\n'.join(parts)).hexdigest())
+
+    def get(self, key):
+        rdf = self.local.get(key)
+        if rdf is None:
+            rdf = self.cache.get(key)
+            if rdf is not None:
+                self.local.set(key, rdf)
+        return rdf
+
+    def set(self, key, rdf):
+        self.local.set(key, rdf)
+        self.cache.set(key, rdf, self.timeout)
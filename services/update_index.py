@@ -0,0 +1,368 @@
+"""
+An in-process index of update candidates for services/update.py.
+
+Each services worker can keep one of these around so that an update ping
+can be answered from memory instead of running the addons lookup and the
+big versions/files JOIN for every installed add-on. Candidates are kept per
+(guid, app_id, platform_id) and the index picks up changes incrementally
+from the modified timestamps on the underlying tables.
+
+The SQL in `Update` stays the source of truth: it is used whenever the
+index can't answer (not loaded yet, an add-on it hasn't seen) and to spot
+check the answers given by the index.
+"""
+from collections import namedtuple
+import threading
+from time import time
+
+from constants import applications, base
+from constants.platforms import PLATFORM_ALL
+
+try:
+    from compare import version_int
+except ImportError:
+    from apps.versions.compare import version_int
+
+from utils import APP_GUIDS
+
+
+APP_GUIDS_BY_ID = dict((v, k) for k, v in APP_GUIDS.items())
+
+# Keep the IN clauses to something MySQL is happy with.
+CHUNK_SIZE = 500
+
+# What the index knows about an add-on, mirroring the addons lookup in
+# `Update.is_valid()`.
+Addon = namedtuple('Addon', 'id status type guid premium_type')
+
+# One row of the update JOIN, without any of the per request filtering.
+Candidate = namedtuple('Candidate', 'version_id version version_key '
+                       'releasenotes min min_int max max_int file_id '
+                       'file_status hash filename datestatuschanged '
+                       'strict_compat binary_components overrides')
+
+addons_sql = """
+    SELECT id, status, addontype_id, guid, premium_type FROM addons
+    WHERE inactive = 0 AND status != %%(STATUS_DELETED)s AND
+          guid IS NOT NULL %(where)s"""
+
+candidates_sql = """
+    SELECT
+        versions.addon_id, applications_versions.application_id,
+        files.platform_id, versions.id, versions.version,
+        versions.releasenotes, appmin.version, appmin.version_int,
+        appmax.version, appmax.version_int, files.id, files.status,
+        files.hash, files.filename, files.datestatuschanged,
+        files.strict_compatibility, files.binary_components
+    FROM versions
+    INNER JOIN applications_versions
+        ON applications_versions.version_id = versions.id
+    INNER JOIN appversions appmin
+        ON appmin.id = applications_versions.min
+    INNER JOIN appversions appmax
+        ON appmax.id = applications_versions.max
+    INNER JOIN files
+        ON files.version_id = versions.id
+    %(where)s"""
+
+beta_sql = """
+    SELECT versions.addon_id, versions.version, files.status
+    FROM files INNER JOIN versions
+        ON files.version_id = versions.id
+    %(where)s
+    ORDER BY files.id"""
+
+overrides_sql = """
+    SELECT incompatible_versions.version_id, incompatible_versions.app_id,
+           incompatible_versions.min_app_version,
+           incompatible_versions.max_app_version,
+           incompatible_versions.min_app_version_int,
+           incompatible_versions.max_app_version_int
+    FROM incompatible_versions
+    INNER JOIN versions ON versions.id = incompatible_versions.version_id
+    %(where)s"""
+
+changed_sql = """
+    SELECT id FROM addons WHERE modified >= %(since)s
+    UNION
+    SELECT addon_id FROM versions WHERE modified >= %(since)s
+    UNION
+    SELECT versions.addon_id FROM files
+    INNER JOIN versions ON versions.id = files.version_id
+    WHERE files.modified >= %(since)s OR
+          files.datestatuschanged >= %(since)s
+    UNION
+    SELECT versions.addon_id FROM incompatible_versions
+    INNER JOIN versions ON versions.id = incompatible_versions.version_id
+    WHERE incompatible_versions.modified >= %(since)s"""
+
+
+def version_key(version):
+    """
+    Versions are matched in MySQL with a case insensitive collation that
+    ignores trailing spaces, so do the same here.
+    """
+    return (version or '').lower().rstrip(' ')
+
+
+def overridden(overrides, app_id, vint):
+    """
+    Mirrors the incompatible_versions sub-select in `Update.get_update()`.
+
+    The AND in that WHERE clause binds tighter than the ORs, so only the
+    first range is limited to the app. Keep it that way so both paths give
+    the same answer.
+    """
+    for (o_app, min_zero, max_star, min_int, max_int) in overrides:
+        if o_app == app_id and min_zero and ge(max_int, vint):
+            return True
+        if le(min_int, vint) and max_star:
+            return True
+        if le(min_int, vint) and ge(max_int, vint):
+            return True
+    return False
+
+
+def status_check(data, flags):
+    """
+    Returns a function of (file status, version_key(version)) that mirrors
+    the file status part of the update query, once `Update.get_beta()` has
+    worked out the status and flags. The keys are worked out once, where
+    the rows are loaded, not on every check.
+    """
+    status = data['status']
+    if flags['use_version']:
+        wanted = version_key(data['version'])
+        return lambda s, key: s > status and key == wanted
+    elif flags['multiple_status']:
+        statuses = (base.STATUS_PUBLIC, base.STATUS_LITE,
+                    base.STATUS_LITE_AND_NOMINATED)
+        return lambda s, key: s in statuses
+    else:
+        return lambda s, key: s == status
+
+
+def le(value, vint):
+    # A NULL in the db never matches, Python would happily compare None.
+    return value is not None and value <= vint
+
+
+def ge(value, vint):
+    return value is not None and value >= vint
+
+
+class UpdateIndex(object):
+
+    def __init__(self, refresh=60, rebuild=60 * 60 * 6, check=0):
+        self.refresh_interval = refresh
+        self.rebuild_interval = rebuild
+        # Fraction of answers to compare against the SQL path.
+        self.check = check
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.addons = {}
+        self.guids = {}
+        self.candidates = {}
+        self.betas = {}
+        self.keys = {}
+        self.watermark = None
+        self.built = 0
+        self.refreshed = 0
+
+    @property
+    def ready(self):
+        return self.watermark is not None
+
+    def __contains__(self, guid):
+        return guid in self.addons
+
+    def stale(self, now=None):
+        now = now or time()
+        return (not self.ready or
+                now - self.refreshed >= self.refresh_interval)
+
+    def refresh(self, cursor, now=None):
+        """
+        Brings the index up to date. Rows are only ever added or changed
+        incrementally, so the whole thing is rebuilt every so often to drop
+        anything that has been deleted in the meantime.
+
+        Returns the number of add-ons that were (re)loaded, or None if
+        another thread is already refreshing.
+        """
+        if not self.lock.acquire(False):
+            return None
+        try:
+            now = now or time()
+            cursor.execute('SELECT NOW();')
+            watermark = cursor.fetchone()[0]
+            if (not self.ready or
+                now - self.built >= self.rebuild_interval):
+                count = self.build(cursor)
+                self.built = now
+            else:
+                cursor.execute(changed_sql, {'since': self.watermark})
+                ids = [r[0] for r in cursor.fetchall()]
+                count = self.load(cursor, ids)
+            self.watermark = watermark
+            self.refreshed = now
+            return count
+        finally:
+            self.lock.release()
+
+    def build(self, cursor):
+        """Loads everything from scratch and swaps it in at once."""
+        (self.addons, self.guids, self.candidates,
+         self.betas, self.keys) = self._fill(cursor, '', {})
+        return len(self.addons)
+
+    def load(self, cursor, ids):
+        """Reloads the given add-on ids, dropping the ones that are gone."""
+        ids = sorted(set(ids))
+        for start in range(0, len(ids), CHUNK_SIZE):
+            chunk = ids[start:start + CHUNK_SIZE]
+            params = dict(('id_%s' % i, id) for i, id in enumerate(chunk))
+            where = ', '.join('%%(%s)s' % k for k in sorted(params))
+            addons, guids, candidates, betas, keys = self._fill(
+                cursor, where, params)
+
+            for id in chunk:
+                # Swap in the new rows before dropping the old ones, readers
+                # will see one or the other but never nothing.
+                old_keys = self.keys.get(id, set())
+                new_keys = keys.get(id, set())
+                for key in new_keys:
+                    self.candidates[key] = candidates[key]
+                for key in old_keys - new_keys:
+                    self.candidates.pop(key, None)
+
+                old_guid, new_guid = self.guids.get(id), guids.get(id)
+                if new_guid:
+                    self.addons[new_guid] = addons[new_guid]
+                    self.guids[id] = new_guid
+                else:
+                    self.guids.pop(id, None)
+                if old_guid and old_guid != new_guid:
+                    self.addons.pop(old_guid, None)
+
+                for new, current in ((betas, self.betas),
+                                     (keys, self.keys)):
+                    if id in new:
+                        current[id] = new[id]
+                    else:
+                        current.pop(id, None)
+        return len(ids)
+
+    def _fill(self, cursor, ids, params):
+        """
+        Runs the index queries, limited to the add-on ids placeholders in
+        `ids` if given, and returns the new index dicts.
+        """
+        addons, guids, candidates, betas, keys = {}, {}, {}, {}, {}
+        params = dict(params, STATUS_DELETED=base.STATUS_DELETED)
+        where = 'WHERE versions.addon_id IN (%s)' % ids if ids else ''
+
+        cursor.execute(addons_sql % {'where': 'AND id IN (%s)' % ids
+                                              if ids else ''}, params)
+        for id, status, type_, guid, premium_type in cursor.fetchall():
+            addons[guid] = Addon(id, status, type_, guid, premium_type)
+            guids[id] = guid
+
+        overrides = {}
+        cursor.execute(overrides_sql % {'where': where}, params)
+        for (version_id, app_id, min_v, max_v,
+             min_int, max_int) in cursor.fetchall():
+            overrides.setdefault(version_id, []).append(
+                (app_id, min_v == '0', max_v == '*', min_int, max_int))
+        overrides = dict((k, tuple(v)) for k, v in overrides.items())
+
+        cursor.execute(beta_sql % {'where': where}, params)
+        for addon_id, version, status in cursor.fetchall():
+            key = version_key(version)
+            if addon_id in guids and base.VERSION_BETA.search(key):
+                betas.setdefault(addon_id, {}).setdefault(key, status)
+
+        cursor.execute(candidates_sql % {'where': where}, params)
+        for row in cursor.fetchall():
+            (addon_id, app_id, platform_id, version_id, version,
+             releasenotes, min_v, min_int, max_v, max_int, file_id,
+             file_status, hash_, filename, datestatuschanged, strict,
+             binary) = row
+            if addon_id not in guids:
+                continue
+            key = (guids[addon_id], app_id, platform_id)
+            candidates.setdefault(key, []).append(Candidate(
+                version_id, version, version_key(version), releasenotes,
+                min_v, min_int, max_v, max_int, file_id, file_status,
+                hash_, filename, datestatuschanged, strict, binary,
+                overrides.get(version_id, ())))
+            keys.setdefault(addon_id, set()).add(key)
+
+        for key, rows in candidates.items():
+            # Same as the ORDER BY versions.id DESC in the update query.
+            rows.sort(key=lambda c: (c.version_id, c.file_id), reverse=True)
+            candidates[key] = tuple(rows)
+
+        return addons, guids, candidates, betas, keys
+
+    def get_addon(self, guid):
+        return self.addons.get(guid)
+
+    def get_beta_status(self, addon_id, version):
+        """The file status for a beta version, or None if there are no
+        files for it, like the beta query in `Update.get_beta()`."""
+        return self.betas.get(addon_id, {}).get(version_key(version))
+
+    def get_update(self, data, flags, compat_mode):
+        """
+        Finds the best candidate for the update request in `data`, once
+        `Update.get_beta()` has filled in the status and flags. Returns the
+        same row dict as the SQL path (before any post processing) or None.
+        """
+        guid, app_id = data['guid'], data['app_id']
+        rows = list(self.candidates.get((guid, app_id, PLATFORM_ALL.id), ()))
+        if data.get('appOS') and data['appOS'] != PLATFORM_ALL.id:
+            rows.extend(self.candidates.get((guid, app_id, data['appOS']),
+                                            ()))
+            rows.sort(key=lambda c: (c.version_id, c.file_id), reverse=True)
+
+        vint = data['version_int']
+        status_ok = status_check(data, flags)
+
+        d2c_max = None
+        if compat_mode == 'normal':
+            d2c_max = applications.D2C_MAX_VERSIONS.get(app_id)
+            if d2c_max:
+                d2c_max = version_int(d2c_max)
+
+        for c in rows:
+            if (not status_ok(c.file_status, c.version_key) or
+                not le(c.min_int, vint)):
+                continue
+            if compat_mode == 'ignore':
+                pass
+            elif compat_mode == 'normal':
+                if ((c.strict_compat or c.binary_components) and
+                    not ge(c.max_int, vint)):
+                    continue
+                if d2c_max and not ge(c.max_int, d2c_max):
+                    continue
+                if overridden(c.overrides, app_id, vint):
+                    continue
+            elif not ge(c.max_int, vint):
+                continue
+
+            addon = self.addons[guid]
+            return {'guid': guid, 'type': addon.type,
+                    'disabled_by_user': 0,
+                    'appguid': APP_GUIDS_BY_ID.get(app_id),
+                    'min': c.min, 'max': c.max, 'file_id': c.file_id,
+                    'file_status': c.file_status, 'hash': c.hash,
+                    'filename': c.filename, 'version_id': c.version_id,
+                    'datestatuschanged': c.datestatuschanged,
+                    'strict_compat': c.strict_compat,
+                    'releasenotes': c.releasenotes, 'version': c.version,
+                    'premium_type': addon.premium_type}
+        return None
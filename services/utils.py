@@ -1,22 +1,26 @@
 from datetime import datetime, timedelta
 import dictconfig
 import logging
-import settings_local as settings
+import os
 import posixpath
 import re
 import sys
+import time
 
-from cef import log_cef as _log_cef
 import MySQLdb as mysql
+import sqlalchemy.exc as exc
 import sqlalchemy.pool as pool
 
-from django.core.management import setup_environ
 import commonware.log
 
-# Pyflakes will complain about these, but they are required for setup.
 import settings_local as settings
-setup_environ(settings)
+# Django is only here for its settings, which the log config and statsd
+# read. Point it at ours rather than running setup_environ, which pulls in
+# the management commands and imports the project as a package as well.
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings_local')
 from lib.log_settings_base import formatters, handlers, loggers
+# This has to be imported after the settings so statsd knows where to log to.
+from statsd import statsd
 
 # Ugh. But this avoids any zamboni or django imports at all.
 # Perhaps we can import these without any problems and we can
@@ -78,13 +82,78 @@ def get_mirror(status, id, row):
     return posixpath.join(host, str(id), row['filename'])
 
 
-def getconn():
-    db = settings.SERVICES_DATABASE
+def getconn(db=None):
+    db = db or settings.SERVICES_DATABASE
     return mysql.connect(host=db['HOST'], user=db['USER'],
                          passwd=db['PASSWORD'], db=db['NAME'])
 
 
-mypool = pool.QueuePool(getconn, max_overflow=10, pool_size=5, recycle=300)
+class PoolListener(object):
+    """
+    Counts new connections, which is the churn, and pings each connection
+    on checkout if the pool is set to. A connection that doesn't answer is
+    thrown away and the pool tries another, so a restarted db or a dropped
+    idle connection doesn't turn into a failed request.
+    """
+
+    def __init__(self, name, ping):
+        self.name = name
+        self.ping = ping
+
+    def connect(self, dbapi_con, con_record):
+        statsd.incr('services.db.%s.connect' % self.name)
+
+    def checkout(self, dbapi_con, con_record, con_proxy):
+        if not self.ping:
+            return
+        try:
+            dbapi_con.ping()
+        except mysql.OperationalError:
+            statsd.incr('services.db.%s.invalidated' % self.name)
+            raise exc.DisconnectionError()
+
+
+class Pool(object):
+    """A QueuePool that reports its checkouts and use to statsd."""
+
+    def __init__(self, name, db, options):
+        self.name = name
+        self.pool = pool.QueuePool(
+            lambda: getconn(db), pool_size=options['SIZE'],
+            max_overflow=options['OVERFLOW'], recycle=options['RECYCLE'],
+            timeout=options['TIMEOUT'],
+            listeners=[PoolListener(name, options['PING'])])
+
+    def connect(self):
+        start = time.time()
+        try:
+            conn = self.pool.connect()
+        except exc.TimeoutError:
+            statsd.incr('services.db.%s.timeout' % self.name)
+            raise
+        stat = 'services.db.%s.' % self.name
+        statsd.timing(stat + 'checkout', (time.time() - start) * 1000)
+        statsd.gauge(stat + 'active', self.pool.checkedout())
+        statsd.gauge(stat + 'overflow', max(self.pool.overflow(), 0))
+        return conn
+
+
+pools = {}
+
+
+def get_pool(name, readonly=False):
+    """
+    The connection pool for the `name` endpoint, sized from
+    SERVICES_DATABASE_POOLS[name] over SERVICES_DATABASE_POOL. Read only
+    queries go to SERVICES_DATABASE_SLAVE if there is one.
+    """
+    slave = readonly and settings.SERVICES_DATABASE_SLAVE
+    key = '%s.slave' % name if slave else name
+    if key not in pools:
+        options = dict(settings.SERVICES_DATABASE_POOL)
+        options.update(settings.SERVICES_DATABASE_POOLS.get(name, {}))
+        pools[key] = Pool(key, slave or settings.SERVICES_DATABASE, options)
+    return pools[key]
 
 
 def log_configure():
@@ -115,6 +184,7 @@ def log_info(data, msg):
 
 def log_cef(request, app, msg, longer):
     """Log receipt transactions to the CEF library."""
+    from cef import log_cef as _log_cef
     c = {'cef.product': getattr(settings, 'CEF_PRODUCT', 'AMO'),
          'cef.vendor': getattr(settings, 'CEF_VENDOR', 'Mozilla'),
          'cef.version': getattr(settings, 'CEF_VERSION', '0'),
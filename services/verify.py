@@ -1,12 +1,16 @@
 import calendar
+import copy
 from datetime import datetime
 from email.Utils import formatdate
+import hashlib
 import json
+import os
 import re
+import threading
 from time import gmtime, time
 from urlparse import parse_qsl
 
-from utils import (log_configure, log_exception, log_info, mypool,
+from utils import (get_pool, log_configure, log_exception, log_info,
                    settings, ADDON_PREMIUM, CONTRIB_CHARGEBACK,
                    CONTRIB_PURCHASE, CONTRIB_REFUND)
 
@@ -15,18 +19,62 @@ log_configure()
 
 import jwt
 from lib.crypto.receipt import sign
-from lib.cef_loggers import receipt_cef
 
 # This has to be imported after the settings (utils).
 import receipts  # used for patching in the tests
 from receipts import certs
 from statsd import statsd
+from update_cache import LRU
 
 
 class VerificationError(Exception):
     pass
 
 
+def log_receipt_cef(environ, addon_id, action, msg):
+    # lib.cef_loggers brings in cef and django.http, which nothing else in a
+    # worker needs, so it waits for the first receipt.
+    from lib.cef_loggers import receipt_cef
+    receipt_cef.log(environ, addon_id, action, msg)
+
+
+class Keys(object):
+    """
+    The receipt key and verifier, loaded once per process instead of for
+    every receipt. The key is loaded again if the key file changes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.key, self.stamp, self.verifier = None, None, None
+
+    def get_key(self):
+        path = settings.WEBAPPS_RECEIPT_KEY
+        stamp = (path, os.stat(path).st_mtime)
+        with self.lock:
+            if stamp != self.stamp:
+                self.key, self.stamp = jwt.rsa_load(path), stamp
+                # Anything checked with the old key has to be checked again.
+                verified.clear()
+            return self.key
+
+    def get_verifier(self):
+        with self.lock:
+            if self.verifier is None:
+                self.verifier = certs.ReceiptVerifier()
+            return self.verifier
+
+
+keys = Keys()
+# The decoded contents of receipts that have been verified recently, keyed on
+# a hash of the whole receipt, signature and all.
+verified = LRU(settings.SERVICES_VERIFY_CACHE_SIZE,
+               settings.SERVICES_VERIFY_CACHE_TIMEOUT)
+
+
 class Verify:
 
     def __init__(self, addon_id, receipt, environ):
@@ -35,6 +83,7 @@ class Verify:
         self.receipt = receipt
         self.environ = environ
         # These will be extracted from the receipt.
+        self.uuid = None
         self.user_id = None
         self.premium = None
         # This is so the unit tests can override the connection.
@@ -42,9 +91,19 @@ class Verify:
 
     def __call__(self, check_purchase=True):
         if not self.cursor:
-            self.conn = mypool.connect()
+            self.conn = get_pool('verify', readonly=True).connect()
             self.cursor = self.conn.cursor()
 
+        receipt = self.decode()
+        if receipt is None:
+            return self.invalid()
+        return self.check(receipt, check_purchase)
+
+    def decode(self):
+        """
+        Returns the decoded receipt, or None if it's no good, with
+        `self.uuid` set from it.
+        """
         # Try and decode the receipt data.
         # If its invalid, then just return invalid rather than give out any
         # information.
@@ -54,22 +113,22 @@ class Verify:
             log_exception({'receipt': '%s...' % self.receipt[:10],
                            'addon': self.addon_id})
             self.log('Error decoding receipt')
-            return self.invalid()
+            return None
 
         try:
             assert receipt['user']['type'] == 'directed-identifier'
         except (AssertionError, KeyError):
             self.log('No directed-identifier supplied')
-            return self.invalid()
+            return None
 
         # Get the addon and user information from the installed table.
         try:
-            uuid = receipt['user']['value']
+            self.uuid = receipt['user']['value']
         except KeyError:
             # If somehow we got a valid receipt without a uuid
             # that's a problem. Log here.
             self.log('No user in receipt')
-            return self.invalid()
+            return None
 
         # Newer receipts have the addon_id in the storedata,
         # if it doesn't match the URL, then it's wrong.
@@ -80,22 +139,22 @@ class Verify:
         except:
             # There was some value for storedata but it was invalid.
             self.log('Invalid store data')
-            return self.invalid()
+            return None
 
         # The addon_id in the URL and the receipt did not match, fail.
         if receipt_addon_id and receipt_addon_id != self.addon_id:
             self.log('The addon_id in the receipt and the URL did not match.')
-            return self.invalid()
-
-        sql = """SELECT id, user_id, premium_type FROM users_install
-                 WHERE addon_id = %(addon_id)s
-                 AND uuid = %(uuid)s LIMIT 1;"""
-        self.cursor.execute(sql, {'addon_id': self.addon_id,
-                                  'uuid': uuid})
-        result = self.cursor.fetchone()
+            return None
+        return receipt
+
+    def check(self, receipt, check_purchase=True):
+        """
+        Checks the decoded receipt against the install and purchase records.
+        """
+        result = self.get_install()
         if not result:
             # We've got no record of this receipt being created.
-            self.log('No entry in users_install for uuid: %s' % uuid)
+            self.log('No entry in users_install for uuid: %s' % self.uuid)
             return self.invalid()
 
         rid, self.user_id, self.premium = result
@@ -110,12 +169,7 @@ class Verify:
             return self.ok_or_expired(receipt)
 
         else:
-            sql = """SELECT id, type FROM addon_purchase
-                     WHERE addon_id = %(addon_id)s
-                     AND user_id = %(user_id)s LIMIT 1;"""
-            self.cursor.execute(sql, {'addon_id': self.addon_id,
-                                      'user_id': self.user_id})
-            result = self.cursor.fetchone()
+            result = self.get_purchase()
             if not result:
                 self.log('Invalid receipt, no purchase')
                 return self.invalid()
@@ -132,6 +186,24 @@ class Verify:
                 self.log('Valid receipt, but invalid contribution')
                 return self.invalid()
 
+    def get_install(self):
+        """The (id, user_id, premium_type) of the install, if there is one."""
+        sql = """SELECT id, user_id, premium_type FROM users_install
+                 WHERE addon_id = %(addon_id)s
+                 AND uuid = %(uuid)s LIMIT 1;"""
+        self.cursor.execute(sql, {'addon_id': self.addon_id,
+                                  'uuid': self.uuid})
+        return self.cursor.fetchone()
+
+    def get_purchase(self):
+        """The (id, type) of the user's purchase, if there is one."""
+        sql = """SELECT id, type FROM addon_purchase
+                 WHERE addon_id = %(addon_id)s
+                 AND user_id = %(user_id)s LIMIT 1;"""
+        self.cursor.execute(sql, {'addon_id': self.addon_id,
+                                  'user_id': self.user_id})
+        return self.cursor.fetchone()
+
     def format_date(self, secs):
         return '%s GMT' % formatdate(time() + secs)[:25]
 
@@ -178,35 +250,139 @@ class Verify:
         if settings.WEBAPPS_RECEIPT_EXPIRED_SEND:
             receipt['exp'] = (calendar.timegm(gmtime()) +
                               settings.WEBAPPS_RECEIPT_EXPIRY_SECONDS)
-            receipt_cef.log(self.environ, self.addon_id, 'sign',
-                            'Expired signing request')
+            log_receipt_cef(self.environ, self.addon_id, 'sign',
+                                'Expired signing request')
             return json.dumps({'status': 'expired', 'receipt': sign(receipt)})
         return json.dumps({'status': 'expired'})
 
 
+class BatchItem(Verify):
+    """
+    One receipt of a `BatchVerify`, checked against the rows the batch has
+    already looked up.
+    """
+
+    def __init__(self, addon_id, receipt, environ):
+        Verify.__init__(self, addon_id, receipt, environ)
+        self.installs, self.purchases = {}, {}
+
+    def get_install(self):
+        return self.installs.get(unicode(self.uuid).lower())
+
+    def get_purchase(self):
+        return self.purchases.get(self.user_id)
+
+
+class BatchVerify(Verify):
+    """
+    Verifies many receipts for the same app at once. However many receipts
+    there are, this takes one query for the installs and one for the
+    purchases. The response is a JSON list with what `Verify` would have
+    said about each receipt, in order.
+    """
+
+    def __init__(self, addon_id, receipts, environ):
+        Verify.__init__(self, addon_id, '', environ)
+        self.receipts = receipts
+
+    def is_valid(self):
+        return (0 < len(self.receipts) <= settings.SERVICES_VERIFY_BATCH_SIZE
+                and all(isinstance(r, basestring) for r in self.receipts))
+
+    def __call__(self, check_purchase=True):
+        if not self.cursor:
+            self.conn = get_pool('verify', readonly=True).connect()
+            self.cursor = self.conn.cursor()
+
+        items = [BatchItem(self.addon_id, receipt.encode('utf8'),
+                           self.environ) for receipt in self.receipts]
+        decoded = [item.decode() for item in items]
+
+        installs = self.get_installs(set(
+            unicode(item.uuid) for item, receipt in zip(items, decoded)
+            if receipt is not None))
+        premium = set(user_id for _, user_id, premium_type
+                      in installs.values() if premium_type == ADDON_PREMIUM)
+        purchases = {}
+        if check_purchase and premium:
+            purchases = self.get_purchases(premium)
+
+        output = []
+        for item, receipt in zip(items, decoded):
+            if receipt is None:
+                output.append(item.invalid())
+                continue
+            item.installs, item.purchases = installs, purchases
+            output.append(item.check(receipt, check_purchase))
+        return '[%s]' % ', '.join(output)
+
+    def get_installs(self, uuids):
+        """{uuid: (id, user_id, premium_type)}, uuids in lower case."""
+        if not uuids:
+            return {}
+        sql = """SELECT id, user_id, premium_type, uuid FROM users_install
+                 WHERE addon_id = %%s AND uuid IN (%s);"""
+        self.cursor.execute(sql % ', '.join(['%s'] * len(uuids)),
+                            [self.addon_id] + list(uuids))
+        installs = {}
+        for rid, user_id, premium_type, uuid in self.cursor.fetchall():
+            installs.setdefault(uuid.lower(), (rid, user_id, premium_type))
+        return installs
+
+    def get_purchases(self, user_ids):
+        """{user_id: (id, type)}"""
+        sql = """SELECT id, type, user_id FROM addon_purchase
+                 WHERE addon_id = %%s AND user_id IN (%s);"""
+        self.cursor.execute(sql % ', '.join(['%s'] * len(user_ids)),
+                            [self.addon_id] + list(user_ids))
+        purchases = {}
+        for pid, type_, user_id in self.cursor.fetchall():
+            purchases.setdefault(user_id, (pid, type_))
+        return purchases
+
+    def log(self, msg):
+        log_info({'receipts': len(self.receipts), 'addon': self.addon_id},
+                 msg)
+
+
 def decode_receipt(receipt):
     """
     Cracks the receipt using the private key. This will probably change
     to using the cert at some point, especially when we get the HSM.
+
+    Receipts that have been verified recently come out of `verified`
+    without checking the signature again.
     """
     with statsd.timer('services.decode'):
-        if settings.SIGNING_SERVER_ACTIVE:
-            verifier = certs.ReceiptVerifier()
-            if not verifier.verify(receipt):
+        if not settings.SIGNING_SERVER_ACTIVE:
+            # Loads the key again if it changed, which clears `verified`.
+            key = keys.get_key()
+        digest = hashlib.sha1(receipt).digest()
+        raw = verified.get(digest)
+        if raw is not None:
+            statsd.incr('services.decode.cached')
+        elif settings.SIGNING_SERVER_ACTIVE:
+            if not keys.get_verifier().verify(receipt):
                 raise VerificationError()
-            return jwt.decode(receipt.split('~')[1], verify=False)
+            raw = jwt.decode(receipt.split('~')[1], verify=False)
+            verified.set(digest, raw)
         else:
-            key = jwt.rsa_load(settings.WEBAPPS_RECEIPT_KEY)
             raw = jwt.decode(receipt, key)
-    return raw
+            verified.set(digest, raw)
+    # The caller is free to change what it gets.
+    return copy.deepcopy(raw)
 
 
 # For consistency with the rest of amo, we'll include addon id in the
 # URL and pull it out using this regex.
 id_re = re.compile('/verify/(?P<addon_id>\d+)$')
+batch_re = re.compile('/verify/(?P<addon_id>\d+)/batch$')
 
 
 def application(environ, start_response):
+    if batch_re.search(environ['PATH_INFO']):
+        return batch_application(environ, start_response)
+
     status = '200 OK'
     with statsd.timer('services.verify'):
 
@@ -224,13 +400,48 @@ def application(environ, start_response):
             verify = Verify(addon_id, data, environ)
             output = verify()
             start_response(status, verify.get_headers(len(output)))
-            receipt_cef.log(environ, addon_id, 'verify',
-                            'Receipt verification')
+            log_receipt_cef(environ, addon_id, 'verify',
+                                'Receipt verification')
         except:
             output = ''
             log_exception({'receipt': '%s...' % data[:10], 'addon': addon_id})
-            receipt_cef.log(environ, addon_id, 'verify',
-                            'Receipt verification error')
+            log_receipt_cef(environ, addon_id, 'verify',
+                                'Receipt verification error')
+            start_response('500 Internal Server Error', [])
+
+    return [output]
+
+
+def batch_application(environ, start_response):
+    """
+    Verifies a JSON list of receipts for the app in the url, POSTed to
+    /verify/<app id>/batch. Responds with a JSON list of the results.
+    """
+    status = '200 OK'
+    with statsd.timer('services.verify.batch'):
+        data = environ['wsgi.input'].read()
+        addon_id = batch_re.search(environ['PATH_INFO']).group('addon_id')
+        try:
+            receipts = json.loads(data)
+            verify = BatchVerify(addon_id, receipts, environ)
+            if not (isinstance(receipts, list) and verify.is_valid()):
+                raise ValueError('Bad batch')
+        except ValueError:
+            log_info({'receipt': '%s...' % data[:10], 'addon': addon_id},
+                     'Bad batch of receipts')
+            start_response('400 Bad Request', [])
+            return ['']
+
+        try:
+            output = verify()
+            start_response(status, verify.get_headers(len(output)))
+            log_receipt_cef(environ, addon_id, 'verify',
+                                'Batch receipt verification')
+        except:
+            output = ''
+            log_exception({'receipts': len(receipts), 'addon': addon_id})
+            log_receipt_cef(environ, addon_id, 'verify',
+                                'Batch receipt verification error')
             start_response('500 Internal Server Error', [])
 
     return [output]